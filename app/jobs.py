@@ -0,0 +1,257 @@
+"""
+jobs.py
+
+This script defines a small persistent job queue so long-running work (collecting, clustering and uploading a user's library) runs outside the web request workers. Jobs are stored in a SQLite database, which acts as the broker: web workers submit jobs and poll their status, while worker processes (see worker.py) claim and run them.
+
+A job whose worker dies stops sending heartbeats; once it has been silent for stale_after seconds another worker picks it up again, so a restart does not lose in-flight work.
+"""
+
+#Standard Python imports
+import json, logging, os, socket, sqlite3, threading, time, traceback, uuid
+
+#Custom script imports
+from scripts.metrics import StageTimings, collecting_timings, timed
+
+
+#Seconds without a heartbeat before a running job is considered abandoned and re-queued
+STALE_JOB_SECONDS = 120
+
+#Seconds between heartbeats of a running job
+HEARTBEAT_SECONDS = 15
+
+#Number of times a job is started before it is marked as failed for good
+MAX_JOB_ATTEMPTS = 3
+
+
+class JobError(Exception):
+    """
+    Raised by a job handler to fail the job with a message meant for the user. The job is not retried.
+    """
+
+
+
+class JobContext:
+    def __init__(self, queue, job_id, payload, progress):
+        """
+        Handed to a job handler. It carries the job's payload and lets the handler report progress, which is saved with the job so it survives a restart and can be shown while polling. Every span timed while the handler runs is summed in timings (see scripts/metrics.py)
+        """
+        self.queue = queue
+        self.job_id = job_id
+        self.payload = payload
+        self.progress = progress
+        self.timings = StageTimings()
+
+    def report_progress(self, **progress):
+        self.progress.update(progress)
+        self.queue.update_progress(self.job_id, self.progress)
+
+
+
+class JobQueue:
+    def __init__(self, db_path, stale_after=STALE_JOB_SECONDS):
+        """
+        Args:
+            db_path (str): path of the SQLite database shared by the web and worker processes
+            stale_after (int): seconds without a heartbeat before a running job is re-queued
+        """
+        self.db_path = db_path
+        self.stale_after = stale_after
+        self.handlers = {}
+        self._create_tables()
+
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+
+    def _create_tables(self):
+        connection = self._connect()
+        try:
+            #WAL lets the status polls read while a worker writes
+            connection.execute('PRAGMA journal_mode=WAL;')
+            connection.execute("""CREATE TABLE IF NOT EXISTS Jobs (
+                JobID TEXT PRIMARY KEY,
+                JobType TEXT NOT NULL,
+                Payload TEXT NOT NULL,
+                Status TEXT NOT NULL,
+                Progress TEXT,
+                Result TEXT,
+                Error TEXT,
+                Attempts INTEGER NOT NULL DEFAULT 0,
+                WorkerID TEXT,
+                CreatedAt REAL NOT NULL,
+                UpdatedAt REAL NOT NULL,
+                HeartbeatAt REAL
+            );""")
+            connection.execute('CREATE INDEX IF NOT EXISTS JobsByStatus ON Jobs(Status, CreatedAt);')
+        finally:
+            connection.close()
+
+
+    def register(self, job_type, handler):
+        """
+        register a handler for a job type. The handler receives a JobContext and its return value (JSON-serializable) is stored as the job's result
+        """
+        self.handlers[job_type] = handler
+
+
+    def submit(self, job_type, payload):
+        """
+        queue a job and return its id right away
+
+        Args:
+            job_type (str): a type registered with register()
+            payload (dict): JSON-serializable arguments for the handler
+
+        Returns:
+            str: the job id
+        """
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('INSERT INTO Jobs(JobID,JobType,Payload,Status,Progress,CreatedAt,UpdatedAt) VALUES(?,?,?,?,?,?,?);',
+                               (job_id, job_type, json.dumps(payload), 'queued', json.dumps({}), now, now))
+        finally:
+            connection.close()
+        logging.info(f'Queued {job_type} job {job_id}')
+        return job_id
+
+
+    def get(self, job_id):
+        """
+        Returns:
+            dict: the job's id, type, status, progress, result and error, or None if there is no such job
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute('SELECT * FROM Jobs WHERE JobID=?;', (job_id,)).fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        return {'job_id': row['JobID'], 'job_type': row['JobType'], 'payload': json.loads(row['Payload']), 'status': row['Status'],
+                'progress': json.loads(row['Progress'] or '{}'), 'result': json.loads(row['Result']) if row['Result'] else None,
+                'error': row['Error'], 'attempts': row['Attempts'], 'created_at': row['CreatedAt'], 'updated_at': row['UpdatedAt']}
+
+
+    def _execute(self, statement, values):
+        connection = self._connect()
+        try:
+            connection.execute(statement, values)
+        finally:
+            connection.close()
+
+
+    def update_progress(self, job_id, progress):
+        now = time.time()
+        self._execute('UPDATE Jobs SET Progress=?, UpdatedAt=?, HeartbeatAt=? WHERE JobID=?;', (json.dumps(progress), now, now, job_id))
+
+
+    def heartbeat(self, job_id):
+        self._execute('UPDATE Jobs SET HeartbeatAt=? WHERE JobID=?;', (time.time(), job_id))
+
+
+    def complete(self, job_id, result):
+        self._execute("UPDATE Jobs SET Status='succeeded', Result=?, UpdatedAt=? WHERE JobID=?;", (json.dumps(result), time.time(), job_id))
+
+
+    def fail(self, job_id, error):
+        self._execute("UPDATE Jobs SET Status='failed', Error=?, UpdatedAt=? WHERE JobID=?;", (error, time.time(), job_id))
+
+
+    def claim_next(self, worker_id):
+        """
+        atomically claim the oldest queued job, or a running job whose worker stopped sending heartbeats
+
+        Returns:
+            sqlite3.Row: the claimed job, or None if there is nothing to do
+        """
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE;')
+            while True:
+                row = connection.execute("SELECT * FROM Jobs WHERE Status='queued' OR (Status='running' AND HeartbeatAt < ?) ORDER BY CreatedAt LIMIT 1;",
+                                         (now - self.stale_after,)).fetchone()
+                if row is None:
+                    connection.execute('COMMIT;')
+                    return None
+                if row['Attempts'] < MAX_JOB_ATTEMPTS:
+                    break
+
+                #give up on a job that keeps losing its worker, and claim the next one instead of leaving the worker idle
+                connection.execute("UPDATE Jobs SET Status='failed', Error=?, UpdatedAt=? WHERE JobID=?;",
+                                   ('THE JOB WAS ABANDONED TOO MANY TIMES', now, row['JobID']))
+
+            connection.execute("UPDATE Jobs SET Status='running', Attempts=Attempts+1, WorkerID=?, UpdatedAt=?, HeartbeatAt=? WHERE JobID=?;",
+                               (worker_id, now, now, row['JobID']))
+            connection.execute('COMMIT;')
+            return row
+        except:
+            connection.execute('ROLLBACK;')
+            raise
+        finally:
+            connection.close()
+
+
+    def run_job(self, row):
+        """
+        run a claimed job with its handler, sending heartbeats while it works, and record the outcome
+        """
+        job_id = row['JobID']
+        context = JobContext(self, job_id, json.loads(row['Payload']), json.loads(row['Progress'] or '{}'))
+        finished = threading.Event()
+
+        def send_heartbeats():
+            while not finished.wait(HEARTBEAT_SECONDS):
+                self.heartbeat(job_id)
+
+        heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+        heartbeat_thread.start()
+
+        logging.info(f"Running {row['JobType']} job {job_id} (attempt {row['Attempts'] + 1})")
+        try:
+            handler = self.handlers[row['JobType']]
+            with collecting_timings(context.timings), timed(f"{row['JobType']}_job"):
+                result = handler(context)
+            self.complete(job_id, result)
+            logging.info(f'Job {job_id} succeeded')
+        except JobError as e:
+            logging.info(f'Job {job_id} failed: {e}')
+            self.fail(job_id, str(e))
+        except Exception as e:
+            logging.error(f'Job {job_id} raised an unexpected error\n{traceback.format_exc()}')
+            self.fail(job_id, f'UNEXPECTED ERROR: {e}')
+        finally:
+            finished.set()
+            logging.info(f'Job {job_id} timings: {json.dumps(context.timings.summary())}')
+
+
+    def run_worker(self, poll_interval=1.0, stop_event=None):
+        """
+        claim and run jobs until stop_event is set (or forever)
+        """
+        worker_id = f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+        logging.info(f'Job worker {worker_id} started')
+        while stop_event is None or not stop_event.is_set():
+            row = self.claim_next(worker_id)
+            if row is None:
+                time.sleep(poll_interval)
+                continue
+            self.run_job(row)
+
+
+    def start_worker_threads(self, count, poll_interval=1.0):
+        """
+        run workers as daemon threads of the current process; meant for running the app locally without separate worker processes
+
+        Returns:
+            threading.Event: set it to stop the workers
+        """
+        stop_event = threading.Event()
+        for _ in range(count):
+            threading.Thread(target=self.run_worker, kwargs={'poll_interval': poll_interval, 'stop_event': stop_event}, daemon=True).start()
+        return stop_event
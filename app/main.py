@@ -6,15 +6,24 @@ This script runs the Flask application and performs all routing tasks
 
 
 #Standard Python imports
-import json, random, uuid, requests, boto3, pandas as pd
+import json, os, random, uuid, requests
 
 #Flask imports
-from flask import Flask, request, redirect, render_template, url_for
+from flask import Flask, request, redirect, render_template, url_for, jsonify
 from flask.helpers import make_response
 from urllib.parse import quote
 
 #Explicit function imports from utils.py file 
-from utils import prime_user_from_access_token, prepare_playlists, prepare_data, execute_clustering, gather_cluster_size_from_submission, organize_cluster_data_for_display, gatherAuthInfoAWS, create_db_connection, initUserDataStructures,upload_data_to_bucket, read_data_from_bucket, user_s3_exists
+from utils import prime_user_from_access_token, prepare_data, cluster_and_prepare_playlists, clustering_result_cache, gather_cluster_size_from_submission, gatherAuthInfoAWS, DBConnectionPool, initUserDataStructures, build_track_features_cache, SUPPORTED_CLUSTER_SIZES, AUTO_CLUSTERS, choose_cluster_count, build_results_artifact, upload_results_artifact, read_results_artifact, data_version, library_version, find_published_clusters, record_published_clusters, store_published_tracks, read_published_tracks
+
+#Background job queue that runs clusterings outside the request workers
+from jobs import JobQueue, JobError
+
+#Where every per-user artifact is kept (S3, or local disk when running offline)
+from storage import build_artifact_store, save_frame, load_frame, save_labels, load_labels
+
+#Stage timings and Spotify request counts, exposed for Prometheus
+from scripts.metrics import render_metrics
 
 
 
@@ -43,16 +52,32 @@ else:
 #Initialize contact to database
 DATABASE_SECRET_NAME = 'radialdbcredentials'
 
+#Per-process database connection pool; the credentials are resolved once, when the first connection is opened
+db_pool = DBConnectionPool(DATABASE_SECRET_NAME)
+
+#Audio features cache shared by every user this process clusters
+track_features_cache = build_track_features_cache(db_pool)
+
+
+#Job queue shared by the web workers (which submit and poll) and the job workers (which run the jobs, see worker.py)
+JOBS_DB_PATH = os.environ.get('RADIAL_JOBS_DB', 'radial_jobs.sqlite3')
+JOB_WORKER_THREADS = int(os.environ.get('RADIAL_JOB_WORKER_THREADS', 2))
+job_queue = JobQueue(JOBS_DB_PATH)
+
 
 RADIAL_BUCKET_NAME = "radial-web-app-data"
 RADIAL_BUCKET = f"s3://{RADIAL_BUCKET_NAME}"
 RADIAL_BUCKET_ARN = f"arn:aws:s3:::{RADIAL_BUCKET_NAME}"
 
+#Artifacts go to the bucket, or to this directory when it is set (e.g. to run without AWS). The store keeps one pooled client for the life of the process
+RADIAL_STORAGE_DIR = os.environ.get('RADIAL_STORAGE_DIR')
+artifact_store = build_artifact_store(RADIAL_BUCKET_NAME, RADIAL_STORAGE_DIR)
+
 
-# Client Keys - these need to be changed prior to non-beta production
-radial_keys = gatherAuthInfoAWS()
-CLIENT_ID = radial_keys['radial-spotify-client-id']
-CLIENT_SECRET = radial_keys['radial-spotify-client-secret']
+# Client Keys - these need to be changed prior to non-beta production. They are resolved on first use (see utils.resolve_secret), not when a worker starts
+def spotify_client_keys():
+    radial_keys = gatherAuthInfoAWS()
+    return radial_keys['radial-spotify-client-id'], radial_keys['radial-spotify-client-secret']
 
 # Spotify URLS
 SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
@@ -71,7 +96,6 @@ auth_query_parameters = {
     "response_type": "code",
     "redirect_uri": REDIRECT_URI,
     "scope": SCOPE,
-    "client_id": CLIENT_ID,
     "show_dialog":'true'
 }
 
@@ -110,7 +134,8 @@ def authenticateuser():
     Redirect the user to the Spotify Authorization URL for the application 
     """
     # Auth Step 1: Authorization
-    url_args = "&".join(["{}={}".format(key, quote(val)) for key, val in auth_query_parameters.items()])
+    client_id, _ = spotify_client_keys()
+    url_args = "&".join(["{}={}".format(key, quote(val)) for key, val in dict(auth_query_parameters, client_id=client_id).items()])
     auth_url = "{}/?{}".format(SPOTIFY_AUTH_URL, url_args)
     return redirect(auth_url)
 
@@ -125,12 +150,13 @@ def callback():
     # Request refresh and access tokens
 
     auth_token = request.args['code']
+    client_id, client_secret = spotify_client_keys()
     code_payload = {
         "grant_type": "authorization_code",
         "code": str(auth_token),
         "redirect_uri": REDIRECT_URI,
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
+        'client_id': client_id,
+        'client_secret': client_secret
     }
 
     #logging payload for debugging
@@ -162,12 +188,9 @@ def callback():
 
 
 
-    #Make cursor for database 
-    db_connection = create_db_connection(db_secret_name=DATABASE_SECRET_NAME)
-
-
-    #Creating data structures for user
-    initUserDataStructures(db_connection,refresh_token, access_token, expires_in, user_id, user_display_name)
+    #Borrow a database connection and create the data structures for the user
+    with db_pool.connection() as db_connection:
+        initUserDataStructures(db_connection,refresh_token, access_token, expires_in, user_id, user_display_name)
 
     #log statement to confirm execution of function
     app.logger.info(msg='Set user')
@@ -195,7 +218,7 @@ def loadingpage():
     chosen_clusters = gather_cluster_size_from_submission(desired_clusters)
     
     #this logic is temporary and will be moved, but checks if the chosen_clusters created is valid or not since ther would be occasional errors where the wrong cluster size gets extracted
-    if chosen_clusters not in [5,9,13]:
+    if chosen_clusters != AUTO_CLUSTERS and chosen_clusters not in SUPPORTED_CLUSTER_SIZES:
         raise AssertionError('THE PASSSED CLUSTER SIZE IS INVALID')
     
     #render the loadingpage.html templaet
@@ -208,102 +231,192 @@ def clustertracks():
     """
     clustertracks()
 
-    Handles the logic of clustering the user's tracks. This function takes a long time and runs in the background while loadingpage() entertains the users. Returns a successful 200 response if data posts 
+    Queues the clustering of the user's tracks and returns the job id right away (202). The work itself is done by a job worker (see run_clustertracks_job) while loadingpage() entertains the users and polls jobstatus()
     """
 
     #Gather appropriate data
     spotify_user_id = request.args.get('spotify_user_id')
     chosen_algorithm = request.form.get('chosen_algorithm')
-    chosen_clusters = int(request.form.get('chosen_clusters'))
+    chosen_clusters = request.form.get('chosen_clusters')
+    chosen_clusters = chosen_clusters if chosen_clusters == AUTO_CLUSTERS else int(chosen_clusters)
+
+    job_id = job_queue.submit('clustertracks', {'spotify_user_id': spotify_user_id, 'chosen_algorithm': chosen_algorithm, 'chosen_clusters': chosen_clusters})
+
+    return make_response(jsonify({'job_id': job_id}), 202)
+
+
+
+@app.route('/jobstatus/<job_id>')
+def jobstatus(job_id):
+    """
+    jobstatus(job_id)
+
+    Lightweight status check polled by the loading page. Only touches the job database
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return make_response(jsonify({'error': 'UNKNOWN JOB'}), 404)
+    return jsonify({key: job[key] for key in ['job_id', 'status', 'progress', 'result', 'error']})
+
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    metrics()
+
+    Stage timings and Spotify request counts of every worker and job worker process, in the Prometheus text format
+    """
+    body, content_type = render_metrics()
+    return make_response(body, 200, {'Content-Type': content_type})
+
+
+
+def run_clustertracks_job(job):
+    """
+    run_clustertracks_job(job)
+
+    Handles the logic of clustering the user's tracks: collecting the library, clustering it, and storing the prepared playlists. This takes a long time, so it runs on a job worker rather than in a web request
+
+    Raises JobError with a message for the user if a step fails
+    """
+
+    #Gather appropriate data
+    spotify_user_id = job.payload['spotify_user_id']
+    chosen_algorithm = job.payload['chosen_algorithm']
+    chosen_clusters = job.payload['chosen_clusters']
 
 
     #Retrieve relevant user data to create obj
-    cursor = create_db_connection(DATABASE_SECRET_NAME).cursor()
+    job.report_progress(stage='Connecting to your account')
     try:
-        cursor.execute(f'SELECT AccessToken FROM RadialUsers WHERE SpotifyID="{spotify_user_id}";')
-        retrieved_access_token = cursor.fetchone()[0]
+        with db_pool.connection() as db_connection, db_connection.cursor() as cursor:
+            cursor.execute('SELECT AccessToken, RefreshToken, AccessExpires FROM RadialUsers WHERE SpotifyID=%s;', (spotify_user_id,))
+            retrieved_access_token, retrieved_refresh_token, retrieved_expiration = cursor.fetchone()
     
     except:
-        return make_response('There was a problem collecting the access token from the database: possible invalid access token or user id', 400)
+        raise JobError('There was a problem collecting the access token from the database: possible invalid access token or user id')
     
 
 
-    #Create the user object from the access token 
-    user_obj = prime_user_from_access_token(spotify_user_id, retrieved_access_token)
+    #Create the user object from the access token; it refreshes the token itself if the job outlives it
+    user_obj = prime_user_from_access_token(spotify_user_id, retrieved_access_token, features_cache=track_features_cache,
+                                            refresh_token=retrieved_refresh_token, access_expires=retrieved_expiration, db_pool=db_pool)
 
 
-    # Check if user prepared data already exists
+    # Collect the user's library. If a previous run stored playlist snapshots, only the playlists that changed since are downloaded
     
-    s3_client = boto3.client('s3')
+    previous_snapshots = artifact_store.get_json(f"{spotify_user_id}/playlist_snapshots.json")
+    stored_data = None
+    if previous_snapshots is not None:
+        app.logger.info('The user has playlist snapshots from a previous run, hence refresh incrementally')
+        #Data prepared from exactly those playlists is reused as is if none of them changed since
+        stored_data = load_frame(artifact_store, f"{spotify_user_id}/prepared_data", library_version=library_version(previous_snapshots))
 
-    if user_s3_exists(s3_client, spotify_user_id, optional_file='user_prepared_data.csv'):
-        #data already exist so let's return it
-        app.logger.info('The user already has data that exist, hence collect it')
-        user_prepared_data = pd.read_csv(f'{RADIAL_BUCKET}/{spotify_user_id}/labelled_data.csv', index_col=0)
-        app.logger.info('Collected user data from bucket successfully')
+    #Begin gathering user clustering data
+    app.logger.info(msg='Gathering entirety of user track library and preparing for clustering')
+    job.report_progress(stage='Collecting your library')
 
-    else:
-        # data does not exist so we need to collect
+    try:
+        user_prepared_data = prepare_data(user_obj, previous_snapshots, stored_data)
+    
+    except AssertionError as e:
+        raise JobError(f'THERE WAS A PROBLEM COLLECTING THE DATA AND IS LIKELY RELATED TO FAULTY ACCESS TOKEN: {e}')
 
-        #Begin gathering user clustering data
-        app.logger.info(msg='Gathering entirety of user track library and preparing for clustering')
 
-        try:
-            user_prepared_data = prepare_data(user_obj)
-        
-        except AssertionError as e:
-            return make_response(f'THERE WAS A PROBLEM COLLECTING THE DATA AND IS LIKELY RELATED TO FAULTY ACCESS TOKEN: {e}', 400)
+    #Labels stored for this data version mean nothing changed; otherwise results cached for the old data are dropped
+    prepared_data_version = data_version(user_prepared_data)
+    stored_labels = load_labels(artifact_store, f"{spotify_user_id}/cluster_labels.npy", prepared_data_version)
+    if stored_labels is None:
+        clustering_result_cache.invalidate_user(spotify_user_id, prepared_data_version)
 
+    #Keep the prepared data, tagged with the playlists it was prepared from, so the next run can reuse it if none of them changes. Written before the snapshots it belongs to
+    current_snapshots = user_obj.playlist_snapshots()
+    if user_prepared_data is not stored_data:
+        save_frame(artifact_store, f"{spotify_user_id}/prepared_data", user_prepared_data, prepared_data_version, library_version=library_version(current_snapshots))
+    artifact_store.put_json(f"{spotify_user_id}/playlist_snapshots.json", current_snapshots)
 
-        #Temporarily store in a CSV file for debugging purposes
-        user_prepared_data.to_csv(f'{RADIAL_BUCKET}/{spotify_user_id}/user_prepared_data.csv')
+    app.logger.info(msg='Data successfully gathered and prepared')
 
-        app.logger.info(msg='Data successfully gathered and prepared')
+    #Let Radial pick the number of clusters if the user asked it to
+    if chosen_clusters == AUTO_CLUSTERS:
+        job.report_progress(stage='Choosing the number of clusters')
+        chosen_clusters = choose_cluster_count(user_prepared_data)
 
     #Execute clustering of user track data with given parameters
     app.logger.info(f'PREPARING TO CLUSTER DATA WITH {chosen_algorithm} {chosen_clusters}')
+    job.report_progress(stage='Clustering your tracks')
 
 
 
     try:
 
-        labelled_data = execute_clustering(chosen_algorithm,chosen_clusters,user_prepared_data)
-        
-        #Temporarily store for debugging purposes
-        labelled_data.to_csv(f'{RADIAL_BUCKET}/{spotify_user_id}/labelled_data.csv')
+        #A repeat of the request with unchanged data comes back from the result cache without clustering
+        cluster_labels, prepared_playlists, cached_result = cluster_and_prepare_playlists(user_obj, chosen_algorithm, chosen_clusters, user_prepared_data,
+                                                                                          store=artifact_store, user_id=spotify_user_id, version=prepared_data_version)
         app.logger.info(msg='Data clustered')
-
-
-        #Finally, prepare the user playlists for rendering and display
-        prepared_playlists = prepare_playlists(user_obj,labelled_data)
     
     except:
-        return make_response('THERE WAS A PROBLEM CLUSTERING THE DATA', 400)
+        raise JobError('THERE WAS A PROBLEM CLUSTERING THE DATA')
+
+
+    #Identifies this clustering in the Clusterings table and, through the results, the playlists published from it
+    clustering_id = str(uuid.uuid4())
+
+    #If the stored labels are from this same clustering of this data, everything stored after them is still current and there is nothing to upload
+    stored_metadata = stored_labels[1] if stored_labels is not None else {}
+    stored_results = None
+    if cached_result and stored_metadata.get('algorithm') == chosen_algorithm and stored_metadata.get('clusters') == str(chosen_clusters):
+        stored_results = read_results_artifact(artifact_store, spotify_user_id)
+        if stored_results is not None and (stored_results['chosen_algorithm'], stored_results['chosen_clusters']) != (chosen_algorithm, chosen_clusters):
+            stored_results = None
+
+    if stored_results is not None:
+        #The stored results and the playlists published from them keep their clustering, so this run is recorded as the same one
+        clustering_id = stored_results.get('clustering_id') or stored_results['content_hash']
+        app.logger.info(msg='Stored cluster results are already up to date')
+
+    else:
+        job.report_progress(stage='Saving your clusters')
+        artifact_store.put_json(f"{spotify_user_id}/prepared_playlists.json", prepared_playlists)
+
+        #Store the labels alongside the prepared data; together they are the labelled data. Written after the playlists, so labels matching a request mean its playlists were stored
+        save_labels(artifact_store, f"{spotify_user_id}/cluster_labels.npy", cluster_labels, prepared_data_version, algorithm=chosen_algorithm, clusters=chosen_clusters)
 
+        app.logger.info(msg='Dumped user cluster results to JSON in proper bucket')
 
-    upload_data_to_bucket(RADIAL_BUCKET_NAME,prepared_playlists, f"{spotify_user_id}/prepared_playlists.json")
 
-    app.logger.info(msg='Dumped user cluster results to JSON in proper bucket')
+        #Build what the results page shows now, so viewing (and refreshing) it is a single read
+        job.report_progress(stage='Preparing your results')
+        try:
+            user_obj.contacter.ensure_fresh_token()
+            results_artifact = build_results_artifact(user_obj.contacter.accessHeader, prepared_playlists, chosen_algorithm, chosen_clusters, clustering_id)
+            upload_results_artifact(artifact_store, spotify_user_id, results_artifact)
+        
+        except Exception as e:
+            #the results page builds it on the first view instead
+            app.logger.info(f'Could not prepare the results page ahead of time: {e}')
 
 
     try:
 
-        #Insert clustering parameters for statistical purposes 
-        insert_statement = 'INSERT INTO Clusterings(ClusteringID,SpotifyID,ClusterAlgorithm,ClustersChosen) VALUES(%s,%s, %s, %s)'
-        insertable_values = (str(uuid.uuid4()), spotify_user_id, chosen_algorithm,chosen_clusters)
-        db_connection = create_db_connection(DATABASE_SECRET_NAME)
-        cursor = db_connection.cursor()
-        cursor.execute(insert_statement, insertable_values)
-        db_connection.commit()
-        cursor.close()
+        #Insert clustering parameters for statistical purposes, along with where the job spent its time. A repeat of a stored clustering keeps the row and timings of its first run
+        insert_statement = ('INSERT INTO Clusterings(ClusteringID,SpotifyID,ClusterAlgorithm,ClustersChosen,TimingSummary) VALUES(%s,%s, %s, %s, %s) '
+                            'ON DUPLICATE KEY UPDATE ClusteringID=ClusteringID')
+        insertable_values = (clustering_id, spotify_user_id, chosen_algorithm,chosen_clusters, json.dumps(job.timings.summary()))
+        with db_pool.connection() as db_connection:
+            with db_connection.cursor() as cursor:
+                cursor.execute(insert_statement, insertable_values)
+            db_connection.commit()
 
     except:
-        return make_response(f"FINAL INSERTION INTO DB FAILED", 400)
+        raise JobError("FINAL INSERTION INTO DB FAILED")
+
 
+    return {'message': 'SUCCESSFULLY CLUSTERED AND STORED RELEVANT DATA', 'chosen_clusters': chosen_clusters}
 
-    #Create final response to indicate successful clustering
 
-    return make_response('SUCCESSFULLY CLUSTERED AND STORED RELEVANT DATA', 200)
+job_queue.register('clustertracks', run_clustertracks_job)
 
 
 
@@ -321,28 +434,40 @@ def clusteringresults():
     #Gather relevant data
     app.logger.info(f"{request.args}")
     spotify_user_id = request.args.get('spotify_user_id')
-    
-    prepared_playlists = json.loads(read_data_from_bucket(RADIAL_BUCKET_NAME,f"{spotify_user_id}/prepared_playlists.json"))
-
-    chosen_clusters = int(request.args.get('chosen_clusters' if 'chosen_clusters' in request.args else 'amp;chosen_clusters'))
-    chosen_algorithm = request.args.get('chosen_algorithm' if 'chosen_algorithm' in request.args else 'amp;chosen_algorithm')
 
-    cursor = create_db_connection(DATABASE_SECRET_NAME).cursor()
-    cursor.execute(f'SELECT * FROM RadialUsers WHERE SpotifyID="{spotify_user_id}";')
+    #The clustering job stores the display payload when it finishes
+    results_artifact = read_results_artifact(artifact_store, spotify_user_id)
 
+    if results_artifact is None:
+        #Results from before the artifact existed: build it once from the prepared playlists
+        prepared_playlists = artifact_store.get_json(f"{spotify_user_id}/prepared_playlists.json")
+        if prepared_playlists is None:
+            #Never clustered (or the results were cleared): send the user back to start a clustering
+            app.logger.info(f'no clustering results stored for {spotify_user_id}, redirecting to the clustering page')
+            return redirect(url_for('appeducation', spotify_user_id = spotify_user_id))
 
-    retrieved_id, retrieved_display_name, retrieved_access_token = cursor.fetchone()[:3]
-    #Establish authorization header for posting to Spotify
-    auth_header = {'Authorization': f'Bearer {retrieved_access_token}'}
+        chosen_clusters = int(request.args.get('chosen_clusters' if 'chosen_clusters' in request.args else 'amp;chosen_clusters'))
+        chosen_algorithm = request.args.get('chosen_algorithm' if 'chosen_algorithm' in request.args else 'amp;chosen_algorithm')
 
-    #Retrieve relevant displayable data for clustering results and save
-    displayable_data, total_organized_playlist_data = organize_cluster_data_for_display(auth_header,prepared_playlists)
+        with db_pool.connection() as db_connection, db_connection.cursor() as cursor:
+            cursor.execute('SELECT AccessToken FROM RadialUsers WHERE SpotifyID=%s;', (spotify_user_id,))
+            retrieved_access_token = cursor.fetchone()[0]
+        #Establish authorization header for posting to Spotify
+        auth_header = {'Authorization': f'Bearer {retrieved_access_token}'}
 
-    upload_data_to_bucket(RADIAL_BUCKET_NAME,total_organized_playlist_data, f"{retrieved_id}/total_organized_playlist_data.json")
+        #Retrieve relevant displayable data for clustering results and save
+        results_artifact = build_results_artifact(auth_header, prepared_playlists, chosen_algorithm, chosen_clusters)
+        upload_results_artifact(artifact_store, spotify_user_id, results_artifact)
 
 
-    # render the clusteringresults page with passed data
-    return render_template("clusteringresults.html", displayable_data = displayable_data, total_organized_playlist_data = total_organized_playlist_data, chosen_algorithm = chosen_algorithm, chosen_clusters = chosen_clusters, spotify_user_id = spotify_user_id)
+    # render the clusteringresults page with passed data; the content hash doubles as the ETag so unchanged results answer 304
+    response = make_response(render_template("clusteringresults.html", displayable_data = results_artifact['displayable_data'], total_organized_playlist_data = results_artifact['total_organized_playlist_data'],
+                                             chosen_algorithm = results_artifact['chosen_algorithm'], chosen_clusters = results_artifact['chosen_clusters'], spotify_user_id = spotify_user_id))
+    response.set_etag(results_artifact['content_hash'])
+    response.last_modified = results_artifact['created_at']
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route("/clusteringresults#<cluster_id>")
@@ -350,9 +475,9 @@ def deploy_cluster(cluster_id):
     """
     deploy_cluster(cluster_id)
 
-    Deploy's a user's cluster to Spotify identified by cluster_id 
+    Deploy's a user's cluster to Spotify identified by cluster_id. Deploying is idempotent: a cluster already published from this clustering just redirects to its playlist, and one published from an earlier clustering with the same algorithm and number of clusters has only its changed tracks sent to the same playlist
 
-    Redirects to created playlist on Spotify in new tab 
+    Redirects to the cluster's playlist on Spotify in new tab 
     """
 
     #Log relevant data for debugging purposes
@@ -364,24 +489,35 @@ def deploy_cluster(cluster_id):
     #Gathering relevant data to post
     spotify_user_id = request.args.get('spotify_user_id')
 
-    total_organized_playlist_data = json.loads(read_data_from_bucket(RADIAL_BUCKET_NAME,f"{spotify_user_id}/total_organized_playlist_data.json"))
-
-    
     #weird ampsersand issues that require special parsing
     chosen_algorithm = request.args.get('chosen_algorithm' if 'chosen_algorithm' in request.args else 'amp;chosen_algorithm')
     chosen_clusters = int(request.args.get('chosen_clusters' if 'chosen_clusters' in request.args else 'amp;chosen_clusters'))
 
+    results_artifact = read_results_artifact(artifact_store, spotify_user_id)
+    if results_artifact is None:
+        #Nothing stored to deploy from yet: the results page builds it from the prepared playlists, or sends the user back to cluster
+        app.logger.info(f'no clustering results stored for {spotify_user_id}, redirecting to the results page')
+        return redirect(url_for('clusteringresults', spotify_user_id = spotify_user_id, chosen_algorithm = chosen_algorithm, chosen_clusters = chosen_clusters))
+    total_organized_playlist_data = results_artifact['total_organized_playlist_data']
+    #results built by the page itself have no clustering id, so their content identifies them instead
+    clustering_id = results_artifact.get('clustering_id') or results_artifact['content_hash']
+
+    #A cluster already published from this clustering needs nothing sent to Spotify
+    published_playlist = find_published_clusters(db_pool, spotify_user_id, clustering_id, chosen_algorithm, chosen_clusters).get(int(cluster_id))
+    if published_playlist is not None and published_playlist[1] == clustering_id:
+        app.logger.info(f'cluster {cluster_id} is already published to {published_playlist[0]}')
+        return redirect(f'https://open.spotify.com/playlist/{published_playlist[0]}')
+
     #Retrieve relevant data
-    cursor = create_db_connection(DATABASE_SECRET_NAME).cursor()
-    cursor.execute(f'SELECT * FROM RadialUsers WHERE SpotifyID="{spotify_user_id}";')
-    
-    retrieved_id, retrieved_display_name, retrieved_access_token = cursor.fetchone()[:3]
+    with db_pool.connection() as db_connection, db_connection.cursor() as cursor:
+        cursor.execute('SELECT * FROM RadialUsers WHERE SpotifyID=%s;', (spotify_user_id,))
+        retrieved_id, retrieved_display_name, retrieved_access_token, retrieved_refresh_token, retrieved_expiration = cursor.fetchone()[:5]
 
     #Logging for debugging
-    app.logger.info(f"gathered the following from the db: {retrieved_id}, {retrieved_display_name}, {retrieved_access_token}")
+    app.logger.info(f"gathered the following from the db: {retrieved_id}, {retrieved_display_name}")
 
-    #Create user obj to post playlist to Spotify
-    specified_user = prime_user_from_access_token(retrieved_id, retrieved_access_token)
+    #Create user obj to post playlist to Spotify; the results page may have been open longer than the token lasts
+    specified_user = prime_user_from_access_token(retrieved_id, retrieved_access_token, refresh_token=retrieved_refresh_token, access_expires=retrieved_expiration, db_pool=db_pool)
     specified_user.optional_display_id = retrieved_display_name
 
     #Logging for debugging
@@ -399,8 +535,15 @@ def deploy_cluster(cluster_id):
     specified_clusters = chosen_clusters
     clustering_type = f"{specified_algorithm.title()} ({specified_clusters})"
 
-    #Deploy the cluster
-    playlist_obj = specified_user.deploy_single_cluster_playlist(tracks_to_add, int(cluster_id) + 1, clustering_type)
+    #Deploy the cluster, or bring the playlist it was published to by an earlier clustering up to date
+    if published_playlist is None:
+        playlist_obj = specified_user.deploy_single_cluster_playlist(tracks_to_add, int(cluster_id) + 1, clustering_type)
+    else:
+        published_tracks = read_published_tracks(artifact_store, spotify_user_id, [published_playlist[0]])[published_playlist[0]]
+        playlist_obj = specified_user.update_cluster_playlist(published_playlist[0], published_tracks, tracks_to_add)
+
+    store_published_tracks(artifact_store, spotify_user_id, {playlist_obj.playlist_id: tracks_to_add})
+    record_published_clusters(db_pool, clustering_id, {int(cluster_id): playlist_obj.playlist_id})
     playlist_url = f'https://open.spotify.com/playlist/{playlist_obj.playlist_id}'
 
     #Redirect to playlist URL
@@ -408,8 +551,91 @@ def deploy_cluster(cluster_id):
     
 
 
+@app.route('/deployallclusters', methods=['POST'])
+def deployallclusters():
+    """
+    deployallclusters()
+
+    Queues publishing every cluster of the user's latest clustering to Spotify and returns the job id right away (202). The clustering results page polls jobstatus() for its progress
+    """
+    spotify_user_id = request.args.get('spotify_user_id')
+    job_id = job_queue.submit('deployclusters', {'spotify_user_id': spotify_user_id})
+    return make_response(jsonify({'job_id': job_id}), 202)
+
+
+
+def run_deployclusters_job(job):
+    """
+    run_deployclusters_job(job)
+
+    Publishes every cluster of the user's latest clustering as a Spotify playlist, all at once (see SpotifyUser.deploy_cluster_playlists). The deployment state is stored after each playlist is created and each batch of tracks is added, so publishing the same results again after a failure resumes where it stopped instead of creating duplicate playlists
+
+    Raises JobError with a message for the user if a step fails
+    """
+    spotify_user_id = job.payload['spotify_user_id']
+
+    results_artifact = read_results_artifact(artifact_store, spotify_user_id)
+    if results_artifact is None:
+        raise JobError('THERE ARE NO CLUSTERING RESULTS TO PUBLISH')
+
+
+    #Retrieve relevant user data to create obj
+    job.report_progress(stage='Connecting to your account')
+    try:
+        with db_pool.connection() as db_connection, db_connection.cursor() as cursor:
+            cursor.execute('SELECT DisplayName, AccessToken, RefreshToken, AccessExpires FROM RadialUsers WHERE SpotifyID=%s;', (spotify_user_id,))
+            retrieved_display_name, retrieved_access_token, retrieved_refresh_token, retrieved_expiration = cursor.fetchone()
+    
+    except:
+        raise JobError('There was a problem collecting the access token from the database: possible invalid access token or user id')
+
+    user_obj = prime_user_from_access_token(spotify_user_id, retrieved_access_token, refresh_token=retrieved_refresh_token, access_expires=retrieved_expiration, db_pool=db_pool)
+    user_obj.optional_display_id = retrieved_display_name
+
+
+    #Every cluster's tracks, closest to the centroid first
+    cluster_playlists = {int(cluster_id): cluster_data['all_tracks'] for cluster_id, cluster_data in results_artifact['total_organized_playlist_data'].items()}
+    clustering_type = f"{results_artifact['chosen_algorithm'].title()} ({results_artifact['chosen_clusters']})"
+    total_tracks = sum(len(track_ids) for track_ids in cluster_playlists.values())
+
+    #Pick up an earlier attempt at publishing these same results
+    state_key = f"{spotify_user_id}/deployment_state.json"
+    stored_state = artifact_store.get_json(state_key)
+    deployment_state = stored_state['clusters'] if stored_state is not None and stored_state['content_hash'] == results_artifact['content_hash'] else {}
+
+    def store_progress(state):
+        artifact_store.put_json(state_key, {'content_hash': results_artifact['content_hash'], 'clusters': state})
+        job.report_progress(stage='Publishing your clusters', playlists_created=len(state), playlists_total=len(cluster_playlists),
+                            tracks_added=sum(cluster_state['tracks_added'] for cluster_state in state.values()), tracks_total=total_tracks)
+
+    #Clusters that already have a playlist (published one at a time, or from an earlier clustering) are brought up to date rather than created again
+    clustering_id = results_artifact.get('clustering_id') or results_artifact['content_hash']
+    published_clusters = find_published_clusters(db_pool, spotify_user_id, clustering_id, results_artifact['chosen_algorithm'], results_artifact['chosen_clusters'])
+    published_tracks = read_published_tracks(artifact_store, spotify_user_id, [playlist_id for playlist_id, _ in published_clusters.values()])
+    published_playlists = {cluster_id: (playlist_id, published_tracks[playlist_id]) for cluster_id, (playlist_id, _) in published_clusters.items() if cluster_id in cluster_playlists}
+
+    job.report_progress(stage='Publishing your clusters', playlists_created=0, playlists_total=len(cluster_playlists), tracks_added=0, tracks_total=total_tracks)
+    try:
+        playlist_ids = user_obj.deploy_cluster_playlists(cluster_playlists, clustering_type, deployment_state, on_progress=store_progress, published_playlists=published_playlists)
+    
+    except Exception as e:
+        raise JobError(f'THERE WAS A PROBLEM PUBLISHING YOUR CLUSTERS; PUBLISHING AGAIN CONTINUES WHERE IT STOPPED: {e}')
+
+    store_published_tracks(artifact_store, spotify_user_id, {playlist_id: cluster_playlists[cluster_id] for cluster_id, playlist_id in playlist_ids.items()})
+    record_published_clusters(db_pool, clustering_id, playlist_ids)
+
+
+    return {'message': 'SUCCESSFULLY PUBLISHED EVERY CLUSTER', 'playlist_urls': {str(cluster_id): f'https://open.spotify.com/playlist/{playlist_id}' for cluster_id, playlist_id in playlist_ids.items()}}
+
+
+job_queue.register('deployclusters', run_deployclusters_job)
+    
+
+
 #RUN THE FLASK SCRIPT EITHER LOCALLY OR ON SERVER
 if __name__ == "__main__":
+    #without uWSGI there are no worker processes, so run the job workers as threads of the dev server
+    job_queue.start_worker_threads(JOB_WORKER_THREADS)
     if DEBUG_MODE:
         app.run(debug=True, port=PORT)
     else:
@@ -1,4 +1,10 @@
 from .track import Track
 from .playlist import Playlist
 from .api_contacter import Contacter
+from .audio_features import AudioFeaturesDownloader
+from .features_cache import TrackFeaturesCache, MySQLTrackFeaturesStore
+from .kmeans_engine import KMeansEngine
+from .k_sweep import KSweep
+from .track_metadata import TrackMetadataCache
+from .result_cache import ClusteringResultCache
 from .new_user import SpotifyUser
@@ -1,16 +1,144 @@
 
-import requests, json, time, logging, os
+import requests, json, time, logging, os, random, threading
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from .metrics import count_spotify_request
+
+
+#Base URL for every Web API call. It can be overridden (e.g. to point at a local fake Spotify server for benchmarking)
+SPOTIFY_API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+
+#Token endpoint used to refresh access tokens, overridable the same way
+SPOTIFY_TOKEN_URL = os.environ.get('SPOTIFY_TOKEN_URL', 'https://accounts.spotify.com/api/token')
+
+#Access tokens are refreshed once they are this many seconds from expiring, so a request never starts with a token about to lapse
+TOKEN_REFRESH_MARGIN = 300
+
+#Stored expiry times further out than this are not trusted (Spotify tokens last an hour) and the token is refreshed before first use
+MAX_TOKEN_LIFETIME = 3600
+
+#Number of keep-alive connections held per host; this bounds how many concurrent requests can reuse a socket
+DEFAULT_POOL_SIZE = 32
+
+#Times a throttled (429), failed (5xx) or dropped request is retried before giving up
+MAX_REQUEST_RETRIES = 6
+
+#Exponential backoff for 5xx responses: the first retry waits up to BACKOFF_BASE seconds, doubling up to BACKOFF_CAP
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+
+#Wait used when a 429 comes without a usable Retry-After header
+DEFAULT_RETRY_AFTER = 1
+
+#Bounds of the adaptive concurrency limit shared by every request in the process, and where it starts
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = DEFAULT_POOL_SIZE
+INITIAL_CONCURRENCY = 16
+
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, initial_limit = INITIAL_CONCURRENCY, min_limit = MIN_CONCURRENCY, max_limit = MAX_CONCURRENCY):
+        '''
+        Caps how many Web API requests are in flight across every thread of the process, adapting the cap with AIMD: each successful request raises it by 1/limit (about +1 per round of requests) and a 429 halves it. A 429 also pauses every new request until its Retry-After has passed, since Spotify rate limits the whole app rather than a single connection
+        '''
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.throttled = 0
+        self.server_errors = 0
+        self._condition = threading.Condition()
+
+
+    @contextmanager
+    def slot(self):
+        '''
+        Blocks until a request may be sent, and holds a slot while it is in flight
+        '''
+        with self._condition:
+            while True:
+                wait = self.resume_at - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self.in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+
+    def record_success(self):
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+    def record_throttle(self, retry_after):
+        with self._condition:
+            self.throttled += 1
+            now = time.monotonic()
+            #requests already in flight when the first 429 arrived tend to be throttled too; halve once per pause, not once per response
+            if now >= self.resume_at:
+                self.limit = max(self.min_limit, self.limit / 2)
+                logging.info(f'Throttled by Spotify: pausing {retry_after}s and lowering concurrency to {int(self.limit)}')
+            self.resume_at = max(self.resume_at, now + retry_after)
+
+
+    def record_server_error(self):
+        with self._condition:
+            self.server_errors += 1
+
+
+    def stats(self):
+        with self._condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight, 'throttled': self.throttled, 'server_errors': self.server_errors}
+
+
+
+#One limiter per process: Spotify's rate limit applies to every user and worker thread at once
+rate_limiter = AdaptiveRateLimiter()
+
+
+def parse_retry_after(response):
+    try:
+        return max(0.0, float(response.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+def backoff_delay(attempt):
+    #full jitter keeps retrying workers from hitting the API in lockstep
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
 
 class Contacter:
-    def __init__(self, auth_hash = None, accessToken = None): #IF DEPRECATED, CONTACTER MAY BE ACCESS TOKEN UNIQUE
+    def __init__(self, auth_hash = None, accessToken = None, pool_size = DEFAULT_POOL_SIZE): #IF DEPRECATED, CONTACTER MAY BE ACCESS TOKEN UNIQUE
 
         self.session = requests.session()
+        #the session is shared by the concurrent fetchers, so size its connection pool to match
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.auth_hash = None 
         self.auth_header = None
 
         self.accessToken = None
         self.accessHeader = None
 
+        #set by enable_token_refresh; without a refresh token the access token is used as is
+        self.refreshToken = None
+        self.accessExpires = None
+        self.on_token_refresh = None
+        self._refresh_lock = threading.Lock()
+
 
 
     def prime_auth_header(self):
@@ -41,19 +169,19 @@ class Contacter:
 
     def refreshTheToken(self,refreshToken, dump_filepath = None):
         assert self.auth_header
-        logging.info(self.auth_header)
+        logging.info('Refreshing the access token')
         
         data = {'grant_type': 'refresh_token', 'refresh_token': refreshToken}
 
 
         headers = self.auth_header.copy()
 
-        response = self.session.post('https://accounts.spotify.com/api/token', data=data, headers=headers)
+        response = self.session.post(SPOTIFY_TOKEN_URL, data=data, headers=headers)
+        count_spotify_request('post', SPOTIFY_TOKEN_URL, response.status_code)
+        assert response.status_code == 200, f'Refreshing the access token failed with status {response.status_code}'
 
         spotifyToken = response.json()
 
-        logging.info(spotifyToken)
-
         # Place the expiration time (current time + almost an hour), and access token into the json
         spotifyState = {'spotify': 'prod', 'expiresAt': int(time.time()) + 3200, 'accessToken': spotifyToken['access_token']}
 
@@ -63,37 +191,127 @@ class Contacter:
             with open(dump_filepath, 'w') as writer:
                 json.dump(spotifyState, writer)
         self.accessToken = spotifyState['accessToken']
-        self.formAccessHeaderfromToken()
+        self.accessExpires = spotifyState['expiresAt']
+        #Spotify sometimes rotates the refresh token as well
+        self.refreshToken = spotifyToken.get('refresh_token', refreshToken)
+        self.formAccessHeaderfromToken(None)
+        return spotifyState
+
+
+
+    def enable_token_refresh(self, refreshToken, accessExpires = None, on_token_refresh = None):
+        '''
+        enable_token_refresh(refreshToken, accessExpires = None, on_token_refresh = None)
+
+        Lets contact_api refresh the access token by itself: ahead of time once it is within TOKEN_REFRESH_MARGIN of accessExpires (epoch seconds), and whenever Spotify answers 401. on_token_refresh(accessToken, refreshToken, accessExpires) is called after each refresh, e.g. to store the new token. Requires auth_header
+        '''
+        assert self.auth_header
+        self.refreshToken = refreshToken
+        now = time.time()
+        #an unknown or implausible expiry is treated as already expired
+        self.accessExpires = accessExpires if accessExpires is not None and accessExpires <= now + MAX_TOKEN_LIFETIME else 0
+        self.on_token_refresh = on_token_refresh
+
+
+    def token_expiring(self):
+        return self.accessExpires is not None and time.time() >= self.accessExpires - TOKEN_REFRESH_MARGIN
+
+
+    def ensure_fresh_token(self, rejected_header = None):
+        '''
+        ensure_fresh_token(rejected_header = None)
+
+        Refreshes the access token if it is about to expire, or if rejected_header (the header a request was just refused with) is still the current one. Concurrent callers share one refresh: whoever gets the lock refreshes and the rest find the new token already in place
+        '''
+        if self.refreshToken is None:
+            return
+        if rejected_header is None and not self.token_expiring():
+            return
+        with self._refresh_lock:
+            if rejected_header is not None and rejected_header is not self.accessHeader:
+                return
+            if rejected_header is None and not self.token_expiring():
+                return
+            spotifyState = self.refreshTheToken(self.refreshToken)
+
+        if self.on_token_refresh is not None:
+            try:
+                self.on_token_refresh(spotifyState['accessToken'], self.refreshToken, spotifyState['expiresAt'])
+            except Exception as e:
+                logging.info(f'Could not store the refreshed access token: {e}')
 
     
 
     def contact_api(self, endpoint, additional_request_parameters = None, contact_type = 'get', data_params = None):
+        '''
+        contact_api(endpoint, additional_request_parameters = None, contact_type = 'get', data_params = None)
+
+        Refreshes the access token first if it is about to expire, and once more if Spotify answers 401. Sends the request through the process-wide rate limiter. 429s are retried after their Retry-After, and 5xx responses and dropped connections (except for POSTs) after a jittered exponential backoff, up to MAX_REQUEST_RETRIES times. Any other non-2xx status, or running out of retries, raises an AssertionError
+        '''
+        self.ensure_fresh_token()
         assert self.accessHeader
         
-        function_caller = {'get': self.session.get, 'post': self.session.post, 'put': self.session.put}
+        function_caller = {'get': self.session.get, 'post': self.session.post, 'put': self.session.put, 'delete': self.session.delete}
         proper_func = function_caller[contact_type]
 
         logging.info(f'We are making a {contact_type.upper()} request to {endpoint}')
 
-        if contact_type in ['post', 'put']:
-            new_auth_header = self.accessHeader
-            new_auth_header['Content-Type'] = 'application/json'
-            logging.info(f'Proceeding with {contact_type.upper()} request')
-            response =  proper_func(endpoint, headers = new_auth_header, data = data_params)
+        if contact_type in ['post', 'put', 'delete']:
+            request_kwargs = {'data': data_params}
+            extra_headers = {'Content-Type': 'application/json'}
         else:
-            logging.info('Proceeding with GET request')
-            response =  proper_func(endpoint, headers = self.accessHeader, params = additional_request_parameters)
-        
-        try:
-            assert response.status_code // 100 == 2
-            logging.info('Successful request')
-            return response
-        except AssertionError:
-            logging.info('Unsuccessful request: dumping response info and headers below')
-            # logging.info(f"ACCESS HEADER: {self.accessHeader}")
+            request_kwargs = {'params': additional_request_parameters}
+            extra_headers = {}
+
+        #a POST that failed midway may still have been applied (e.g. tracks added), so only a 429, which Spotify never processed, is retried for it
+        retry_failures = contact_type != 'post'
+
+        response = None
+        refreshed_after_401 = False
+        for attempt in range(MAX_REQUEST_RETRIES + 1):
+            #read per attempt, since another thread may have refreshed the token in the meantime
+            access_header = self.accessHeader
+            try:
+                with rate_limiter.slot():
+                    response = proper_func(endpoint, headers = dict(access_header, **extra_headers), **request_kwargs)
+            except requests.ConnectionError as e:
+                count_spotify_request(contact_type, endpoint, 'connection_error')
+                if not retry_failures:
+                    raise
+                logging.info(f'Connection to {endpoint} failed ({e}); retrying')
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            count_spotify_request(contact_type, endpoint, response.status_code)
+            if response.status_code // 100 == 2:
+                rate_limiter.record_success()
+                logging.info('Successful request')
+                return response
+
+            if response.status_code == 401 and self.refreshToken is not None and not refreshed_after_401:
+                logging.info('The access token was rejected; refreshing it and retrying')
+                self.ensure_fresh_token(rejected_header = access_header)
+                refreshed_after_401 = True
+                continue
+
+            if response.status_code == 429:
+                rate_limiter.record_throttle(parse_retry_after(response))
+                continue
+
+            if response.status_code // 100 == 5 and retry_failures:
+                rate_limiter.record_server_error()
+                logging.info(f'Spotify answered {response.status_code} for {endpoint}; retrying')
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            break
+
+        logging.info('Unsuccessful request: dumping response info and headers below')
+        # logging.info(f"ACCESS HEADER: {self.accessHeader}")
+        if response is not None:
             logging.info(response.status_code)
             logging.info(response.text)
-            raise AssertionError(f'There was an unsuccessful request using {endpoint}')
+        raise AssertionError(f'There was an unsuccessful request using {endpoint}')
 
         
         
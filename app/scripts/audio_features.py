@@ -0,0 +1,120 @@
+'''
+audio_features.py
+
+This defines the AudioFeaturesDownloader, which pulls audio features for tracks in batches of 100 on a pool of worker threads. Track ids can be fed in while playlists are still being paged, so downloading starts as soon as the first full batch is known. If a TrackFeaturesCache is given, only the ids it does not hold are requested from Spotify.
+'''
+import logging, threading
+from concurrent.futures import ThreadPoolExecutor
+from .api_contacter import SPOTIFY_API_URL
+from .metrics import timed, propagate_timings
+
+
+#Spotify accepts at most 100 ids per audio-features request
+AUDIO_FEATURES_BATCH_SIZE = 100
+
+#Default number of audio-features batches downloaded at once
+DEFAULT_AUDIO_FEATURES_WORKERS = 4
+
+
+class AudioFeaturesDownloader:
+    def __init__(self, contacter, max_workers = DEFAULT_AUDIO_FEATURES_WORKERS, features_cache = None):
+        '''
+        contacter - the Contacter used for the requests
+
+        max_workers = DEFAULT_AUDIO_FEATURES_WORKERS - number of batches requested concurrently
+
+        features_cache = None - a TrackFeaturesCache consulted before, and filled after, each request
+        '''
+        self.contacter = contacter
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.features_cache = features_cache
+        self.audio_features = {}
+        self.batches_downloaded = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self._track_order = []
+        self._seen_track_ids = set()
+        self._pending_track_ids = []
+        self._futures = []
+        self._lock = threading.Lock()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        #on an error the queued batches are useless, so do not wait on them
+        if exc_info[0] is not None:
+            for future in self._futures:
+                future.cancel()
+        self.executor.shutdown(wait = exc_info[0] is None)
+
+
+    def add_track_ids(self, track_ids):
+        '''
+        Queues every unseen track id and submits a download for each full batch
+        '''
+        with self._lock:
+            for track_id in track_ids:
+                if track_id is None or track_id in self._seen_track_ids:
+                    continue
+                self._seen_track_ids.add(track_id)
+                self._track_order.append(track_id)
+                self._pending_track_ids.append(track_id)
+                if len(self._pending_track_ids) == AUDIO_FEATURES_BATCH_SIZE:
+                    self._submit_pending()
+
+
+    def add_playlist_items(self, playlist_items):
+        #raw playlist items can hold a null track (e.g. removed from Spotify), which is skipped
+        self.add_track_ids(item['track']['id'] for item in playlist_items if item.get('track'))
+
+
+    def _submit_pending(self):
+        batch = tuple(self._pending_track_ids)
+        self._pending_track_ids = []
+        self._futures.append(self.executor.submit(propagate_timings(self._download_batch), batch))
+
+
+    def _download_batch(self, track_ids):
+        cached_features = self.features_cache.get_many(track_ids) if self.features_cache is not None else {}
+        missing_track_ids = [track_id for track_id in track_ids if track_id not in cached_features]
+
+        downloaded_features = {}
+        if missing_track_ids:
+            endpoint = f'{SPOTIFY_API_URL}/audio-features'
+            with timed('audio_features_batch'):
+                response_obj = self.contacter.contact_api(endpoint, additional_request_parameters = {'ids': ','.join(missing_track_ids)})
+            downloaded_features = dict(zip(missing_track_ids, response_obj.json()['audio_features']))
+            if self.features_cache is not None:
+                self.features_cache.put_many(downloaded_features)
+
+        with self._lock:
+            self.audio_features.update(cached_features)
+            self.audio_features.update(downloaded_features)
+            self.cache_hits += len(cached_features)
+            self.cache_misses += len(missing_track_ids)
+            self.batches_downloaded += 1
+            logging.info(f'Retrieved audio features batch {self.batches_downloaded} ({len(self.audio_features)} tracks so far)')
+
+
+    def finish(self):
+        '''
+        Submits the last partial batch, waits for every download and returns the audio features keyed by track id in the order the ids were first added. Any failed batch re-raises its error here.
+        '''
+        with self._lock:
+            if self._pending_track_ids:
+                self._submit_pending()
+            futures = list(self._futures)
+
+        #what is left to download once the caller has fed every id
+        with timed('audio_features_wait'):
+            for future in futures:
+                future.result()
+            self.executor.shutdown()
+
+        if self.features_cache is not None:
+            logging.info(f'Audio features cache: {self.cache_hits} hits, {self.cache_misses} misses ({self.features_cache.stats()})')
+
+        return {track_id: self.audio_features[track_id] for track_id in self._track_order}
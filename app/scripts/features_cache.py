@@ -0,0 +1,112 @@
+'''
+features_cache.py
+
+Audio features for a track id never change, so they are cached across users and requests. TrackFeaturesCache keeps the most recently used entries in process memory and falls back to a persistent store (the TrackAudioFeatures MySQL table) shared by every worker.
+'''
+import json, logging, threading
+from collections import OrderedDict
+
+
+#Number of tracks held in the in-process tier before the least recently used are evicted
+DEFAULT_CACHE_ENTRIES = 200000
+
+
+class MySQLTrackFeaturesStore:
+    def __init__(self, connection_context):
+        '''
+        connection_context - a callable returning a context manager that yields a DB-API connection to the radial database, e.g. DBConnectionPool.connection
+        '''
+        self.connection_context = connection_context
+
+    def get_many(self, track_ids):
+        if not track_ids:
+            return {}
+        placeholders = ','.join(['%s'] * len(track_ids))
+        with self.connection_context() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT TrackID, AudioFeatures FROM TrackAudioFeatures WHERE TrackID IN ({placeholders});', tuple(track_ids))
+                return {track_id: json.loads(features) for track_id, features in cursor.fetchall()}
+
+    def put_many(self, audio_features):
+        if not audio_features:
+            return
+        insertable_values = [(track_id, json.dumps(features)) for track_id, features in audio_features.items()]
+        with self.connection_context() as connection:
+            with connection.cursor() as cursor:
+                cursor.executemany('INSERT IGNORE INTO TrackAudioFeatures(TrackID, AudioFeatures) VALUES(%s,%s);', insertable_values)
+            connection.commit()
+
+
+
+class TrackFeaturesCache:
+    def __init__(self, persistent_store = None, max_entries = DEFAULT_CACHE_ENTRIES):
+        '''
+        persistent_store = None - an object with get_many(track_ids) and put_many(audio_features), e.g. MySQLTrackFeaturesStore. Without one only the in-process tier is used
+
+        max_entries = DEFAULT_CACHE_ENTRIES - size of the in-process LRU tier
+        '''
+        self.persistent_store = persistent_store
+        self.max_entries = max_entries
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def _remember(self, audio_features):
+        #caller holds the lock
+        for track_id, features in audio_features.items():
+            self._entries[track_id] = features
+            self._entries.move_to_end(track_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last = False)
+
+
+    def get_many(self, track_ids):
+        '''
+        Returns the cached audio features for whichever of track_ids are known. Lookups in the persistent store are best effort: if it fails, those ids count as misses
+        '''
+        found = {}
+        with self._lock:
+            for track_id in track_ids:
+                if track_id in self._entries:
+                    self._entries.move_to_end(track_id)
+                    found[track_id] = self._entries[track_id]
+            self.memory_hits += len(found)
+
+        remaining_ids = [track_id for track_id in track_ids if track_id not in found]
+        if remaining_ids and self.persistent_store is not None:
+            try:
+                stored = self.persistent_store.get_many(remaining_ids)
+            except Exception as e:
+                logging.info(f'Could not read the audio features store: {e}')
+                stored = {}
+            found.update(stored)
+            with self._lock:
+                self._remember(stored)
+                self.store_hits += len(stored)
+
+        with self._lock:
+            self.misses += len(track_ids) - len(found)
+        return found
+
+
+    def put_many(self, audio_features):
+        '''
+        Caches audio features keyed by track id. Null features (Spotify returns null for some tracks) are not cached so they are asked for again next time
+        '''
+        cacheable = {track_id: features for track_id, features in audio_features.items() if features is not None}
+        with self._lock:
+            self._remember(cacheable)
+
+        if cacheable and self.persistent_store is not None:
+            try:
+                self.persistent_store.put_many(cacheable)
+            except Exception as e:
+                logging.info(f'Could not write to the audio features store: {e}')
+
+
+    def stats(self):
+        with self._lock:
+            return {'memory_hits': self.memory_hits, 'store_hits': self.store_hits, 'misses': self.misses, 'entries': len(self._entries)}
@@ -0,0 +1,96 @@
+'''
+k_sweep.py
+
+This defines KSweep, which fits k-means for a range of cluster counts in parallel worker processes and scores each with the Davies-Bouldin index to pick a good k. The normalized matrix is written once to a memory-mapped file that every worker reads, and the sweep stops early once the scores have settled.
+'''
+import logging, os, tempfile
+import numpy as np, joblib
+from joblib import Parallel, delayed
+from .kmeans_engine import KMeansEngine, KMEANS_SEED
+
+
+#Cluster counts swept by default, as in the original evaluation
+DEFAULT_K_VALUES = range(2, 26)
+
+#Number of worker processes; -1 uses every core
+DEFAULT_SWEEP_JOBS = -1
+
+#Stop once the best Davies-Bouldin score has not improved for this many consecutive k values
+DEFAULT_SWEEP_PATIENCE = 6
+
+#Improvements smaller than this do not count as improving
+DEFAULT_SWEEP_TOLERANCE = 1e-3
+
+
+def fit_and_score(normalized_matrix, clusters, seed):
+    #runs in a worker process; normalized_matrix is the shared memory map
+    from sklearn import metrics
+    engine = KMeansEngine(clusters, seed = seed)
+    labels = engine.fit(normalized_matrix)
+    return clusters, engine.model.inertia_, metrics.davies_bouldin_score(normalized_matrix, labels)
+
+
+
+class KSweep:
+    def __init__(self, k_values = DEFAULT_K_VALUES, n_jobs = DEFAULT_SWEEP_JOBS, patience = DEFAULT_SWEEP_PATIENCE, tolerance = DEFAULT_SWEEP_TOLERANCE, seed = KMEANS_SEED):
+        '''
+        k_values = DEFAULT_K_VALUES - cluster counts to try, in increasing order
+
+        n_jobs = DEFAULT_SWEEP_JOBS - number of worker processes
+
+        patience = DEFAULT_SWEEP_PATIENCE - consecutive k values without improvement before stopping; None sweeps every k
+
+        tolerance = DEFAULT_SWEEP_TOLERANCE - smallest decrease in the Davies-Bouldin score that counts as an improvement
+        '''
+        self.k_values = list(k_values)
+        self.n_jobs = joblib.cpu_count() if n_jobs == -1 else n_jobs
+        self.patience = patience
+        self.tolerance = tolerance
+        self.seed = seed
+        self.inertias = {}
+        self.davies_bouldin_scores = {}
+
+
+    def has_settled(self):
+        if self.patience is None:
+            return False
+        swept = sorted(self.davies_bouldin_scores)
+        best_position = min(range(len(swept)), key = lambda position: self.davies_bouldin_scores[swept[position]])
+        best_score = self.davies_bouldin_scores[swept[best_position]]
+        #k values after the best one that failed to beat it by more than the tolerance
+        later_scores = [self.davies_bouldin_scores[k] for k in swept[best_position + 1:]]
+        return len(later_scores) >= self.patience and all(score > best_score - self.tolerance for score in later_scores)
+
+
+    def run(self, normalized_data):
+        '''
+        Sweeps the k values in waves of n_jobs fits, stopping after a wave once the scores have settled
+
+        Returns a dict of k to its Davies-Bouldin score for every k fitted
+        '''
+        with tempfile.TemporaryDirectory() as temp_dir:
+            #one copy of the matrix on disk, mapped read-only by every worker instead of pickled to each
+            matrix_path = os.path.join(temp_dir, 'normalized_data.mmap')
+            joblib.dump(np.ascontiguousarray(normalized_data, dtype = np.float64), matrix_path)
+            shared_matrix = joblib.load(matrix_path, mmap_mode = 'r')
+
+            with Parallel(n_jobs = self.n_jobs) as parallel:
+                for wave_start in range(0, len(self.k_values), self.n_jobs):
+                    wave = self.k_values[wave_start: wave_start + self.n_jobs]
+                    for clusters, inertia, score in parallel(delayed(fit_and_score)(shared_matrix, clusters, self.seed) for clusters in wave):
+                        self.inertias[clusters] = inertia
+                        self.davies_bouldin_scores[clusters] = score
+                    logging.info(f'Swept k={wave[0]}..{wave[-1]}')
+                    if self.has_settled():
+                        logging.info(f'Davies-Bouldin scores settled after k={wave[-1]}; stopping the sweep')
+                        break
+
+        return dict(self.davies_bouldin_scores)
+
+
+    def best_k(self):
+        '''
+        Returns the swept k with the lowest (best) Davies-Bouldin score
+        '''
+        assert self.davies_bouldin_scores
+        return min(self.davies_bouldin_scores, key = self.davies_bouldin_scores.get)
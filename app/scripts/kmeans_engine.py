@@ -0,0 +1,69 @@
+'''
+kmeans_engine.py
+
+This defines the KMeansEngine used to cluster a user's tracks with k-means. It picks full-batch Lloyd iterations for ordinary libraries and mini-batch updates for large ones, can warm-start from the centroids of a previous run, and always uses a fixed seed so the same data gives the same clusters.
+'''
+import logging, pandas as pd
+
+
+#Seed for every k-means fit so results are reproducible
+KMEANS_SEED = 420
+
+#Above this many tracks the engine switches to mini-batch updates
+MINI_BATCH_THRESHOLD = 10000
+
+#Number of k-means++ initializations tried on a cold start
+COLD_START_INITS = 10
+
+
+class KMeansEngine:
+    def __init__(self, clusters, seed = KMEANS_SEED, mini_batch_threshold = MINI_BATCH_THRESHOLD, initial_centroids = None):
+        '''
+        clusters - number of clusters
+
+        seed = KMEANS_SEED - random_state for the fit
+
+        mini_batch_threshold = MINI_BATCH_THRESHOLD - libraries larger than this are fit with MiniBatchKMeans
+
+        initial_centroids = None - centroids (clusters x features array) from a previous run to warm-start from. A warm start runs a single initialization instead of COLD_START_INITS
+        '''
+        self.clusters = clusters
+        self.seed = seed
+        self.mini_batch_threshold = mini_batch_threshold
+        self.initial_centroids = initial_centroids
+        self.model = None
+
+
+    def build_model(self, track_count, feature_count):
+        warm_start = self.initial_centroids is not None and self.initial_centroids.shape == (self.clusters, feature_count)
+        #imported on first fit rather than with the module, which every web worker loads
+        from sklearn.cluster import KMeans, MiniBatchKMeans
+        init_params = dict(init = self.initial_centroids, n_init = 1) if warm_start else dict(init = 'k-means++', n_init = COLD_START_INITS)
+
+        if track_count > self.mini_batch_threshold:
+            logging.info(f'Fitting mini-batch k-means on {track_count} tracks (warm start: {warm_start})')
+            return MiniBatchKMeans(n_clusters = self.clusters, batch_size = 4096, random_state = self.seed, **init_params)
+        logging.info(f'Fitting k-means on {track_count} tracks (warm start: {warm_start})')
+        return KMeans(n_clusters = self.clusters, random_state = self.seed, **init_params)
+
+
+    def fit(self, normalized_data):
+        '''
+        Fits the engine and returns the cluster label of every row of normalized_data
+        '''
+        self.model = self.build_model(*normalized_data.shape)
+        self.model.fit(normalized_data)
+        return self.model.labels_
+
+
+    @property
+    def cluster_centers_(self):
+        assert self.model is not None
+        return self.model.cluster_centers_
+
+
+    def centroids(self, feature_columns):
+        '''
+        Returns the fitted centroids as a DataFrame indexed by label, in the shape SpotifyUser.collect_centroids produces
+        '''
+        return pd.DataFrame(self.cluster_centers_, columns = feature_columns)
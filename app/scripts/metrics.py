@@ -0,0 +1,145 @@
+'''
+metrics.py
+
+Timing spans and request counters for the hot paths of collecting, clustering and storing a library. Every span is observed in the radial_stage_seconds histogram and every Spotify response is counted in radial_spotify_requests_total by endpoint and status code, both exposed in the Prometheus text format by render_metrics().
+
+Under uWSGI every worker and mule is its own process, so when PROMETHEUS_MULTIPROC_DIR is set each process writes its samples to files in that directory and render_metrics() adds up the files of every process. The directory must be emptied before the server starts (see entrypoint.sh).
+
+A job can also collect its own spans in a StageTimings, which sums them per stage so the job can store where its time went.
+'''
+import os, threading, time, contextvars
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+#Directory shared by every process of the server for multi-process metrics; unset, each process only reports its own
+METRICS_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+if os.environ.get(METRICS_DIR_ENV):
+    os.makedirs(os.environ[METRICS_DIR_ENV], exist_ok = True)
+
+#imported after the directory exists, since prometheus_client opens its files there as soon as a metric is created
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+
+#Histogram buckets of the stage timings, in seconds: from a single request up to a whole job
+STAGE_SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
+
+#Path segments of the Spotify API that are followed by an id; the id is replaced with {id} so every playlist or user shares one endpoint label
+SPOTIFY_ID_COLLECTIONS = ('users', 'playlists', 'tracks', 'albums', 'artists', 'audio-features')
+
+
+stage_seconds = Histogram('radial_stage_seconds', 'Seconds spent in each stage of collecting, clustering and storing a library', ['stage'], buckets = STAGE_SECONDS_BUCKETS)
+
+spotify_requests = Counter('radial_spotify_requests', 'Spotify API responses by method, endpoint and status code', ['method', 'endpoint', 'status'])
+
+#StageTimings of the job running in this context, if any
+_current_timings = contextvars.ContextVar('radial_stage_timings', default = None)
+
+
+
+class StageTimings:
+    def __init__(self):
+        '''
+        Sums the spans recorded while it is active (see collecting_timings) per stage: how many there were, their total and their longest duration. Spans that ran concurrently on pool threads each count in full, so a stage's total can exceed the wall time it covered
+        '''
+        self.started_at = time.perf_counter()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, stage, seconds):
+        with self._lock:
+            count, total_seconds, max_seconds = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (count + 1, total_seconds + seconds, max(max_seconds, seconds))
+
+
+    def summary(self):
+        '''
+        Returns a JSON-serializable dict with the seconds elapsed since the timings were created and, per stage, the count, total and longest span
+        '''
+        with self._lock:
+            stages = {stage: {'count': count, 'seconds': round(total_seconds, 3), 'max_seconds': round(max_seconds, 3)} for stage, (count, total_seconds, max_seconds) in sorted(self._stages.items())}
+        return {'elapsed_seconds': round(time.perf_counter() - self.started_at, 3), 'stages': stages}
+
+
+
+@contextmanager
+def collecting_timings(timings):
+    '''
+    with collecting_timings(timings): every span recorded in the block, and on pool threads it hands work to through propagate_timings, is also added to timings
+    '''
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = None
+
+
+
+@contextmanager
+def timed(stage):
+    '''
+    with timed(stage) as span: times the block, observes it in radial_stage_seconds and adds it to the active StageTimings. span.seconds holds the duration once the block is over, whether or not it raised
+    '''
+    span = Span(stage)
+    started_at = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span.seconds = time.perf_counter() - started_at
+        stage_seconds.labels(stage).observe(span.seconds)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.record(stage, span.seconds)
+
+
+
+def propagate_timings(function):
+    '''
+    Wraps function, about to be handed to a pool thread, so the spans it records count towards the StageTimings active where it was submitted
+    '''
+    timings = _current_timings.get()
+    if timings is None:
+        return function
+
+    def run_with_timings(*args, **kwargs):
+        with collecting_timings(timings):
+            return function(*args, **kwargs)
+    return run_with_timings
+
+
+
+def endpoint_label(url):
+    '''
+    Returns the path of a Spotify API url with its ids replaced by {id}, e.g. /v1/playlists/{id}/tracks
+    '''
+    segments = urlparse(url).path.strip('/').split('/')
+    return '/' + '/'.join('{id}' if index > 0 and segments[index - 1] in SPOTIFY_ID_COLLECTIONS else segment for index, segment in enumerate(segments))
+
+
+
+def count_spotify_request(method, url, status):
+    '''
+    status - the response's status code, or a short reason (e.g. 'connection_error') when there was no response
+    '''
+    spotify_requests.labels(method.upper(), endpoint_label(url), str(status)).inc()
+
+
+
+def render_metrics():
+    '''
+    Returns (body, content type) of every metric in the Prometheus text format, added up across processes when PROMETHEUS_MULTIPROC_DIR is set
+    '''
+    if os.environ.get(METRICS_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
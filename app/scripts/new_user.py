@@ -6,17 +6,33 @@ Spotify User
 This script hopefully aims to control the User class that can hold playlists, etc.
 
 '''
-import json, logging, pandas as pd, numpy as np, matplotlib.pyplot as plt
-from math import pi
-from sklearn import preprocessing, metrics
-from sklearn.cluster import KMeans
-from scipy.cluster.hierarchy import dendrogram, linkage, cut_tree
-from .playlist import Playlist
+import json, logging, threading, pandas as pd, numpy as np
+from math import pi, ceil
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, wait
+from .playlist import Playlist, TRACKS_PER_ADD
 from .track import Track
+from .api_contacter import SPOTIFY_API_URL
+from .audio_features import AudioFeaturesDownloader, DEFAULT_AUDIO_FEATURES_WORKERS
+from .k_sweep import KSweep, DEFAULT_SWEEP_PATIENCE
+from .metrics import timed, propagate_timings
+
+
+#Default cap on the number of simultaneous Spotify requests made on behalf of a single user
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+
+#Largest page Spotify allows when listing a user's playlists
+PLAYLIST_LISTING_LIMIT = 50
+
+#Number of micro-clusters the large-library agglomerative mode condenses tracks into before building the Ward linkage
+DEFAULT_MICRO_CLUSTERS = 2000
+
+#Audio features tracks are clustered on, in column order
+CLUSTERING_FEATURES = ('danceability', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo', 'duration_ms')
 
 
 class SpotifyUser:
-    def __init__(self, spotify_id, playlists = {}, contacter = None, optional_display_id = ''):
+    def __init__(self, spotify_id, playlists = {}, contacter = None, optional_display_id = '', max_concurrent_requests = DEFAULT_MAX_CONCURRENT_REQUESTS, audio_features_workers = DEFAULT_AUDIO_FEATURES_WORKERS, features_cache = None):
         '''
         The SpotifyUser instance represents a particular Spotify user denoted by a Spotify_id and allows for API communication, storage of playlists, and clustering of tracks.
 
@@ -29,12 +45,22 @@ class SpotifyUser:
         playlists = {} - a dictionary of playlist ids to Playlist instances
 
         contacter = None - a Contacter if desired. A contacter is used to make API queries and is necessary to do so. However, all database information can be made without a contacter
+
+        max_concurrent_requests = DEFAULT_MAX_CONCURRENT_REQUESTS - the most requests that will be in flight at once for this user when downloading playlists
+
+        audio_features_workers = DEFAULT_AUDIO_FEATURES_WORKERS - the number of audio-features batches downloaded at once
+
+        features_cache = None - a TrackFeaturesCache shared across users; audio features it already holds are not downloaded again
         '''
         self.name = None
         self.user_id = spotify_id
         self.playlists = playlists
         self.contacter = contacter
         self.optional_display_id = optional_display_id
+        self.max_concurrent_requests = max_concurrent_requests
+        self.audio_features_workers = audio_features_workers
+        self.features_cache = features_cache
+        self.listed_snapshot_ids = {}
         np.random.seed(420)
  
     
@@ -45,13 +71,16 @@ class SpotifyUser:
 
         This function calls https://api.spotify.com/v1/users/{self.user_id}/playlists to retrieve the playlist_id of every user playlist. I believe this only includes public playlists. If the user has over 1500 playlists, a Permission error is raised (to avoid drastic amounts of queries, but likely needs to be changed). If there is no contacter, a ValueError is raised. If over 30 queries were made. but fewer were expected, a ValueError is raised.
 
+        The snapshot_id the listing reports for each playlist is recorded in self.listed_snapshot_ids so unchanged playlists can be skipped on an incremental refresh.
+
         This returns a set of tuples, where each tuple is of the form (playlist id, platlist name)
         '''
         if self.contacter is None:
             raise ValueError('Add a contacter!')
         logging.info('Working on hitting the users playlists endpoint')
-        link = f'https://api.spotify.com/v1/users/{self.user_id}/playlists'
-        api_response = self.contacter.contact_api(link).json()
+        self.listed_snapshot_ids = {}
+        link = f'{SPOTIFY_API_URL}/users/{self.user_id}/playlists'
+        api_response = self.contacter.contact_api(link, additional_request_parameters = {'limit': PLAYLIST_LISTING_LIMIT}).json()
         final_ids = []
         playlists = api_response['items']
         playlists_to_extend = []
@@ -63,6 +92,7 @@ class SpotifyUser:
             if playlist['owner']['id'] == self.user_id:
                 logging.info(playlist['owner'])
                 playlists_to_extend.append((playlist['id'],playlist['name']))
+                self.listed_snapshot_ids[playlist['id']] = playlist.get('snapshot_id')
             final_ids.extend(playlists_to_extend)
         total_queries_made = 1
         logging.info(f"YOU WILL NEED TO GATHER {len(final_ids)} playlists")
@@ -75,6 +105,7 @@ class SpotifyUser:
             for playlist in playlists:                
                 if playlist['owner']['id'] == self.user_id:
                     playlists_to_extend.append((playlist['id'],playlist['name']))
+                    self.listed_snapshot_ids[playlist['id']] = playlist.get('snapshot_id')
                 final_ids.extend(playlists_to_extend)
             total_queries_made +=1
         
@@ -87,12 +118,22 @@ class SpotifyUser:
 
 
     
-    def get_all_playlist_information(self, custom_playlist_ids = None, save_file_flag = True):
+    def get_all_playlist_information(self, custom_playlist_ids = None, save_file_flag = True, audio_features_downloader = None, previous_snapshots = None, listed_playlist_ids = None):
         '''
         get_all_playlist_information(self)
 
         Calls self.get_all_user_playlist_ids() and fills out self.playlists with the Playlist() instances
 
+        Playlists are downloaded concurrently, with at most self.max_concurrent_requests requests in flight. The first page of every playlist is fetched first; since that gives each playlist's total, every remaining page is then requested by offset in one batch. Playlists are kept in sorted id order and their items in playlist order, so the result does not depend on which request finishes first.
+
+        Each page is reduced to Track objects as it arrives and its raw JSON is dropped, unless save_file_flag asks for the raw items to be written out.
+
+        If an AudioFeaturesDownloader is passed, every page is handed to it as soon as it is read so audio features download while the remaining pages are still being fetched.
+
+        previous_snapshots (as returned by self.playlist_snapshots() on an earlier run) turns on incremental refresh: a playlist whose snapshot_id in the listing matches the stored one is rebuilt from the stored track ids instead of being paged again.
+
+        listed_playlist_ids, the return value of a get_all_user_playlist_ids() call just made, saves listing the playlists again.
+
         Raises an error is self.contacter is None.
 
         This returns None but updates self.playlists in place
@@ -101,19 +142,89 @@ class SpotifyUser:
 
         if self.contacter is None:
             raise ValueError('Add a contacter')
-        playlist_ids = self.get_all_user_playlist_ids() if custom_playlist_ids is None else custom_playlist_ids
+        if custom_playlist_ids is not None:
+            playlist_ids = custom_playlist_ids
+        elif listed_playlist_ids is not None:
+            playlist_ids = listed_playlist_ids
+        else:
+            with timed('playlist_listing'):
+                playlist_ids = self.get_all_user_playlist_ids()
 
         logging.info(f'Getting ready to work with {len(playlist_ids)} playlists')
 
         self.playlists = {} # this may wipe existing user data which would be good???
 
-        for playlist_info in playlist_ids:
+        previous_snapshots = previous_snapshots if previous_snapshots is not None else {}
+        playlists = []
+
+        for playlist_info in sorted(playlist_ids):
             #make a playlist instance and add it to the user's playlist dict
             playlist_id,playlist_name = playlist_info
-            self.playlists[playlist_id] = Playlist(playlist_id,playlist_name)
-            self.playlists[playlist_id].retrieve_playlist_data(self.contacter, save_file = save_file_flag)
+            self.playlists[playlist_id] = Playlist(playlist_id,playlist_name, keep_raw_items = save_file_flag)
+
+            previous_snapshot = previous_snapshots.get(playlist_id)
+            listed_snapshot_id = self.listed_snapshot_ids.get(playlist_id) if custom_playlist_ids is None else None
+            if previous_snapshot is not None and listed_snapshot_id is not None and previous_snapshot['snapshot_id'] == listed_snapshot_id:
+                self.playlists[playlist_id].restore_tracks(previous_snapshot['snapshot_id'], previous_snapshot['track_ids'])
+                if audio_features_downloader is not None:
+                    audio_features_downloader.add_track_ids(previous_snapshot['track_ids'])
+            else:
+                playlists.append(self.playlists[playlist_id])
 
+        logging.info(f'{len(self.playlists) - len(playlists)} playlists are unchanged since the last run; paging through {len(playlists)}')
 
+        with ThreadPoolExecutor(max_workers = self.max_concurrent_requests) as executor:
+            first_pages = executor.map(propagate_timings(lambda playlist: playlist.retrieve_first_page(self.contacter)), playlists)
+            for first_page_items in first_pages:
+                if audio_features_downloader is not None:
+                    audio_features_downloader.add_playlist_items(first_page_items)
+
+            page_requests = [(playlist, offset) for playlist in playlists for offset in playlist.remaining_page_offsets()]
+            logging.info(f'Fetching {len(page_requests)} remaining pages across {len(playlists)} playlists')
+
+            #executor.map yields in submission order, so pages are appended in offset order
+            page_results = executor.map(propagate_timings(lambda page_request: page_request[0].retrieve_page_items(self.contacter, page_request[1])), page_requests)
+            for (playlist, _), page_items in zip(page_requests, page_results):
+                playlist.ingest_items(page_items)
+                if audio_features_downloader is not None:
+                    audio_features_downloader.add_playlist_items(page_items)
+
+        if save_file_flag:
+            for playlist in playlists:
+                playlist.write_playlist_items()
+
+
+
+
+
+    def playlist_snapshots(self):
+        '''
+        playlist_snapshots(self)
+
+        Returns a JSON-serializable dict of playlist id to its snapshot_id, name and track ids. Storing it and passing it back to collect_data as previous_snapshots lets the next run skip every playlist that has not changed.
+        '''
+        return {playlist_id: {'snapshot_id': playlist.snapshot_id, 'name': playlist.name, 'track_ids': [track.id for track in playlist.tracks]} for playlist_id, playlist in self.playlists.items()}
+
+
+
+    def restore_unchanged_playlists(self, listed_playlist_ids, previous_snapshots):
+        '''
+        restore_unchanged_playlists(self, listed_playlist_ids, previous_snapshots)
+
+        If the listing (the return value of get_all_user_playlist_ids()) holds exactly the playlists in previous_snapshots, each with the snapshot_id stored there, rebuilds self.playlists from the stored track ids without paging any playlist and returns True. Otherwise leaves self.playlists alone and returns False
+        '''
+        if {playlist_id for playlist_id, _ in listed_playlist_ids} != set(previous_snapshots):
+            return False
+        for playlist_id, previous_snapshot in previous_snapshots.items():
+            listed_snapshot_id = self.listed_snapshot_ids.get(playlist_id)
+            if listed_snapshot_id is None or listed_snapshot_id != previous_snapshot['snapshot_id']:
+                return False
+
+        self.playlists = {}
+        for playlist_id, playlist_name in sorted(listed_playlist_ids):
+            self.playlists[playlist_id] = Playlist(playlist_id, playlist_name, keep_raw_items = False)
+            self.playlists[playlist_id].restore_tracks(previous_snapshots[playlist_id]['snapshot_id'], previous_snapshots[playlist_id]['track_ids'])
+        return True
 
 
 
@@ -134,32 +245,22 @@ class SpotifyUser:
     
 
 
-    def gather_audio_features_data_from_specified_tracks(self,track_ids):
+    def gather_audio_features_data_from_specified_tracks(self,track_ids, audio_features_downloader = None):
+        '''
+        gather_audio_features_data_from_specified_tracks(self, track_ids, audio_features_downloader = None)
+
+        Downloads the audio features of every track id in batches of 100, self.audio_features_workers batches at a time. Ids already held by self.features_cache are not requested. If a downloader that has already been fed ids is passed, only the ids it has not seen are requested.
+
+        Returns a dict of track id to audio features
+        '''
         assert len(track_ids) > 0
 
-        final_audio_features_data = {}
-
-        track_ids = tuple(track_ids)
-
-
-        #now determine the number of bins
-        bin_num = len(track_ids) // 100 + bool(len(track_ids) % 100)
-        custom_bins = [i * 100 for i in range(bin_num)]
-        custom_bins.append(len(track_ids))
-
-        for ind in range(len(custom_bins) - 1):
-            #download i - i+1
-            logging.info(f'On bin {ind + 1} out of {len(custom_bins)-1}')
-            relevant_track_ids = track_ids[custom_bins[ind]: custom_bins[ind+1]]
-            track_ids_to_download = ','.join(relevant_track_ids)
-            additional_q_params = {'ids': track_ids_to_download} 
-            endpoint = 'https://api.spotify.com/v1/audio-features'
-            response_obj = self.contacter.contact_api(endpoint, additional_request_parameters=additional_q_params)
-            logging.info('Retrieved data')
-            features = response_obj.json()['audio_features']
-            sub_feature_dict = dict(zip(relevant_track_ids,features))
-            final_audio_features_data.update(sub_feature_dict)
-        return final_audio_features_data
+        if audio_features_downloader is None:
+            audio_features_downloader = AudioFeaturesDownloader(self.contacter, max_workers = self.audio_features_workers, features_cache = self.features_cache)
+
+        with audio_features_downloader:
+            audio_features_downloader.add_track_ids(track_ids)
+            return audio_features_downloader.finish()
         
 
 
@@ -177,21 +278,16 @@ class SpotifyUser:
 
     
 
-    def collect_data(self, custom_playlist_ids = None, save_file_flag = False):
+    def collect_data(self, custom_playlist_ids = None, save_file_flag = False, previous_snapshots = None, listed_playlist_ids = None):
         logging.info('Gathering all playlist info')
-        self.get_all_playlist_information(custom_playlist_ids=custom_playlist_ids, save_file_flag=save_file_flag)
-        try:
-            for p_id,playlist in self.playlists.items():
-                logging.info(f'converting tracks in playlist {p_id}')
-                playlist.convert_raw_track_items()
-            logging.info('Converted all raw track items')
-        except:
-            logging.info('Theres an issue with converting the raw track items')
-            logging.info(f"playlists: {self.playlists.keys()}")
-            raise ValueError('Theres an issue with converting the raw track items')
-        
-        specified_tracks = self.aggregate_track_ids_across_playlists()
-        aggregated_audio_features_data = self.gather_audio_features_data_from_specified_tracks(specified_tracks)
+        #audio features start downloading while the playlists are still being paged
+        audio_features_downloader = AudioFeaturesDownloader(self.contacter, max_workers = self.audio_features_workers, features_cache = self.features_cache)
+        with audio_features_downloader:
+            #tracks are built while the pages stream in, so there is nothing left to convert afterwards
+            self.get_all_playlist_information(custom_playlist_ids=custom_playlist_ids, save_file_flag=save_file_flag, audio_features_downloader=audio_features_downloader, previous_snapshots=previous_snapshots, listed_playlist_ids=listed_playlist_ids)
+            
+            specified_tracks = self.aggregate_track_ids_across_playlists()
+            aggregated_audio_features_data = self.gather_audio_features_data_from_specified_tracks(specified_tracks, audio_features_downloader=audio_features_downloader)
         return aggregated_audio_features_data
 
 
@@ -217,38 +313,78 @@ class SpotifyUser:
     
 
     def prepare_data_for_clustering(self,aggregated_audio_features_data, alternative_features=None):
-        aggregated_audio_features_data_copy = aggregated_audio_features_data.copy()
-        
-        if alternative_features is None:
-            features = [
-            "danceability",
-            "energy",
-            "loudness",
-            "speechiness",
-            "acousticness",
-            "instrumentalness",
-            "liveness",
-            "valence",
-            "tempo",
-            "duration_ms"]
-        else:
-            features = alternative_features
-        
-        prepped_features = {}
+        '''
+        prepare_data_for_clustering(self, aggregated_audio_features_data, alternative_features = None)
 
-        for track_id, track_features in aggregated_audio_features_data_copy.items():
+        Returns a DataFrame of the features (CLUSTERING_FEATURES unless alternative_features is passed) indexed by track id, built with build_feature_matrix. Tracks without usable features are left out
+        '''
+        features = CLUSTERING_FEATURES if alternative_features is None else alternative_features
+        track_ids, feature_matrix = SpotifyUser.build_feature_matrix(aggregated_audio_features_data, features)
+        return SpotifyUser.feature_frame(track_ids, feature_matrix, features)
 
 
-            prepped_features[track_id] = {key:val for key,val in track_features.items() if key in features}
-        
-        return pd.DataFrame(prepped_features).T
+    @staticmethod
+    def build_feature_matrix(aggregated_audio_features_data, features = CLUSTERING_FEATURES, dtype = np.float64):
+        '''
+        build_feature_matrix(aggregated_audio_features_data, features = CLUSTERING_FEATURES, dtype = np.float64)
+
+        Fills a preallocated matrix with one row per track and one column per feature, straight from the audio features dicts. Spotify answers null for tracks it has no audio features for, and a feature can be null or missing; such tracks are left out rather than clustered on made-up values. Raises an AssertionError if no track is left
+
+        Returns a tuple of (track ids, matrix), the track ids in row order
+        '''
+        get_features = itemgetter(*features)
+        feature_matrix = np.empty((len(aggregated_audio_features_data), len(features)), dtype = dtype)
+        track_ids = []
+        for track_id, track_features in aggregated_audio_features_data.items():
+            if track_features is None:
+                continue
+            try:
+                feature_matrix[len(track_ids)] = get_features(track_features)
+            except (KeyError, TypeError, ValueError):
+                #a missing or non-numeric feature
+                continue
+            track_ids.append(track_id)
+        feature_matrix = feature_matrix[:len(track_ids)]
+
+        #numpy stores a null feature as NaN
+        complete_rows = np.isfinite(feature_matrix).all(axis = 1)
+        if not complete_rows.all():
+            feature_matrix = feature_matrix[complete_rows]
+            track_ids = [track_id for track_id, complete in zip(track_ids, complete_rows) if complete]
+
+        skipped_tracks = len(aggregated_audio_features_data) - len(track_ids)
+        if skipped_tracks:
+            logging.info(f'Left out {skipped_tracks} tracks without complete audio features')
+        assert track_ids, 'None of the tracks have audio features'
+        return track_ids, feature_matrix
+
+
+    @staticmethod
+    def normalize_feature_matrix(feature_matrix):
+        '''
+        normalize_feature_matrix(feature_matrix)
+
+        Min-max scales every column of feature_matrix to [0, 1] in place, exactly as sklearn's MinMaxScaler would; a constant column becomes 0. Returns feature_matrix
+        '''
+        column_min = feature_matrix.min(axis = 0)
+        column_range = feature_matrix.max(axis = 0) - column_min
+        column_range[column_range == 0] = 1
+        scale = 1 / column_range
+        feature_matrix *= scale
+        feature_matrix -= column_min * scale
+        return feature_matrix
+
+
+    @staticmethod
+    def feature_frame(track_ids, feature_matrix, features = CLUSTERING_FEATURES):
+        #wraps the matrix without copying it, which is the form the clustering functions take
+        return pd.DataFrame(feature_matrix, index = pd.Index(track_ids), columns = list(features), copy = False)
+
 
     @staticmethod
     def normalize_prepped_data(prepped_data):
-        scaler = preprocessing.MinMaxScaler()
-        normalized_data = scaler.fit_transform(prepped_data)
-        normalized_data_df = pd.DataFrame(normalized_data, columns=prepped_data.columns, index=prepped_data.index)
-        return normalized_data_df
+        normalized_data = prepped_data.to_numpy(dtype = np.float64, copy = True)
+        return SpotifyUser.feature_frame(prepped_data.index, SpotifyUser.normalize_feature_matrix(normalized_data), prepped_data.columns)
 
 
     @staticmethod
@@ -258,27 +394,47 @@ class SpotifyUser:
 
 
     @staticmethod
-    def evaluate_kmeans_clusterings(normalized_data):
-        inertias = []
-        davies_bouldin_scores = []
-
-        for k in range(2, 26):
-            model = KMeans(n_clusters=k)
-            model.fit(normalized_data) #fit/train the model
-            labels = model.labels_
-            davies_bouldin_scores.append(metrics.davies_bouldin_score(normalized_data, labels))
-            inertias.append(model.inertia_)
-    
-        return inertias, davies_bouldin_scores
+    def evaluate_kmeans_clusterings(normalized_data, early_stopping = False):
+        '''
+        evaluate_kmeans_clusterings(normalized_data, early_stopping = False)
+
+        Fits k-means for k = 2..25 across worker processes (see KSweep) and returns the inertias and Davies-Bouldin scores in order of k. With early_stopping the sweep ends once the scores have settled, so the lists may be shorter
+        '''
+        sweep = KSweep(patience = DEFAULT_SWEEP_PATIENCE if early_stopping else None)
+        sweep.run(normalized_data)
+        swept_k_values = sorted(sweep.davies_bouldin_scores)
+        return [sweep.inertias[k] for k in swept_k_values], [sweep.davies_bouldin_scores[k] for k in swept_k_values]
 
 
     @staticmethod
     def produce_linkage_matrix(normalized_data):
+        from scipy.cluster.hierarchy import linkage
         return linkage(normalized_data,method='ward')
+
+
+    @staticmethod
+    def produce_micro_cluster_linkage(normalized_data, micro_clusters = DEFAULT_MICRO_CLUSTERS):
+        '''
+        produce_micro_cluster_linkage(normalized_data, micro_clusters = DEFAULT_MICRO_CLUSTERS)
+
+        Bounded-memory stand-in for produce_linkage_matrix on very large libraries. Ward linkage needs memory quadratic in the number of tracks, so mini-batch k-means first condenses the tracks into at most micro_clusters centroids and the linkage is built over those centroids only.
+
+        Returns a tuple of (linkage matrix over the micro-clusters, micro-cluster index of every track)
+        '''
+        from sklearn.cluster import MiniBatchKMeans
+        from scipy.cluster.hierarchy import linkage
+        model = MiniBatchKMeans(n_clusters = min(micro_clusters, len(normalized_data)), batch_size = 4096, n_init = 3, random_state = 420)
+        micro_labels = model.fit_predict(normalized_data)
+
+        #drop centroids no track ended up in, otherwise a cut could produce empty clusters
+        used_micro_clusters = np.unique(micro_labels)
+        micro_labels = np.searchsorted(used_micro_clusters, micro_labels)
+        return linkage(model.cluster_centers_[used_micro_clusters], method = 'ward'), micro_labels
     
 
 
     def plot_inertias_db_scores(self,inertias, db_scores):
+        import matplotlib.pyplot as plt
         fig, axes = plt.subplots(ncols=2)
         left_ax,right_ax = axes
 
@@ -293,6 +449,8 @@ class SpotifyUser:
     
 
     def plot_dendrogram(self,linked_data):
+        import matplotlib.pyplot as plt
+        from scipy.cluster.hierarchy import dendrogram
         fig,ax = plt.subplots()
         proper_id = self.user_id if not self.optional_display_id else self.optional_display_id 
         dn = dendrogram(linked_data, ax = ax, no_labels = True, above_threshold_color='black', color_threshold=0)
@@ -300,22 +458,40 @@ class SpotifyUser:
         fig.savefig(f'../results/{proper_id}_dendrogram.png', bbox_inches='tight', dpi = 500)
 
     @staticmethod
-    def organize_by_centroid_distance(labelled_cluster_data):
-        cluster_data_centroids = SpotifyUser.collect_centroids(labelled_cluster_data)
-        euclidean_distance_formula = lambda ser1, ser2: ((ser2 - ser1)**2).sum()
-        centroid_distances = []
-        for _, track_data in labelled_cluster_data.iterrows():
-            cluster_label = track_data['Label']
-            cluster_centroid = cluster_data_centroids.loc[cluster_label]
-            relevant_data = track_data.drop(['Label'])
-            calculated_distance = euclidean_distance_formula(relevant_data,cluster_centroid)
-            centroid_distances.append(calculated_distance)
-        labelled_cluster_data.loc[:,'Distance to Centroid'] = centroid_distances
-        return labelled_cluster_data.sort_values(by='Distance to Centroid')
+    def feature_columns(labelled_cluster_data):
+        return [column for column in labelled_cluster_data.columns if column not in ('Label', 'Distance to Centroid')]
+
+
+    @staticmethod
+    def centroid_distances(labelled_cluster_data, centroids = None):
+        '''
+        centroid_distances(labelled_cluster_data, centroids = None)
+
+        Computes every track's squared euclidean distance to its cluster's centroid in one NumPy pass. centroids (a DataFrame indexed by label, e.g. built from KMeans.cluster_centers_) is computed with collect_centroids if not passed
+
+        Returns a NumPy array aligned with the rows of labelled_cluster_data
+        '''
+        feature_columns = SpotifyUser.feature_columns(labelled_cluster_data)
+        if centroids is None:
+            centroids = SpotifyUser.collect_centroids(labelled_cluster_data[feature_columns + ['Label']])
+        track_features = labelled_cluster_data[feature_columns].to_numpy(dtype = float)
+        centroid_rows = centroids.index.get_indexer(labelled_cluster_data['Label'].to_numpy())
+        assigned_centroids = centroids[feature_columns].to_numpy(dtype = float)[centroid_rows]
+        return ((track_features - assigned_centroids) ** 2).sum(axis = 1)
 
 
     @staticmethod
-    def collect_centroids(labelled_cluster_data):
+    def organize_by_centroid_distance(labelled_cluster_data, centroids = None):
+        organized_data = labelled_cluster_data.copy()
+        organized_data['Distance to Centroid'] = SpotifyUser.centroid_distances(labelled_cluster_data, centroids)
+        return organized_data.sort_values(by='Distance to Centroid', kind = 'stable')
+
+
+    @staticmethod
+    def collect_centroids(labelled_cluster_data, clustering_engine = None):
+        #a fitted KMeansEngine already knows its centroids, so there is no need to group the data again
+        if clustering_engine is not None:
+            return clustering_engine.centroids(SpotifyUser.feature_columns(labelled_cluster_data))
         return labelled_cluster_data.groupby('Label').mean()
 
 
@@ -364,6 +540,7 @@ class SpotifyUser:
         rows = cluster_num // 2 + bool(cluster_num % 2)
         logging.info(f'Found number of rows: {rows}')
         logging.info('Attempting to create subplots')
+        import matplotlib.pyplot as plt
         fig, axes = plt.subplots(rows,2, subplot_kw={'projection': 'polar'}, dpi = 1000)
 
         #I want each axes to plot the proper plot. There is no natural order. Cycle through each axes and plot only one row worth of data at a time
@@ -401,12 +578,29 @@ class SpotifyUser:
         #kwargs?
 
 
-    def generate_uploadable_playlists(self, labelled_data):
-        uploadable_playlists = {}
+    def generate_uploadable_playlists(self, labelled_data, centroids = None):
+        '''
+        generate_uploadable_playlists(self, labelled_data, centroids = None)
+
+        Orders the tracks of every cluster by their distance to the cluster centroid. All distances are computed at once and a single sort by (label, distance) groups and ranks every cluster together
+
+        Returns a dict of label to the list of track ids, closest to the centroid first
+        '''
+        if labelled_data.empty:
+            return {}
 
-        for label in set(labelled_data['Label']):
-            cluster_data = SpotifyUser.organize_by_centroid_distance(labelled_data[labelled_data['Label'] == label])
-            uploadable_playlists[label] = list(cluster_data.index)
+        distances = SpotifyUser.centroid_distances(labelled_data, centroids)
+        labels = labelled_data['Label'].to_numpy()
+        track_ids = labelled_data.index.to_numpy()
+
+        #lexsort is stable and sorts by the last key first: label, then distance
+        ranking = np.lexsort((distances, labels))
+        ranked_labels = labels[ranking]
+        cluster_starts = np.flatnonzero(np.diff(ranked_labels)) + 1
+
+        uploadable_playlists = {}
+        for cluster_ranking in np.split(ranking, cluster_starts):
+            uploadable_playlists[int(labels[cluster_ranking[0]])] = list(track_ids[cluster_ranking])
 
         return uploadable_playlists
 
@@ -415,13 +609,18 @@ class SpotifyUser:
 
 
 
-    def deploy_single_cluster_playlist(self,tracks_to_deploy,cluster_id,cluster_algo):
+    def cluster_playlist_params(self, cluster_id, cluster_algo):
         if self.name is not None:
                 id_to_add = self.name
         else:
             id_to_add = self.user_id if not self.optional_display_id else self.optional_display_id
         new_name = f"{id_to_add}'s {cluster_algo} Cluster {cluster_id}"
-        playlist_params = {'name':new_name, 'description': 'These are tracks organized by their distance to the cluster centroid. The higher the song appears on this playlist, the more typical it is for this cluster. What can you find? Created via Radial Web App by Ryan Papetti'}
+        return {'name':new_name, 'description': 'These are tracks organized by their distance to the cluster centroid. The higher the song appears on this playlist, the more typical it is for this cluster. What can you find? Created via Radial Web App by Ryan Papetti'}
+
+
+
+    def deploy_single_cluster_playlist(self,tracks_to_deploy,cluster_id,cluster_algo):
+        playlist_params = self.cluster_playlist_params(cluster_id, cluster_algo)
         associated_tracks = tracks_to_deploy
         associated_tracks_objs = [Track(track_id) for track_id in associated_tracks]
 
@@ -436,21 +635,143 @@ class SpotifyUser:
 
 
 
+    def update_cluster_playlist(self, playlist_id, published_track_ids, track_ids):
+        '''
+        update_cluster_playlist(self, playlist_id, published_track_ids, track_ids)
 
-    def add_cluster_playlists(self, cluster_playlists, cluster_algo = 'KMeans'):
+        published_track_ids - the tracks the playlist was last published with, or None if they are not known
+
+        track_ids - the cluster's tracks now, closest to the centroid first
+
+        Brings an already published cluster playlist up to date with as few requests as possible. If only some tracks changed, the departed ones are removed and the new ones appended (closest to the centroid first), and the rest keep their places. If that would take as many requests as uploading the whole cluster, or the published tracks are not known, the playlist is replaced so it is exactly in centroid order again. Nothing is sent if the tracks are the same
+
+        Returns the Playlist, holding track_ids
+        '''
+        playlist = Playlist(playlist_id, None)
+        playlist.add_track_objs_to_playlist_obj([Track(track_id) for track_id in track_ids])
+
+        if published_track_ids is None:
+            playlist.replace_tracks_on_spotify_playlist(self)
+            return playlist
+
+        current_tracks, published_tracks = set(track_ids), set(published_track_ids)
+        removed_track_ids = sorted(published_tracks - current_tracks)
+        added_track_ids = [track_id for track_id in track_ids if track_id not in published_tracks]
+        if not removed_track_ids and not added_track_ids:
+            logging.info(f'{playlist_id} is already up to date')
+            return playlist
+
+        diff_requests = ceil(len(removed_track_ids) / TRACKS_PER_ADD) + ceil(len(added_track_ids) / TRACKS_PER_ADD)
+        if diff_requests >= max(1, ceil(len(track_ids) / TRACKS_PER_ADD)):
+            logging.info(f'Replacing the tracks of {playlist_id}')
+            playlist.replace_tracks_on_spotify_playlist(self)
+            return playlist
+
+        logging.info(f'Updating {playlist_id}: removing {len(removed_track_ids)} tracks and adding {len(added_track_ids)}')
+        if removed_track_ids:
+            playlist.remove_tracks_from_spotify_playlist(self, removed_track_ids)
+        if added_track_ids:
+            added_playlist = Playlist(playlist_id, None)
+            added_playlist.add_track_objs_to_playlist_obj([Track(track_id) for track_id in added_track_ids])
+            added_playlist.add_tracks_to_spotify_playlist(self)
+            playlist.snapshot_id = added_playlist.snapshot_id
+        return playlist
+
+
+
+    def resume_position(self, playlist, tracks_added):
+        '''
+        resume_position(self, playlist, tracks_added)
+
+        Where to continue an interrupted upload to playlist. If the playlist is still at its last confirmed snapshot (playlist.snapshot_id), exactly tracks_added tracks are on it. Otherwise an add went through without being confirmed, and the upload continues after every track the playlist now holds
         '''
-        fully_establish_and_add_cluster_playlists(self, desired_algorithm = 'HC 8')
+        current_snapshot_id, current_size = playlist.retrieve_upload_state(self.contacter)
+        if current_snapshot_id == playlist.snapshot_id:
+            return tracks_added
+        logging.info(f'{playlist.playlist_id} changed after its last confirmed snapshot; resuming after its {current_size} tracks')
+        playlist.snapshot_id = current_snapshot_id
+        return current_size
 
-        desired_algorithm = 'HC 8' - a string representing the preamble of the desired tables inside the database
 
-        For each of the playlists created by find_most_typical_tracks_per_cluster, this function officially adds the playlist to the user's Spotify account, making it an actual playable playlist
 
-        Returns None, but creates playlists on Spotify and updates user database
+    def deploy_cluster_playlists(self, cluster_playlists, cluster_algo = 'KMeans', deployment_state = None, on_progress = None, published_playlists = None):
+        '''
+        deploy_cluster_playlists(self, cluster_playlists, cluster_algo = 'KMeans', deployment_state = None, on_progress = None, published_playlists = None)
+
+        cluster_playlists - a dict of cluster id to its track ids, closest to the centroid first
+
+        deployment_state = None - what a previous, interrupted call recorded (see below). Clusters in it are not created again: their upload resumes from the last confirmed snapshot
+
+        on_progress = None - called with a copy of the deployment state whenever it changes, e.g. to store it and report progress
+
+        published_playlists = None - a dict of cluster id to (playlist id, the track ids it was published with or None) for clusters the user already has a playlist for. Those playlists are brought up to date with update_cluster_playlist instead of being created again
+
+        Publishes every cluster as a playlist at once: up to max_concurrent_requests playlists are created and filled concurrently, while the adds within each playlist stay in order so it keeps its centroid-distance ordering. The deployment state maps each cluster id (as a str) to its playlist_id, the snapshot_id of the last confirmed add, tracks_added and total_tracks; it is recorded as soon as a playlist is created and after every confirmed add. If any cluster fails the others still finish, then the first failure is raised
+
+        Returns a dict of cluster id to playlist id
+        '''
+        deployment_state = {} if deployment_state is None else deployment_state
+        published_playlists = published_playlists or {}
+        state_lock = threading.Lock()
+
+        def record(cluster_id, playlist, tracks_added):
+            #under the lock so on_progress sees the updates in the order they happened
+            with state_lock:
+                deployment_state[str(cluster_id)] = {'playlist_id': playlist.playlist_id, 'snapshot_id': playlist.snapshot_id, 'tracks_added': tracks_added, 'total_tracks': len(playlist.tracks)}
+                if on_progress is not None:
+                    on_progress({key: dict(value) for key, value in deployment_state.items()})
+
+        def deploy(cluster_id, track_ids):
+            track_objs = [Track(track_id) for track_id in track_ids]
+            previous_state = deployment_state.get(str(cluster_id))
+            if previous_state is None and cluster_id in published_playlists:
+                playlist = self.update_cluster_playlist(*published_playlists[cluster_id], track_ids)
+                record(cluster_id, playlist, len(track_objs))
+                return playlist.playlist_id
+
+            if previous_state is None:
+                playlist_params = self.cluster_playlist_params(int(cluster_id) + 1, cluster_algo)
+                playlist = Playlist.generate_playlist_from_user(user = self, playlist_params = json.dumps(playlist_params))
+                playlist.add_track_objs_to_playlist_obj(track_objs)
+                start = 0
+                #recorded before any add, so a retry reuses this playlist instead of creating another
+                record(cluster_id, playlist, start)
+            else:
+                playlist = Playlist(previous_state['playlist_id'], None, snapshot_id = previous_state['snapshot_id'])
+                playlist.add_track_objs_to_playlist_obj(track_objs)
+                start = self.resume_position(playlist, previous_state['tracks_added'])
+
+            if start < len(track_objs):
+                playlist.add_tracks_to_spotify_playlist(self, start = start, on_chunk = lambda playlist, tracks_added: record(cluster_id, playlist, tracks_added))
+            return playlist.playlist_id
+
+        if not cluster_playlists:
+            return {}
+        with ThreadPoolExecutor(max_workers = min(self.max_concurrent_requests, len(cluster_playlists))) as executor:
+            futures = {cluster_id: executor.submit(deploy, cluster_id, track_ids) for cluster_id, track_ids in cluster_playlists.items()}
+            wait(futures.values())
+
+        for cluster_id, future in futures.items():
+            if future.exception() is not None:
+                logging.info(f'Publishing cluster {cluster_id} failed; {len(deployment_state)} of {len(cluster_playlists)} playlists were created')
+                raise future.exception()
+        return {cluster_id: future.result() for cluster_id, future in futures.items()}
 
+
+
+
+    def add_cluster_playlists(self, cluster_playlists, cluster_algo = 'KMeans'):
         '''
+        add_cluster_playlists(self, cluster_playlists, cluster_algo = 'KMeans')
 
-        for cluster_id, cluster_playlist in cluster_playlists.items():
-            _ = self.deploy_single_cluster_playlist(cluster_playlist, cluster_id + 1,cluster_algo)
+        cluster_playlists - a dict of cluster id to its track ids, closest to the centroid first
+
+        Officially adds every cluster playlist to the user's Spotify account, making each an actual playable playlist. The playlists are created and filled concurrently (see deploy_cluster_playlists)
+
+        Returns a dict of cluster id to playlist id
+
+        '''
+        return self.deploy_cluster_playlists(cluster_playlists, cluster_algo)
 
 
         
@@ -1,11 +1,25 @@
 import json, logging
 from .track import Track
+from .api_contacter import SPOTIFY_API_URL
+from .metrics import timed
+
+
+#Maximum number of items Spotify returns per playlist page
+PLAYLIST_PAGE_LIMIT = 100
+
+#Maximum number of track uris Spotify accepts per add-items request
+TRACKS_PER_ADD = 100
 
 class Playlist:
-    def __init__(self, playlist_id, name, owner = None, description = None, snapshot_id = None):
+    def __init__(self, playlist_id, name, owner = None, description = None, snapshot_id = None, keep_raw_items = False):
+        '''
+        keep_raw_items = False - also keep every raw page item in raw_playlist_items (needed by write_playlist_items). Otherwise each page is reduced to Tracks as it arrives and its JSON is dropped
+        '''
         self.playlist_id = playlist_id
         self.name = name
         self.playlist_size = None
+        self.first_page_size = PLAYLIST_PAGE_LIMIT
+        self.keep_raw_items = keep_raw_items
         self.raw_playlist_items = []
         self.owner = owner
         self.description = description
@@ -17,7 +31,7 @@ class Playlist:
     
     @classmethod
     def generate_playlist_from_user(cls,user, playlist_params):
-        endpoint = f'https://api.spotify.com/v1/users/{user.user_id}/playlists' #it is a POST request
+        endpoint = f'{SPOTIFY_API_URL}/users/{user.user_id}/playlists' #it is a POST request
         logging.info(f'Generating playlist with params: {json.dumps(playlist_params)}')
         response_json = user.contacter.contact_api(endpoint, data_params = playlist_params, contact_type = 'post').json()
 
@@ -32,46 +46,98 @@ class Playlist:
 
     
 
-    def retrieve_playlist_data(self,contacter, save_file = True):
-        spotify_playlist_link = 'https://api.spotify.com/v1/playlists/{}'.format(self.playlist_id)
+    def retrieve_playlist_data(self,contacter, save_file = True, executor = None):
+        '''
+        retrieve_playlist_data(self, contacter, save_file = True, executor = None)
+
+        Downloads the playlist metadata and every item in the playlist. The first page tells us the total number of tracks, so the remaining pages are requested by offset rather than by chaining the 'next' links. If an executor is passed, those pages are fetched concurrently; tracks are always stored in playlist order.
+        '''
+        self.keep_raw_items = self.keep_raw_items or save_file
+        self.retrieve_first_page(contacter)
+
+        remaining_offsets = self.remaining_page_offsets()
+        page_mapper = map if executor is None else executor.map
+        for page_items in page_mapper(lambda offset: self.retrieve_page_items(contacter, offset), remaining_offsets):
+            self.ingest_items(page_items)
+
+        logging.info('Successfully downloaded data for {} after {} queries'.format(self.name, len(remaining_offsets) + 1))
+
+        if save_file:
+            self.write_playlist_items()
+
+
+
+    def retrieve_first_page(self, contacter):
+        spotify_playlist_link = f'{SPOTIFY_API_URL}/playlists/{self.playlist_id}'
         
-        playlist_response = contacter.contact_api(spotify_playlist_link)
+        logging.info(f'Working with {self.name}')
+        with timed('playlist_page'):
+            playlist_response = contacter.contact_api(spotify_playlist_link)
         
         playlist_json = playlist_response.json()
 
         track_data = playlist_json['tracks']
 
         self.playlist_size = int(track_data['total'])
-        self.raw_playlist_items.extend(track_data['items'])
+        self.first_page_size = int(track_data.get('limit') or PLAYLIST_PAGE_LIMIT)
+        self.raw_playlist_items = []
+        self.tracks = []
+        self.ingest_items(track_data['items'])
         user_data = playlist_json['owner']
         self.description = playlist_json['description']
         self.owner = user_data['display_name']
         self.snapshot_id = playlist_json['snapshot_id']
+        return track_data['items']
 
-        #now, while playlist_json['next'] exists. make a checker to make sure we did not hit an infinite loop
-        total_queries_made = 1
-        logging.info(f'Working with {self.name}')
-        while track_data['next']:
-            new_response = contacter.contact_api(track_data['next'])
-            try:
-                track_data = new_response.json()
-                self.raw_playlist_items.extend(track_data['items'])
-            except:
-                logging.info(track_data)
-                logging.info(track_data.keys())
-                raise ValueError('Unable to extend track_data')
-            total_queries_made +=1
-        logging.info('Successfully downloaded data for {} after {} queries'.format(self.name, total_queries_made))
 
-        if save_file:
-            self.write_playlist_items()
+
+    def remaining_page_offsets(self):
+        #only valid once the first page is in, since that is where the total comes from
+        assert self.playlist_size is not None
+        return list(range(self.first_page_size, self.playlist_size, PLAYLIST_PAGE_LIMIT))
+
+
+
+    def retrieve_page_items(self, contacter, offset):
+        endpoint = f'{SPOTIFY_API_URL}/playlists/{self.playlist_id}/tracks'
+        page_params = {'offset': offset, 'limit': PLAYLIST_PAGE_LIMIT}
+        with timed('playlist_page'):
+            page_response = contacter.contact_api(endpoint, additional_request_parameters = page_params)
+        try:
+            return page_response.json()['items']
+        except:
+            logging.info(page_response.text)
+            raise ValueError(f'Unable to read items at offset {offset} of {self.playlist_id}')
         
         
 
+    def ingest_items(self, items):
+        '''
+        ingest_items(self, items)
+
+        Appends a page of raw playlist items to self.tracks, keeping only what Track holds (id, duration and when it was added). Pages must be passed in playlist order
+        '''
+        if self.keep_raw_items:
+            self.raw_playlist_items.extend(items)
+        for item in items:
+            if item['track'] is not None:
+                self.tracks.append(Track.create_track_from_json(item))
+            else:
+                logging.info(f'AN EMPTY TRACK WAS FOUND IN PLAYLIST {self.name} ({self.playlist_id})... skipping track')
+
+
+
     def write_playlist_items(self):
+        assert self.keep_raw_items, 'raw playlist items were not kept'
         with open('../data/{} Raw Track Items.json'.format(self.playlist_id), 'w') as writer:
             json.dump(self.raw_playlist_items,writer)
     
+    def restore_tracks(self, snapshot_id, track_ids):
+        #used for incremental refreshes: the playlist has not changed since these track ids were stored
+        self.snapshot_id = snapshot_id
+        self.playlist_size = len(track_ids)
+        self.tracks = [Track(track_id) for track_id in track_ids]
+
     def add_track_objs_to_playlist_obj(self, items):
         self.tracks.extend(items)
     
@@ -89,6 +155,7 @@ class Playlist:
         return organized_data
     
     def convert_raw_track_items(self):
+        #tracks are built as pages arrive (see ingest_items); this rebuilds them from kept raw items
         try:
             assert self.raw_playlist_items
         
@@ -110,39 +177,71 @@ class Playlist:
     
 
     
-    def add_tracks_to_spotify_playlist(self,user):
+    def add_tracks_to_spotify_playlist(self,user, start = 0, on_chunk = None):
+        '''
+        add_tracks_to_spotify_playlist(self, user, start = 0, on_chunk = None)
+
+        Appends self.tracks[start:] to the playlist on Spotify, TRACKS_PER_ADD at a time. The requests go one after another so the playlist keeps the order of self.tracks. After each one, self.snapshot_id is the snapshot it returned and on_chunk(self, tracks_added) is called, so an interrupted upload can be resumed from tracks_added
+        '''
         assert self.tracks
         track_objs = self.tracks
-
-        bin_num = len(track_objs) // 100 + bool(len(track_objs) % 100)
-        custom_bins = [i * 100 for i in range(bin_num)]
-        custom_bins.append(len(track_objs))
+        endpoint = f'{SPOTIFY_API_URL}/playlists/{self.playlist_id}/tracks'
         
         query_counter = 0
 
-        for i in range(len(custom_bins) - 1):
-            #download i - i+1
-            relevant_tracks = track_objs[custom_bins[i]: custom_bins[i+1]]
-            track_uris_to_add = [f'spotify:track:{track.id}' for track in relevant_tracks] #it is possible it does not want a list but rather a single string separated by commas; it may depend on the function
+        for chunk_start in range(start, len(track_objs), TRACKS_PER_ADD):
+            relevant_tracks = track_objs[chunk_start: chunk_start + TRACKS_PER_ADD]
+            track_uris_to_add = [f'spotify:track:{track.id}' for track in relevant_tracks]
             body_params = json.dumps({'uris': track_uris_to_add})
-            endpoint = f'https://api.spotify.com/v1/playlists/{self.playlist_id}/tracks'
+            response = user.contacter.contact_api(endpoint, data_params = body_params, contact_type = 'post')
             try:
-                response_json = user.contacter.contact_api(endpoint, data_params = body_params, contact_type = 'post').json()
-            except:
-                logging.info(response_json.json())
-                raise ValueError
-            
-            #update snapshot ID
-            # response = user.contacter.contact_api(endpoint, data_params = body_params, contact_type = 'post').json() #adds songs
+                self.snapshot_id = response.json()['snapshot_id']
+            except (ValueError, KeyError):
+                logging.info(response.text)
+                raise ValueError(f'Unable to read the snapshot after adding tracks at position {chunk_start} of {self.playlist_id}')
 
-            self.snapshot_id = response_json['snapshot_id']
             query_counter +=1
-        logging.info('Successfully added {} tracks to {} for {} in {} queries'.format(len(track_objs), self.name, user.name , query_counter))
+            if on_chunk is not None:
+                on_chunk(self, chunk_start + len(relevant_tracks))
+        logging.info('Successfully added {} tracks to {} for {} in {} queries'.format(len(track_objs) - start, self.name, user.name , query_counter))
+
+
+
+    def replace_tracks_on_spotify_playlist(self, user):
+        '''
+        Replaces everything on the Spotify playlist with self.tracks, in order: the first TRACKS_PER_ADD replace the playlist's items and the rest are appended
+        '''
+        endpoint = f'{SPOTIFY_API_URL}/playlists/{self.playlist_id}/tracks'
+        body_params = json.dumps({'uris': [f'spotify:track:{track.id}' for track in self.tracks[:TRACKS_PER_ADD]]})
+        self.snapshot_id = user.contacter.contact_api(endpoint, data_params = body_params, contact_type = 'put').json()['snapshot_id']
+        if len(self.tracks) > TRACKS_PER_ADD:
+            self.add_tracks_to_spotify_playlist(user, start = TRACKS_PER_ADD)
+
+
+
+    def remove_tracks_from_spotify_playlist(self, user, track_ids):
+        '''
+        Removes every occurrence of track_ids from the Spotify playlist, TRACKS_PER_ADD at a time
+        '''
+        endpoint = f'{SPOTIFY_API_URL}/playlists/{self.playlist_id}/tracks'
+        for chunk_start in range(0, len(track_ids), TRACKS_PER_ADD):
+            body_params = json.dumps({'tracks': [{'uri': f'spotify:track:{track_id}'} for track_id in track_ids[chunk_start: chunk_start + TRACKS_PER_ADD]]})
+            self.snapshot_id = user.contacter.contact_api(endpoint, data_params = body_params, contact_type = 'delete').json()['snapshot_id']
+
+
+
+    def retrieve_upload_state(self, contacter):
+        '''
+        Returns the playlist's current snapshot_id and number of tracks on Spotify
+        '''
+        endpoint = f'{SPOTIFY_API_URL}/playlists/{self.playlist_id}'
+        response_json = contacter.contact_api(endpoint, additional_request_parameters = {'fields': 'snapshot_id,tracks.total'}).json()
+        return response_json['snapshot_id'], int(response_json['tracks']['total'])
 
 
     def update_playlist_metadata(self,user, metadata_to_update):
         uploadable_metadata = json.dumps(metadata_to_update)
-        endpoint = f'https://api.spotify.com/v1/playlists/{self.playlist_id}'
+        endpoint = f'{SPOTIFY_API_URL}/playlists/{self.playlist_id}'
         try:
             response_json = user.contacter.contact_api(endpoint, data_params = uploadable_metadata, contact_type = 'put').json()
             logging.info(response_json)
@@ -0,0 +1,106 @@
+'''
+result_cache.py
+
+Clustering the same data with the same algorithm and number of clusters always gives the same result, and users often re-submit the settings they already chose. ClusteringResultCache keeps recent results (the cluster labels and the prepared playlists) in process memory, keyed by everything the result depends on, so a repeat request skips the clustering entirely. Entries are evicted least recently used once the cache holds too many or too large results, and a user's entries are dropped as soon as their library data changes.
+'''
+import hashlib, pickle, threading
+from collections import OrderedDict
+
+
+#Number of results held before the least recently used are evicted
+DEFAULT_RESULT_ENTRIES = 256
+
+#Total size of the held results, in bytes, before the least recently used are evicted
+DEFAULT_RESULT_BYTES = 256 * 1024 * 1024
+
+
+def result_key(data_version, algorithm, clusters, seed, feature_columns):
+    '''
+    data_version - fingerprint of the normalized feature matrix (see utils.data_version)
+
+    Returns a short hex digest identifying one clustering of one version of the data
+    '''
+    parts = [data_version, algorithm.lower(), str(clusters), str(seed), ','.join(map(str, feature_columns))]
+    return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()[:32]
+
+
+
+class ClusteringResultCache:
+    def __init__(self, max_entries = DEFAULT_RESULT_ENTRIES, max_bytes = DEFAULT_RESULT_BYTES):
+        '''
+        max_entries = DEFAULT_RESULT_ENTRIES - most results held at once
+
+        max_bytes = DEFAULT_RESULT_BYTES - most bytes of results held at once; a single result larger than this is not cached
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict() #key -> (user id, data version, pickled result)
+        self._user_keys = {} #user id -> keys of their entries
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        '''
+        Returns (cluster labels, prepared playlists) for key, or None. Each call returns a fresh copy, so callers may modify it
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return pickle.loads(entry[2])
+
+
+    def put(self, user_id, key, data_version, labels, prepared_playlists):
+        '''
+        Caches a result and drops the user's results for any other version of their data, which can no longer be requested
+        '''
+        payload = pickle.dumps((labels, prepared_playlists), protocol = pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            self._invalidate(user_id, data_version)
+            self._discard(key)
+            self._entries[key] = (user_id, data_version, payload)
+            self._user_keys.setdefault(user_id, set()).add(key)
+            self.total_bytes += len(payload)
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+
+    def invalidate_user(self, user_id, current_data_version = None):
+        '''
+        Drops the user's results, except those computed from current_data_version
+        '''
+        with self._lock:
+            self._invalidate(user_id, current_data_version)
+
+
+    def _invalidate(self, user_id, current_data_version):
+        #caller holds the lock
+        for key in list(self._user_keys.get(user_id, ())):
+            if self._entries[key][1] != current_data_version:
+                self._discard(key)
+
+
+    def _discard(self, key):
+        #caller holds the lock
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        user_id, _, payload = entry
+        self.total_bytes -= len(payload)
+        user_keys = self._user_keys[user_id]
+        user_keys.discard(key)
+        if not user_keys:
+            del self._user_keys[user_id]
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.total_bytes}
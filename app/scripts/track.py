@@ -7,7 +7,12 @@ This defines the class and behaviors for the Track object aka each song
 
 '''
 import logging
+from .api_contacter import SPOTIFY_API_URL
+
 class Track:
+    #a large library holds one Track per playlist entry, so skip the per-instance __dict__
+    __slots__ = ('id', 'album', 'artist', 'duration', 'name', 'added')
+
     def __init__(self,track_id = None, album = None, artist = None, duration = None,name = None, added_at = None):
         self.id = track_id
         self.album = album
@@ -44,7 +49,7 @@ class Track:
         RETEST AND REWRITE TO MAKE SUITABLE FOR NEW CLASS
         '''
         
-        audio_analysis_link = 'https://api.spotify.com/v1/audio-features/{}'.format(self.id)
+        audio_analysis_link = '{}/audio-features/{}'.format(SPOTIFY_API_URL, self.id)
 
         features_response = contacter.contact_api(audio_analysis_link)
 
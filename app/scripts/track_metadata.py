@@ -0,0 +1,66 @@
+'''
+track_metadata.py
+
+The clustering results page shows a name, artists and album cover for a handful of tracks per cluster, and is reloaded often. TrackMetadataCache keeps that metadata per track id in process memory for a limited time so repeat page views do not go back to Spotify.
+'''
+import threading, time
+from collections import OrderedDict
+
+
+#Seconds a track's display metadata is reused before it is fetched again (cover art urls can change)
+DEFAULT_METADATA_TTL = 6 * 60 * 60
+
+#Number of tracks held before the least recently used are evicted
+DEFAULT_METADATA_ENTRIES = 50000
+
+
+class TrackMetadataCache:
+    def __init__(self, ttl = DEFAULT_METADATA_TTL, max_entries = DEFAULT_METADATA_ENTRIES):
+        '''
+        ttl = DEFAULT_METADATA_TTL - seconds an entry stays valid
+
+        max_entries = DEFAULT_METADATA_ENTRIES - size of the LRU
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() #track id -> (expires at, metadata)
+        self._lock = threading.Lock()
+
+
+    def get_many(self, track_ids):
+        '''
+        Returns the unexpired metadata for whichever of track_ids are cached
+        '''
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for track_id in track_ids:
+                entry = self._entries.get(track_id)
+                if entry is None:
+                    continue
+                expires_at, metadata = entry
+                if expires_at <= now:
+                    del self._entries[track_id]
+                    continue
+                self._entries.move_to_end(track_id)
+                found[track_id] = metadata
+            self.hits += len(found)
+            self.misses += len(set(track_ids)) - len(found)
+        return found
+
+
+    def put_many(self, track_metadata):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for track_id, metadata in track_metadata.items():
+                self._entries[track_id] = (expires_at, metadata)
+                self._entries.move_to_end(track_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
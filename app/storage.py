@@ -0,0 +1,362 @@
+"""
+storage.py
+
+This script defines the artifact stores that hold everything Radial keeps per user: JSON documents (playlist snapshots, prepared playlists, the results page), NumPy arrays (linkages, centroids, labels) and the prepared data. An artifact store is either S3ArtifactStore, which keeps one long-lived pooled S3 client, or LocalArtifactStore, which uses a directory on disk so the whole pipeline can run and be benchmarked without AWS.
+
+Both stores take the same keys ('<user id>/<name>') and string metadata. A local object is one file: a JSON line of metadata, then the body. Arrays are stored as .npy: a local file is memory-mapped and an S3 object is viewed in place over the downloaded bytes, so reading parses nothing. JSON is gzip-compressed on write; uncompressed JSON written before that is still read.
+"""
+
+#Standard Python imports
+import gzip, hashlib, io, json, logging, mmap, os, tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np, pandas as pd
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+#Custom script imports
+from scripts.metrics import timed, propagate_timings
+
+
+#Version of the layout written by save_frame and save_labels; anything written with another version is ignored
+FRAME_FORMAT = '1'
+
+#Connections the pooled S3 client keeps open, which is also how many objects put_many/get_many transfer at once
+STORE_CONCURRENCY = 16
+
+#Returned by get() when if_none_match still matches the stored object
+NOT_MODIFIED = object()
+
+#Error codes S3 answers with when there is no such object (HEAD requests only get the status code)
+MISSING_OBJECT_CODES = ('NoSuchKey', '404', 'NotFound')
+
+#First bytes of every gzip stream
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def array_to_npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def npy_bytes_to_array(body):
+    """
+    view .npy bytes as an array without copying the data
+
+    Returns:
+        np.ndarray: a read-only array backed by body
+    """
+    header = io.BytesIO(body)
+    array_header = read_npy_header(header)
+    if array_header is None:
+        return np.load(io.BytesIO(body), allow_pickle=False)
+    return view_npy_data(body, array_header, header.tell())
+
+
+def read_npy_header(reader):
+    """
+    Returns:
+        tuple: (shape, fortran_order, dtype) of the .npy data reader is at, leaving it at the start of the values, or None for a format version that can only be loaded
+    """
+    version = np.lib.format.read_magic(reader)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(reader)
+    if version == (2, 0):
+        return np.lib.format.read_array_header_2_0(reader)
+    return None
+
+
+def view_npy_data(buffer, array_header, offset):
+    shape, fortran_order, dtype = array_header
+    array = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset)
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+
+class StoredObject:
+    def __init__(self, body, metadata, etag):
+        self.body = body
+        self.metadata = metadata
+        self.etag = etag
+
+
+
+class ArtifactStore:
+    """
+    What every store provides on top of its put, get and exists: concurrent multi-object transfers, compressed JSON and arrays
+    """
+
+    def put_many(self, items):
+        """
+        store several objects concurrently
+
+        Args:
+            items (list): (key, body, metadata) tuples
+        """
+        if not items:
+            return
+        with ThreadPoolExecutor(max_workers=min(STORE_CONCURRENCY, len(items))) as executor:
+            #list() so the first failure is raised here
+            list(executor.map(propagate_timings(lambda item: self.put(*item)), items))
+
+
+    def get_many(self, keys):
+        """
+        Returns:
+            dict: key to StoredObject, or None for keys that do not exist
+        """
+        if not keys:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(STORE_CONCURRENCY, len(keys))) as executor:
+            return dict(zip(keys, executor.map(propagate_timings(self.get), keys)))
+
+
+    def put_json(self, key, data, metadata=None):
+        self.put(key, gzip.compress(json.dumps(data).encode()), metadata, content_type='application/json')
+
+
+    def get_json(self, key):
+        """
+        Returns:
+            the decoded JSON document, or None if there is no such object
+        """
+        stored = self.get(key)
+        if stored is None:
+            return None
+        return json.loads(decode_json_body(stored.body))
+
+
+    def put_array(self, key, array, metadata=None):
+        self.put(key, array_to_npy_bytes(array), metadata)
+
+
+    def load_array(self, key):
+        """
+        Returns:
+            tuple: (read-only array, metadata), or None if there is no such object
+        """
+        stored = self.get(key)
+        if stored is None:
+            return None
+        return npy_bytes_to_array(stored.body), stored.metadata
+
+
+    def get_array(self, key, expected_metadata=None):
+        """
+        Args:
+            expected_metadata (dict, optional): metadata the array must carry, e.g. the current data version
+
+        Returns:
+            np.ndarray: the array, or None if it does not exist or its metadata does not match
+        """
+        stored = self.load_array(key)
+        if stored is None:
+            return None
+        array, metadata = stored
+        if expected_metadata and any(metadata.get(name) != value for name, value in expected_metadata.items()):
+            return None
+        return array
+
+
+
+def decode_json_body(body):
+    return (gzip.decompress(body) if body[:2] == GZIP_MAGIC else body).decode()
+
+
+
+class S3ArtifactStore(ArtifactStore):
+    def __init__(self, bucket_name, max_pool_connections=STORE_CONCURRENCY):
+        """
+        Args:
+            bucket_name (str): bucket the artifacts are kept in
+            max_pool_connections (int): size of the client's connection pool; the client is created once and shared by every thread
+        """
+        self.bucket_name = bucket_name
+        self.client = boto3.client('s3', config=Config(max_pool_connections=max_pool_connections))
+
+    def put(self, key, body, metadata=None, content_type='application/octet-stream'):
+        put_args = {'Body': body, 'Bucket': self.bucket_name, 'Key': key, 'ContentType': content_type, 'Metadata': metadata or {}}
+        if body[:2] == GZIP_MAGIC:
+            put_args['ContentEncoding'] = 'gzip'
+        with timed('s3_upload'):
+            self.client.put_object(**put_args)
+        logging.info(f'successful upload of {key} to bucket')
+
+    def get(self, key, if_none_match=None):
+        """
+        Args:
+            if_none_match (str, optional): ETag of a copy the caller already has
+
+        Returns:
+            StoredObject, NOT_MODIFIED if the object still has the ETag if_none_match, or None if there is no such object
+        """
+        get_args = {'Bucket': self.bucket_name, 'Key': key}
+        if if_none_match is not None:
+            get_args['IfNoneMatch'] = if_none_match
+        with timed('s3_download'):
+            try:
+                s3_object = self.client.get_object(**get_args)
+            except ClientError as e:
+                if if_none_match is not None and e.response['Error']['Code'] in ('304', 'NotModified'):
+                    return NOT_MODIFIED
+                #anything else (denied, throttled, a server error) is not the same as a missing object
+                if e.response['Error']['Code'] in MISSING_OBJECT_CODES:
+                    return None
+                raise
+            return StoredObject(s3_object['Body'].read(), s3_object['Metadata'], s3_object.get('ETag'))
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=key)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in MISSING_OBJECT_CODES:
+                return False
+            raise
+
+
+
+class LocalArtifactStore(ArtifactStore):
+    def __init__(self, root):
+        """
+        Args:
+            root (str): directory the artifacts are kept under; keys become relative paths
+        """
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, key, body, metadata=None, content_type='application/octet-stream'):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #the metadata and ETag go on the first line of the same file, so a reader always gets them with the body they describe
+        header = {'metadata': metadata or {}, 'etag': hashlib.md5(body).hexdigest()}
+        #write to a temporary file of this put's own, then rename, so a reader never sees half a file and concurrent puts of one key do not mix
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as writer:
+                writer.write(json.dumps(header).encode() + b'\n')
+                writer.write(body)
+            os.replace(temporary_path, path)
+        except:
+            os.remove(temporary_path)
+            raise
+
+    def get(self, key, if_none_match=None):
+        """
+        Returns:
+            StoredObject, NOT_MODIFIED if the file still has the ETag if_none_match, or None if there is no such file
+        """
+        try:
+            with open(self._path(key), 'rb') as reader:
+                header = json.loads(reader.readline())
+                if if_none_match is not None and header['etag'] == if_none_match:
+                    return NOT_MODIFIED
+                return StoredObject(reader.read(), header['metadata'], header['etag'])
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def load_array(self, key):
+        """
+        Returns:
+            tuple: (read-only memory-mapped array, metadata), or None if there is no such file
+        """
+        try:
+            with open(self._path(key), 'rb') as reader:
+                header = json.loads(reader.readline())
+                array_header = read_npy_header(reader)
+                if array_header is None:
+                    return np.load(reader, allow_pickle=False), header['metadata']
+                #the mapping stays open for as long as the array refers to it
+                return view_npy_data(mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ), array_header, reader.tell()), header['metadata']
+        except FileNotFoundError:
+            return None
+
+
+
+def build_artifact_store(bucket_name, local_root=None):
+    """
+    Returns:
+        ArtifactStore: a LocalArtifactStore under local_root if it is set, otherwise an S3ArtifactStore for bucket_name
+    """
+    if local_root:
+        logging.info(f'Keeping artifacts on local disk under {local_root}')
+        return LocalArtifactStore(local_root)
+    return S3ArtifactStore(bucket_name)
+
+
+
+def save_frame(store, key, frame, data_version, **details):
+    """
+    store a numeric DataFrame as two arrays: its values (float64) and its index
+
+    Args:
+        store (ArtifactStore)
+        key (str): prefix of the two objects, e.g. '<user id>/prepared_data'
+        frame (DataFrame): numeric data indexed by track id
+        data_version (str): fingerprint of the data (see utils.data_version)
+        details: extra string metadata, e.g. the library version the frame was built from
+    """
+    metadata = dict({name.replace('_', '-'): str(value) for name, value in details.items()},
+                    **{'format': FRAME_FORMAT, 'data-version': data_version, 'columns': json.dumps([str(column) for column in frame.columns])})
+    store.put_many([(f'{key}.index.npy', array_to_npy_bytes(np.array([str(label) for label in frame.index])), metadata),
+                    (f'{key}.values.npy', array_to_npy_bytes(np.ascontiguousarray(frame.to_numpy(dtype=np.float64))), metadata)])
+    logging.info(f'stored {frame.shape[0]} x {frame.shape[1]} frame at {key}')
+
+
+def load_frame(store, key, data_version=None, **details):
+    """
+    read a frame written by save_frame without parsing or copying its values
+
+    Args:
+        data_version (str, optional): only return the frame if it was stored from this version of the data
+        details: metadata the frame must have been saved with, as passed to save_frame
+
+    Returns:
+        DataFrame: the frame, or None if it is missing, has another layout or does not match data_version or details
+    """
+    stored_values = store.load_array(f'{key}.values.npy')
+    stored_index = store.load_array(f'{key}.index.npy')
+    if stored_values is None or stored_index is None:
+        return None
+    (values, metadata), (index, index_metadata) = stored_values, stored_index
+    #the two objects are written concurrently, so only trust them if they come from the same write
+    if metadata.get('format') != FRAME_FORMAT or index_metadata.get('data-version') != metadata.get('data-version'):
+        return None
+    if data_version is not None and metadata.get('data-version') != data_version:
+        return None
+    if any(metadata.get(name.replace('_', '-')) != str(value) for name, value in details.items()):
+        return None
+    return pd.DataFrame(values, index=pd.Index(index.tolist()), columns=json.loads(metadata['columns']), copy=False)
+
+
+def save_labels(store, key, labels, data_version, **details):
+    """
+    store the cluster label of every row of a frame saved with the same data_version
+
+    Args:
+        key (str): name of the object, e.g. '<user id>/cluster_labels.npy'
+        labels (array-like): integer labels in the frame's row order
+        details: extra string metadata, e.g. the algorithm and number of clusters
+    """
+    metadata = dict({name.replace('_', '-'): str(value) for name, value in details.items()}, **{'format': FRAME_FORMAT, 'data-version': data_version})
+    store.put_array(key, np.asarray(labels, dtype=np.int16), metadata)
+
+
+def load_labels(store, key, data_version=None):
+    """
+    Returns:
+        tuple: (labels, metadata), or None if they are missing, have another layout or do not match data_version
+    """
+    stored = store.load_array(key)
+    if stored is None:
+        return None
+    labels, metadata = stored
+    if metadata.get('format') != FRAME_FORMAT or (data_version is not None and metadata.get('data-version') != data_version):
+        return None
+    return labels, metadata
@@ -5,23 +5,63 @@ This script defines the relevant helper functions for main.py
 """
 
 #Standard Python imports
-import time, re, logging, random, requests, boto3, json
-from typing import Union
+import time, re, logging, random, requests, boto3, json, os, queue, threading, hashlib
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import OrderedDict
 from botocore.errorfactory import ClientError
 from botocore.exceptions import ClientError
 import pymysql.cursors
-
-#Clustering imports
-from scipy.cluster.hierarchy import cut_tree
-from sklearn.cluster import KMeans
+from requests.adapters import HTTPAdapter
 
 #Custom script imports
-from scripts import SpotifyUser, Contacter
+from scripts import SpotifyUser, Contacter, TrackFeaturesCache, MySQLTrackFeaturesStore, KMeansEngine, KSweep, TrackMetadataCache, ClusteringResultCache
+from scripts.api_contacter import SPOTIFY_API_URL
+from scripts.kmeans_engine import KMEANS_SEED
+from scripts.new_user import CLUSTERING_FEATURES
+from scripts.metrics import timed, propagate_timings, count_spotify_request
+from scripts.result_cache import result_key
+from storage import NOT_MODIFIED, array_to_npy_bytes, decode_json_body
 
 
 #Set random seed for reproducibility
 random.seed(420)
 
+#Cluster counts offered by the app
+SUPPORTED_CLUSTER_SIZES = (5, 9, 13)
+
+#Submitted instead of a cluster count when the user lets Radial choose, and the counts it chooses from
+AUTO_CLUSTERS = 'auto'
+AUTO_CLUSTER_RANGE = range(4, 26)
+
+#Above this many tracks, agglomerative clustering condenses the tracks into micro-clusters first so memory stays bounded
+LARGE_LIBRARY_THRESHOLD = 10000
+
+#K-means warm-starts from the previous run's centroids when at most this fraction of the library has changed
+KMEANS_WARM_START_MAX_CHANGE = 0.1
+
+#Spotify's /tracks endpoint accepts at most this many ids per call
+TRACKS_LOOKUP_BATCH_SIZE = 50
+
+#Concurrent /tracks calls made while gathering display metadata
+TRACKS_LOOKUP_WORKERS = 4
+
+#Name of the stored display payload of a user's latest clustering, and the version of its layout
+RESULTS_ARTIFACT_NAME = 'clustering_results.json'
+RESULTS_ARTIFACT_FORMAT = 2
+
+#Folder under a user's prefix recording which tracks each of their published cluster playlists was last given
+PUBLISHED_TRACKS_FOLDER = 'published_playlists'
+
+#A secret can be supplied without Secrets Manager: as its SecretString in the environment variable SECRET_ENV_PREFIX + its name (upper-cased, non-alphanumerics as _), or under its name in the JSON file named by SECRETS_FILE_ENV
+SECRET_ENV_PREFIX = 'RADIAL_SECRET_'
+SECRETS_FILE_ENV = 'RADIAL_SECRETS_FILE'
+
+#Secret holding the Spotify client id, client secret and auth hash
+SPOTIFY_AUTH_SECRET_NAME = 'radialspotifyauthcreds'
+
 #Logging formatter
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -76,8 +116,39 @@ def get_secret(secret_name, region_name = 'us-west-2'):
 
 
 
+@lru_cache(maxsize=None)
+def resolve_secret(secret_name):
+    """
+    look a secret up the first time it is needed: in the environment, then in the secrets file, then in Secrets Manager. Cached, so each secret is resolved at most once per process
+
+    Args:
+        secret_name (str): name of the secret in Secrets Manager
+
+    Returns:
+        str: the secret's SecretString
+    """
+    env_name = SECRET_ENV_PREFIX + re.sub(r'[^A-Za-z0-9]', '_', secret_name).upper()
+    if env_name in os.environ:
+        return os.environ[env_name]
+
+    secrets_path = os.environ.get(SECRETS_FILE_ENV)
+    if secrets_path:
+        with open(secrets_path) as reader:
+            file_secrets = json.load(reader)
+        if secret_name in file_secrets:
+            secret = file_secrets[secret_name]
+            #the file may hold the secret as a string, as Secrets Manager does, or as the decoded JSON
+            return secret if isinstance(secret, str) else json.dumps(secret)
+
+    logging.info(f'Fetching {secret_name} from Secrets Manager')
+    return get_secret(secret_name)
+
+
+
+@lru_cache(maxsize=None)
 def get_db_info(db_secret_name):
-    return json.loads(get_secret(db_secret_name))
+    #cached so the secret is only resolved and parsed once per process
+    return json.loads(resolve_secret(db_secret_name))
 
 
 
@@ -90,53 +161,109 @@ def create_db_connection(db_secret_name):
 
 
 
+#Most connections a single process keeps to the database
+DB_POOL_MAX_SIZE = 5
+
+#Seconds to wait for a free connection before giving up
+DB_POOL_CHECKOUT_TIMEOUT = 30
+
+
+class DBConnectionPool:
+    def __init__(self, db_secret_name, max_size=DB_POOL_MAX_SIZE, checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT):
+        """
+        per-process pool of database connections. Connections are opened on demand, so creating the pool before uWSGI forks does not share sockets between workers
+
+        Args:
+            db_secret_name (str): name of the database secret; the credentials are resolved when the first connection is opened
+            max_size (int): most connections open at once
+            checkout_timeout (int): seconds to wait for a connection when all of them are in use
+        """
+        self.db_secret_name = db_secret_name
+        self.checkout_timeout = checkout_timeout
+        self._idle_connections = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+
+    def _checkout(self):
+        #reuse the most recently returned healthy connection, otherwise open a new one
+        while True:
+            try:
+                conn = self._idle_connections.get_nowait()
+            except queue.Empty:
+                return create_db_connection(self.db_secret_name)
+            try:
+                conn.ping(reconnect=False)
+                return conn
+            except Exception:
+                logging.info('Discarding a stale pooled connection')
+                close_connection_quietly(conn)
+
+
+    @contextmanager
+    def connection(self):
+        """
+        check a connection out for the duration of a with block. Uncommitted work is rolled back if the block raises
+
+        Raises:
+            TimeoutError: if no connection frees up within checkout_timeout seconds
+        """
+        #timed from the checkout until the connection is returned, so waiting for a free connection counts too
+        with timed('database'):
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                raise TimeoutError('No database connection became available')
+            try:
+                conn = self._checkout()
+                try:
+                    yield conn
+                except:
+                    try:
+                        conn.rollback()
+                        self._idle_connections.put(conn)
+                    except Exception:
+                        close_connection_quietly(conn)
+                    raise
+                else:
+                    self._idle_connections.put(conn)
+            finally:
+                self._slots.release()
+
+
+
+
+def build_track_features_cache(db_pool):
+    """
+    build the process-wide audio features cache, backed by the TrackAudioFeatures table
 
-def close_connection(db):
-    db.close()
-
-
-
-
-def user_s3_exists(s3_client, user_id, optional_file=''):
-    # checks if user s3 info exists
-    try:
-        s3_client.head_object(Bucket='radial-web-app-data', Key=f'{user_id}/{optional_file}') #if the file is not passed this will just check if the user exists. if a file is passed it will check if that file exists
-        return True
-    except ClientError as e:
-        # User is Not found
-        return False
-
-
+    Args:
+        db_pool (DBConnectionPool): pool the cache borrows connections from
 
+    Returns:
+        TrackFeaturesCache: cache to share across every user handled by this process
+    """
+    features_store = MySQLTrackFeaturesStore(db_pool.connection)
+    return TrackFeaturesCache(persistent_store=features_store)
 
-def user_db_exists(db_cursor, user_id):
-    sql_statement = f'SELECT * FROM RadialUsers WHERE SpotifyID="{user_id}";'
-    db_cursor.execute(sql_statement)
-    return bool(db_cursor.fetchone())
 
 
 
+def close_connection(db):
+    db.close()
 
-def upload_data_to_bucket(bucket_arn:str,uploadable_data:Union[list,dict,str], desired_name:str):
-    """
-    upload entire array to bucket as a JSON obj
-    Args:
-        uploadable_data (list)
-        desired_name (str): key for bucket
-    """
-    
-    s3 = boto3.client('s3')
-    s3_args = {'Body':bytes(json.dumps(uploadable_data),'utf-8'), 'Bucket':bucket_arn.split(':')[-1], 'Key':desired_name, 'ContentType':'application/json'}
-    s3.put_object(**s3_args)
-    logging.info('successful upload to bucket')
 
 
+def close_connection_quietly(db):
+    try:
+        db.close()
+    except Exception:
+        pass
 
 
-def read_data_from_bucket(bucket_name,file_name):
-    return boto3.client('s3').get_object(Bucket=bucket_name, Key=file_name)["Body"].read().decode()
 
 
+def user_db_exists(db_cursor, user_id):
+    sql_statement = 'SELECT * FROM RadialUsers WHERE SpotifyID=%s;'
+    db_cursor.execute(sql_statement, (user_id,))
+    return bool(db_cursor.fetchone())
 
 
 
@@ -147,7 +274,7 @@ def initUserDataStructures(db_connection,refresh_token, access_token, expires_in
     if user_db_exists(db_cursor,user_id):
         logging.info('USER DOES EXIST')
         #now check if the access token is expired - if it is then we need to refresh it
-        db_cursor.execute(f'SELECT * FROM RadialUsers WHERE SpotifyID="{user_id}" ORDER BY AccessExpires DESC;')
+        db_cursor.execute('SELECT * FROM RadialUsers WHERE SpotifyID=%s ORDER BY AccessExpires DESC;', (user_id,))
         # recorded_expiration = db_cursor.fetchone()[-1]
 
         #if the access token IS expired, refresh it 
@@ -158,14 +285,15 @@ def initUserDataStructures(db_connection,refresh_token, access_token, expires_in
         expires_in = refresh_token_data['expiresAt']
 
         #Update user with new data regardless
-        replace_statement = 'UPDATE RadialUsers SET AccessToken=%s, RefreshToken=%s, AccessExpires=%s WHERE SpotifyId=' + f'"{user_id}";'
-        replaceable_values = (access_token, refresh_token, expires_in + int(time.time()))
+        replace_statement = 'UPDATE RadialUsers SET AccessToken=%s, RefreshToken=%s, AccessExpires=%s WHERE SpotifyId=%s;'
+        replaceable_values = (access_token, refresh_token, expires_in, user_id)
         # app.logger.info(f"updating with these values to db {replaceable_values}")
         db_cursor.execute(replace_statement, replaceable_values)
     else:
         logging.info('BRAND NEW USER ADDING TO DB AND MAKING BUCKET')
         insert_statement = 'INSERT INTO RadialUsers(SpotifyId,DisplayName,AccessToken,RefreshToken,AccessExpires) VALUES(%s,%s,%s,%s,%s);'
-        insertable_values = (user_id,user_name,access_token, refresh_token, expires_in)
+        #AccessExpires holds the epoch second the token expires, as refreshes store it
+        insertable_values = (user_id,user_name,access_token, refresh_token, int(time.time()) + expires_in)
         logging.debug(msg=f"VALUES: {insertable_values}")
 
         db_cursor.execute(insert_statement, insertable_values)
@@ -177,10 +305,10 @@ def initUserDataStructures(db_connection,refresh_token, access_token, expires_in
 
 
 
+@lru_cache(maxsize=None)
 def gatherAuthInfoAWS():
-    secrets_client = boto3.client('secretsmanager')
-    secret_info = secrets_client.get_secret_value(SecretId='radialspotifyauthcreds')
-    secrets =  json.loads(secret_info['SecretString'])
+    #cached, and only resolved when a route or token refresh first needs it rather than at import
+    secrets =  json.loads(resolve_secret(SPOTIFY_AUTH_SECRET_NAME))
 
     formatted_secrets = {}
 
@@ -191,7 +319,8 @@ def gatherAuthInfoAWS():
         
 
 # AUTH HASH HERE
-AUTH_HASH = gatherAuthInfoAWS()['radial-spotify-auth-hash']
+def spotify_auth_hash():
+    return gatherAuthInfoAWS()['radial-spotify-auth-hash']
 
 
 
@@ -207,7 +336,7 @@ def refreshTheToken(refreshToken):
     """
 
     #Generate authorization hash and relevant data
-    auth_header = {'Authorization': f'{AUTH_HASH}'}
+    auth_header = {'Authorization': f'{spotify_auth_hash()}'}
     logging.info(f"REFRESHING THE TOKEN")
     data = {'grant_type': 'refresh_token', 'refresh_token': refreshToken}
     
@@ -229,16 +358,19 @@ def gather_cluster_size_from_submission(submission):
 
     submission - str
 
-    Parse the submission for cluster size and return the integer. It is guaranteed to be in here.
+    Parse the submission for cluster size and return the integer. It is guaranteed to be in here, unless the user chose to let Radial pick.
 
-    Returns int of cluster size
+    Returns int of cluster size, or AUTO_CLUSTERS
     """
     pattern = r'\d+'
-    return int(re.findall(pattern, submission)[0])
+    found_sizes = re.findall(pattern, submission)
+    if not found_sizes and AUTO_CLUSTERS in submission.lower():
+        return AUTO_CLUSTERS
+    return int(found_sizes[0])
 
 
 
-def prime_user_from_access_token(user_id,accessToken):
+def prime_user_from_access_token(user_id,accessToken, features_cache=None, refresh_token=None, access_expires=None, db_pool=None):
     """
     prime_user_from_access_token(user_id,accessToken)
 
@@ -247,43 +379,258 @@ def prime_user_from_access_token(user_id,accessToken):
     Args:
         user_id (str)
         accessToken (str)
+        features_cache (TrackFeaturesCache, optional): shared audio features cache for the user's downloads
+        refresh_token (str, optional): lets the user's contacter refresh the access token when it expires mid-job
+        access_expires (int, optional): epoch second the access token expires (RadialUsers.AccessExpires)
+        db_pool (DBConnectionPool, optional): where refreshed tokens are written back to RadialUsers
 
     Returns:
         SpotifyUser: instance to use for gathering etc.
     """
     user_contacter = Contacter()
     user_contacter.formAccessHeaderfromToken(accessToken)
-    new_user = SpotifyUser(user_id, contacter=user_contacter)
+    if refresh_token:
+        user_contacter.auth_header = {'Authorization': f'{spotify_auth_hash()}'}
+        on_token_refresh = store_refreshed_token(db_pool, user_id) if db_pool is not None else None
+        user_contacter.enable_token_refresh(refresh_token, access_expires, on_token_refresh)
+    new_user = SpotifyUser(user_id, contacter=user_contacter, features_cache=features_cache)
     logging.info(f'user {user_id} has been primed from access token')
     return new_user
 
 
-def prepare_data(user):
+def store_refreshed_token(db_pool, user_id):
+    """
+    build the callback a Contacter uses to write a refreshed access token back to RadialUsers
+
+    Args:
+        db_pool (DBConnectionPool)
+        user_id (str)
+
+    Returns:
+        function: callback taking (access_token, refresh_token, expires_at)
+    """
+    def write_refreshed_token(access_token, refresh_token, expires_at):
+        with db_pool.connection() as db_connection:
+            with db_connection.cursor() as cursor:
+                cursor.execute('UPDATE RadialUsers SET AccessToken=%s, RefreshToken=%s, AccessExpires=%s WHERE SpotifyID=%s;', (access_token, refresh_token, expires_at, user_id))
+            db_connection.commit()
+        logging.info(f'stored the refreshed access token of {user_id}')
+    return write_refreshed_token
+
+
+def prepare_data(user, previous_snapshots=None, stored_data=None):
     """
     prepare_data(user)
 
-    Gather and prepare all data for user. This will take a long time as it collects all track data for each user
+    Gather and prepare all data for user. This will take a long time as it collects all track data for each user, unless previous_snapshots is passed, in which case only the playlists changed since then are downloaded
 
     Args:
         user (SpotifyUser): must be made prior
+        previous_snapshots (dict, optional): output of user.playlist_snapshots() from the last run
+        stored_data (DataFrame, optional): the data prepared from the library in previous_snapshots (see library_version); returned as is, without collecting any audio features, if no playlist has changed since
+
+    Returns:
+        DataFrame: normalized data to pass to clustering algorithm, one row per track with complete audio features
+    """
+
+    #each stage is timed (see scripts/metrics.py). For around 2500 tracks collecting takes around 50s 
+    with timed('collect_library') as span:
+        listed_playlist_ids = None
+        if previous_snapshots is not None and stored_data is not None and list(stored_data.columns) == list(CLUSTERING_FEATURES):
+            listed_playlist_ids = user.get_all_user_playlist_ids()
+            library_unchanged = user.restore_unchanged_playlists(listed_playlist_ids, previous_snapshots)
+        else:
+            library_unchanged = False
+        if not library_unchanged:
+            aggregated_audio_features = user.collect_data(previous_snapshots=previous_snapshots, listed_playlist_ids=listed_playlist_ids)
+    logging.info(f'Collecting the library took {span.seconds:.2f} seconds')
+
+    if library_unchanged:
+        logging.info('No playlist changed since the stored data was prepared, hence reuse it')
+        return stored_data
+
+    #the features go straight into a float matrix, normalized in place; pandas only wraps the result
+    with timed('build_feature_matrix'):
+        track_ids, feature_matrix = SpotifyUser.build_feature_matrix(aggregated_audio_features)
+
+    with timed('normalize'):
+        SpotifyUser.normalize_feature_matrix(feature_matrix)
+    return SpotifyUser.feature_frame(track_ids, feature_matrix)
+
+
+
+def data_version(normalized_data):
+    """
+    fingerprint of the prepared data, used to tell whether anything cached from it is still valid
+
+    Args:
+        normalized_data (DataFrame): prepared and normalized data
+
+    Returns:
+        str: hex digest that changes whenever the tracks or their features change
+    """
+    digest = hashlib.sha256()
+    digest.update('\x1f'.join(map(str, normalized_data.index)).encode())
+    digest.update('\x1f'.join(map(str, normalized_data.columns)).encode())
+    digest.update(np.ascontiguousarray(normalized_data.to_numpy(dtype=np.float64)).tobytes())
+    return digest.hexdigest()[:32]
+
+
+
+def library_version(snapshots):
+    """
+    fingerprint of the playlists a library was collected from, used to tell whether data prepared from it is still current
+
+    Args:
+        snapshots (dict): output of user.playlist_snapshots()
+
+    Returns:
+        str: hex digest that changes whenever a playlist is added, removed or changed
+    """
+    listing = sorted((playlist_id, str(snapshot['snapshot_id'])) for playlist_id, snapshot in snapshots.items())
+    return hashlib.sha256(json.dumps(listing).encode()).hexdigest()[:32]
+
+
+
+def get_agglomerative_labels(clusters, normalized_data, store=None, user_id=None):
+    """
+    cuts the Ward linkage of the data into the given number of clusters
+
+    Libraries over LARGE_LIBRARY_THRESHOLD tracks are condensed into micro-clusters first (see SpotifyUser.produce_micro_cluster_linkage) and the linkage is built over those, so memory stays bounded; every track then takes its micro-cluster's label
+
+    The linkage and the cuts for every size in SUPPORTED_CLUSTER_SIZES are stored under the user's prefix, tagged with the data version. A later request on the same data reads the precomputed labels (or, for another size, only runs cut_tree on the stored linkage) instead of rebuilding the linkage
+
+    Args:
+        clusters (int): number of clusters
+        normalized_data (DataFrame): prepared and normalized data
+        store (ArtifactStore, optional): where to cache; nothing is cached without it and user_id
+        user_id (str, optional)
+
+    Returns:
+        np.ndarray: cluster label of every row of normalized_data
+    """
+    caching = store is not None and user_id is not None
+    version_metadata = {'data-version': data_version(normalized_data)}
+    linkage_key = f'{user_id}/ward_linkage.npy'
+    micro_labels_key = f'{user_id}/ward_micro_labels.npy'
+    labels_key = f'{user_id}/ward_cut_labels.npy'
+    large_library = len(normalized_data) > LARGE_LIBRARY_THRESHOLD
+
+    if caching and clusters in SUPPORTED_CLUSTER_SIZES:
+        cut_labels = store.get_array(labels_key, version_metadata)
+        if cut_labels is not None:
+            logging.info('Using precomputed agglomerative labels')
+            return cut_labels[:, SUPPORTED_CLUSTER_SIZES.index(clusters)]
+
+    linkage_matrix = store.get_array(linkage_key, version_metadata) if caching else None
+    micro_labels = store.get_array(micro_labels_key, version_metadata) if caching and large_library else None
+    if linkage_matrix is None or (large_library and micro_labels is None):
+        if large_library:
+            logging.info(f'Building the Ward linkage over micro-clusters for {len(normalized_data)} tracks')
+            linkage_matrix, micro_labels = SpotifyUser.produce_micro_cluster_linkage(normalized_data)
+        else:
+            logging.info('Building the Ward linkage')
+            linkage_matrix = SpotifyUser.produce_linkage_matrix(normalized_data)
+        if caching:
+            store.put_array(linkage_key, linkage_matrix, version_metadata)
+            if large_library:
+                store.put_array(micro_labels_key, micro_labels.astype(np.int32), version_metadata)
+    else:
+        logging.info('Reusing the stored Ward linkage')
+
+    #imported here so processes that never cluster do not load scipy
+    from scipy.cluster.hierarchy import cut_tree
+
+    #one cut_tree call produces the labels for every supported size at once
+    cut_sizes = list(SUPPORTED_CLUSTER_SIZES) + ([] if clusters in SUPPORTED_CLUSTER_SIZES else [clusters])
+    cut_labels = cut_tree(linkage_matrix, n_clusters=cut_sizes).astype(np.int16)
+    if large_library:
+        cut_labels = cut_labels[micro_labels]
+    if caching:
+        store.put_array(labels_key, cut_labels[:, :len(SUPPORTED_CLUSTER_SIZES)], version_metadata)
+
+    return cut_labels[:, cut_sizes.index(clusters)]
+
+
 
+def hash_track_ids(track_ids):
+    """
     Returns:
-        numpy array: normalized data to pass to clustering algorithm
+        np.ndarray: sorted, stable 64-bit hashes of the track ids, a compact stand-in for the library's track list
     """
+    return np.sort(np.array([int.from_bytes(hashlib.blake2b(str(track_id).encode(), digest_size=8).digest(), 'little', signed=True) for track_id in track_ids], dtype=np.int64))
+
 
-    #mostly logging for debugging purposes later. For around 2500 tracks it takes around 50s 
-    logging.info('Timing how long data collection and storing takes')
-    start_time = time.time()
-    aggregated_audio_features = user.collect_data()
-    logging.info(f'The elapsed time is {time.time() - start_time} seconds')
-    user_prepped_data = user.prepare_data_for_clustering(aggregated_audio_features)
 
-    normalized_data = SpotifyUser.normalize_prepped_data(user_prepped_data)
-    return normalized_data
+def library_change_fraction(previous_hashes, current_hashes):
+    """
+    Returns:
+        float: share of tracks added or removed between two libraries (0 when identical, 1 when disjoint)
+    """
+    union_size = len(np.union1d(previous_hashes, current_hashes))
+    if union_size == 0:
+        return 0.0
+    return 1 - len(np.intersect1d(previous_hashes, current_hashes, assume_unique=True)) / union_size
 
 
 
-def execute_clustering(algorithm, clusters, normalized_data):
+def get_kmeans_labels(clusters, normalized_data, store=None, user_id=None):
+    """
+    clusters the data with a KMeansEngine
+
+    The fitted centroids are stored under the user's prefix along with hashes of the library's track ids. When the library has changed by at most KMEANS_WARM_START_MAX_CHANGE since, the next fit warm-starts from those centroids
+
+    Args:
+        clusters (int): number of clusters
+        normalized_data (DataFrame): prepared and normalized data
+        store (ArtifactStore, optional): where to keep the centroids; nothing is stored without it and user_id
+        user_id (str, optional)
+
+    Returns:
+        tuple: cluster label of every row of normalized_data, and the fitted KMeansEngine
+    """
+    caching = store is not None and user_id is not None
+    columns_metadata = {'columns': ','.join(map(str, normalized_data.columns))}
+    centroids_key = f'{user_id}/kmeans_centroids_{clusters}.npy'
+    track_hashes_key = f'{user_id}/kmeans_track_hashes_{clusters}.npy'
+    track_hashes = hash_track_ids(normalized_data.index)
+
+    initial_centroids = None
+    if caching:
+        previous_hashes = store.get_array(track_hashes_key)
+        if previous_hashes is not None and library_change_fraction(previous_hashes, track_hashes) <= KMEANS_WARM_START_MAX_CHANGE:
+            initial_centroids = store.get_array(centroids_key, columns_metadata)
+
+    engine = KMeansEngine(clusters, initial_centroids=initial_centroids)
+    cluster_labels = engine.fit(normalized_data)
+
+    if caching:
+        store.put_many([(centroids_key, array_to_npy_bytes(engine.cluster_centers_), columns_metadata), (track_hashes_key, array_to_npy_bytes(track_hashes), None)])
+
+    return cluster_labels, engine
+
+
+
+def choose_cluster_count(normalized_data):
+    """
+    picks the number of clusters with the lowest Davies-Bouldin score from a parallel, early-stopping k-means sweep over AUTO_CLUSTER_RANGE
+
+    Args:
+        normalized_data (DataFrame): prepared and normalized data
+
+    Returns:
+        int: chosen number of clusters
+    """
+    sweep = KSweep(AUTO_CLUSTER_RANGE)
+    with timed('choose_clusters'):
+        sweep.run(normalized_data)
+    chosen_clusters = sweep.best_k()
+    logging.info(f'Chose {chosen_clusters} clusters after sweeping k={sorted(sweep.davies_bouldin_scores)}')
+    return chosen_clusters
+
+
+
+def execute_clustering(algorithm, clusters, normalized_data, store=None, user_id=None):
     """
     executes clustering with given algorithms, data, and clusters
 
@@ -291,45 +638,87 @@ def execute_clustering(algorithm, clusters, normalized_data):
         algorithm (str): must be 'kmeans' or 'agglomerative hierarchical' when lowercased 
         clusters (int): number of clusters to pass to algorithm
         normalized_data (array-like): prepared and normalized data to cluster
+        store (ArtifactStore, optional): where the agglomerative linkage and k-means centroids are kept for the user
+        user_id (str, optional): user whose prefix holds them
 
     Raises:
         AssertionError: if the algorithm passed is not valid; this will be deprecated soon 
 
     Returns:
-        DataFrame: labelled data after clustering
+        tuple: DataFrame of labelled data after clustering, and the centroids (DataFrame indexed by label) when the algorithm produced them, otherwise None
     """
     try:
         assert algorithm.lower() in ['kmeans', 'agglomerative hierarchical']
         labelled_data = normalized_data.copy()
+        centroids = None
         if algorithm.lower() == 'kmeans':
-            model = KMeans(clusters)
-            model.fit(normalized_data)
-            cluster_labels = model.labels_
+            cluster_labels, engine = get_kmeans_labels(clusters, normalized_data, store, user_id)
             labelled_data['Label'] = cluster_labels
+            centroids = SpotifyUser.collect_centroids(labelled_data, clustering_engine=engine)
         elif algorithm.lower() == 'agglomerative hierarchical':
             logging.info('Working with agglomerative hierarchical')
-            linkage_matrix = SpotifyUser.produce_linkage_matrix(normalized_data)
-            agglomerative_labels = cut_tree(linkage_matrix,clusters)
-            labelled_data['Label'] = agglomerative_labels
-        return labelled_data
+            labelled_data['Label'] = get_agglomerative_labels(clusters, normalized_data, store, user_id)
+        return labelled_data, centroids
     except AssertionError:
         raise AssertionError('Algorithm passed is NOT either kmeans or agglomerative hierarchical')
 
 
 
 
-def prepare_playlists(user,labelled_data):
+def prepare_playlists(user,labelled_data, centroids=None):
     """
     prepares the user's playlists for upload and display
 
     Args:
         user (SpotifyUser)
         labelled_data (DataFrame or array-like)
+        centroids (DataFrame, optional): centroids returned by execute_clustering; computed from the labels if not passed
 
     Returns:
         Dictionary: uploadable playlists in JSON format
     """
-    return user.generate_uploadable_playlists(labelled_data)
+    with timed('centroid_ranking'):
+        return user.generate_uploadable_playlists(labelled_data, centroids)
+
+
+
+#Recent clustering results of the users this process has clustered
+clustering_result_cache = ClusteringResultCache()
+
+
+def cluster_and_prepare_playlists(user, algorithm, clusters, normalized_data, store=None, user_id=None, version=None, result_cache=clustering_result_cache):
+    """
+    execute_clustering followed by prepare_playlists, memoized: a repeat request for the same algorithm and number of clusters on unchanged data returns the cached result without clustering
+
+    Args:
+        user (SpotifyUser)
+        algorithm (str): as for execute_clustering
+        clusters (int): number of clusters
+        normalized_data (DataFrame): prepared and normalized data
+        store (ArtifactStore, optional): passed on to execute_clustering
+        user_id (str, optional): owner of the data; nothing is cached without it
+        version (str, optional): data_version(normalized_data), if the caller already has it
+        result_cache (ClusteringResultCache)
+
+    Returns:
+        tuple: cluster label of every row of normalized_data (np.ndarray), the uploadable playlists, and whether they came from the cache
+    """
+    version = version or data_version(normalized_data)
+    key = result_key(version, algorithm, clusters, KMEANS_SEED, normalized_data.columns)
+    if user_id is not None:
+        cached_result = result_cache.get(key)
+        if cached_result is not None:
+            logging.info(f'Reusing the cached {algorithm} result with {clusters} clusters')
+            labels, prepared_playlists = cached_result
+            return labels, prepared_playlists, True
+
+    with timed('clustering'):
+        labelled_data, centroids = execute_clustering(algorithm, clusters, normalized_data, store, user_id)
+    labels = labelled_data['Label'].to_numpy()
+    prepared_playlists = prepare_playlists(user, labelled_data, centroids)
+    if user_id is not None:
+        result_cache.put(user_id, key, version, labels, prepared_playlists)
+    return labels, prepared_playlists, False
 
 
 def get_cluster_playlist_metadata(clustered_tracks:dict):
@@ -358,38 +747,77 @@ def get_cluster_playlist_metadata(clustered_tracks:dict):
     return total_organized_playlist_data
 
 
-def get_displayable_tracks_metadata(authorization_header,track_ids):
+#Keep-alive session shared by every display metadata lookup in this process
+display_session = requests.Session()
+display_session.mount('https://', HTTPAdapter(pool_connections=TRACKS_LOOKUP_WORKERS, pool_maxsize=TRACKS_LOOKUP_WORKERS))
+display_session.mount('http://', HTTPAdapter(pool_connections=TRACKS_LOOKUP_WORKERS, pool_maxsize=TRACKS_LOOKUP_WORKERS))
+
+#Display metadata per track id, reused across page views for a few hours
+track_metadata_cache = TrackMetadataCache()
+
+
+def fetch_tracks_metadata_batch(authorization_header, track_ids):
     """
-    get the relevant metadata for the tracks that will be displayed on the page
+    look up a single batch of at most TRACKS_LOOKUP_BATCH_SIZE tracks
 
     Args:
         authorization_header (dict): valid authorization header
-        track_ids (list): list of track_ids to get data for
+        track_ids (list): track ids to look up
 
     Returns:
-        Dictionary: relevant tracks and their metadata in JSON format
+        Dictionary: track ids mapped to their displayable metadata. Tracks Spotify no longer knows are left out
     """
-    track_ids_string = ','.join(track_ids)
-    query_params = f'?ids={track_ids_string}'
-    retrieved_metadata = requests.get(f'https://api.spotify.com/v1/tracks{query_params}', headers=authorization_header).json()
-
-    total_track_metadata = []
-
-    for track_data in retrieved_metadata['tracks']:
+    with timed('tracks_lookup_batch'):
+        response = display_session.get(f'{SPOTIFY_API_URL}/tracks', params={'ids': ','.join(track_ids)}, headers=authorization_header)
+    count_spotify_request('get', f'{SPOTIFY_API_URL}/tracks', response.status_code)
+    assert response.status_code == 200, f'Tracks lookup failed with status {response.status_code}'
+
+    batch_metadata = {}
+    for track_id, track_data in zip(track_ids, response.json()['tracks']):
+        if track_data is None:
+            continue
         # i just need the name and the album cover and url to play
         track_name = track_data['name']
         artists = ' / '.join([artist['name'] for artist in track_data['artists']])
         playable_url = track_data['external_urls']['spotify']
-        album_cover_url = track_data['album']['images'][0]['url']
-        track_metadata = {'name': track_name, 'playable_url':playable_url, 'album_cover_url':album_cover_url, 'artists':artists}
-        total_track_metadata.append(track_metadata)
-    
-    return dict(zip(track_ids,total_track_metadata))
+        album_images = track_data['album']['images']
+        album_cover_url = album_images[0]['url'] if album_images else ''
+        batch_metadata[track_id] = {'name': track_name, 'playable_url':playable_url, 'album_cover_url':album_cover_url, 'artists':artists}
+    return batch_metadata
+
+
+def get_displayable_tracks_metadata(authorization_header, track_ids, metadata_cache=track_metadata_cache):
+    """
+    get the relevant metadata for the tracks that will be displayed on the page. Cached tracks are served from metadata_cache; the rest are looked up in concurrent batches of TRACKS_LOOKUP_BATCH_SIZE
+
+    Args:
+        authorization_header (dict): valid authorization header
+        track_ids (list): list of track_ids to get data for
+        metadata_cache (TrackMetadataCache): cache to read and fill, or None to always ask Spotify
+
+    Returns:
+        Dictionary: relevant tracks and their metadata in JSON format
+    """
+    unique_track_ids = list(dict.fromkeys(track_ids))
+    total_track_metadata = metadata_cache.get_many(unique_track_ids) if metadata_cache is not None else {}
+
+    missing_track_ids = [track_id for track_id in unique_track_ids if track_id not in total_track_metadata]
+    batches = [missing_track_ids[start:start + TRACKS_LOOKUP_BATCH_SIZE] for start in range(0, len(missing_track_ids), TRACKS_LOOKUP_BATCH_SIZE)]
+    logging.info(f'{len(unique_track_ids) - len(missing_track_ids)} displayable tracks cached, looking up {len(missing_track_ids)} in {len(batches)} batches')
+
+    if batches:
+        with ThreadPoolExecutor(max_workers=min(TRACKS_LOOKUP_WORKERS, len(batches))) as executor:
+            for batch_metadata in executor.map(propagate_timings(lambda batch: fetch_tracks_metadata_batch(authorization_header, batch)), batches):
+                total_track_metadata.update(batch_metadata)
+                if metadata_cache is not None:
+                    metadata_cache.put_many(batch_metadata)
+
+    return {track_id: total_track_metadata[track_id] for track_id in track_ids if track_id in total_track_metadata}
 
 
 def organize_cluster_data_for_display(authorization_header,clustered_tracks):
     """
-    collects and organizes relevant metadata to pass to templates for rendering
+    collects and organizes relevant metadata to pass to templates for rendering. The displayable tracks of every cluster are looked up together and then split back out per cluster
 
     Args:
         authorization_header (dict): valid authorization header
@@ -400,10 +828,149 @@ def organize_cluster_data_for_display(authorization_header,clustered_tracks):
     """
     total_organized_playlist_data = get_cluster_playlist_metadata(clustered_tracks)
 
+    all_displayable_tracks = [track_id for data in total_organized_playlist_data.values() for track_id in data['displayable_tracks']]
+    tracks_metadata = get_displayable_tracks_metadata(authorization_header, all_displayable_tracks)
+
     displayable_data = {}
 
     for playlist_id, data in total_organized_playlist_data.items():
-        tracks_metadata = get_displayable_tracks_metadata(authorization_header, data['displayable_tracks'])
-        displayable_data[playlist_id] = tracks_metadata
+        displayable_data[playlist_id] = {track_id: tracks_metadata[track_id] for track_id in data['displayable_tracks'] if track_id in tracks_metadata}
     
     return displayable_data, total_organized_playlist_data
+
+
+
+#Most results artifacts a process keeps after reading them; the least recently read are dropped first
+RESULTS_ARTIFACT_CACHE_ENTRIES = 64
+
+#Latest results artifact read per key in this process, with the ETag it was read at, least recently read first
+results_artifact_cache = OrderedDict()
+results_artifact_cache_lock = threading.Lock()
+
+
+def build_results_artifact(authorization_header, clustered_tracks, chosen_algorithm, chosen_clusters, clustering_id=None):
+    """
+    build the payload the clustering results page renders, once, so page views do not rebuild it
+
+    Args:
+        authorization_header (dict): valid authorization header
+        clustered_tracks (dict): cluster IDs mapped to the tracks in their cluster
+        chosen_algorithm (str): algorithm the clusters were made with
+        chosen_clusters (int): number of clusters
+        clustering_id (str, optional): ClusteringID of the clustering in the Clusterings table
+
+    Returns:
+        Dictionary: the display payload, its content hash, the clustering id and when it was built
+    """
+    displayable_data, total_organized_playlist_data = organize_cluster_data_for_display(authorization_header, clustered_tracks)
+    payload = {'displayable_data': displayable_data, 'total_organized_playlist_data': total_organized_playlist_data,
+               'chosen_algorithm': chosen_algorithm, 'chosen_clusters': chosen_clusters}
+    #round trip through JSON so the artifact looks the same whether it was just built or read back (cluster ids become strings). The order is kept, since the page lists each cluster's tracks closest to the centroid first; only the hashed bytes have sorted keys
+    artifact = json.loads(json.dumps(payload))
+    artifact['format'] = RESULTS_ARTIFACT_FORMAT
+    artifact['content_hash'] = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:32]
+    artifact['clustering_id'] = clustering_id
+    artifact['created_at'] = int(time.time())
+    return artifact
+
+
+def upload_results_artifact(store, user_id:str, artifact:dict):
+    """
+    store a user's results artifact, tagged with its content hash
+    """
+    store.put_json(f'{user_id}/{RESULTS_ARTIFACT_NAME}', artifact, {'content-hash': artifact['content_hash']})
+    logging.info(f"stored results artifact {artifact['content_hash']} for {user_id}")
+
+
+def read_results_artifact(store, user_id:str):
+    """
+    read a user's latest results artifact. A copy read earlier by this process is reused when the store reports it unchanged, so repeat reads transfer no body
+
+    Returns:
+        Dictionary: the artifact, or None if there is none or it has an older layout
+    """
+    key = f'{user_id}/{RESULTS_ARTIFACT_NAME}'
+    with results_artifact_cache_lock:
+        cached = results_artifact_cache.get(key)
+    stored = store.get(key, if_none_match=cached[0] if cached is not None else None)
+    if stored is NOT_MODIFIED:
+        with results_artifact_cache_lock:
+            if key in results_artifact_cache:
+                results_artifact_cache.move_to_end(key)
+        return cached[1]
+    if stored is None:
+        return None
+
+    artifact = json.loads(decode_json_body(stored.body))
+    if artifact.get('format') != RESULTS_ARTIFACT_FORMAT:
+        return None
+    if stored.etag:
+        with results_artifact_cache_lock:
+            results_artifact_cache[key] = (stored.etag, artifact)
+            results_artifact_cache.move_to_end(key)
+            while len(results_artifact_cache) > RESULTS_ARTIFACT_CACHE_ENTRIES:
+                results_artifact_cache.popitem(last=False)
+    return artifact
+
+
+
+def find_published_clusters(db_pool, user_id, clustering_id, algorithm, clusters):
+    """
+    look up the playlists the user's clusters are already published to, from this clustering or an earlier one with the same algorithm and number of clusters. When several earlier clusterings published the same cluster, the most recently published playlist is the one returned
+
+    Args:
+        db_pool (DBConnectionPool)
+        user_id (str)
+        clustering_id (str): the current clustering; its own deployments take precedence
+        algorithm (str)
+        clusters (int)
+
+    Returns:
+        dict: cluster id (int) to (playlist id, clustering id it was last published for)
+    """
+    with db_pool.connection() as db_connection, db_connection.cursor() as cursor:
+        cursor.execute('SELECT DeployedClusters.ClusterID, DeployedClusters.PlaylistID, DeployedClusters.ClusteringID FROM DeployedClusters '
+                       'LEFT JOIN Clusterings ON DeployedClusters.ClusteringID = Clusterings.ClusteringID '
+                       'WHERE DeployedClusters.ClusteringID=%s OR (Clusterings.SpotifyID=%s AND Clusterings.ClusterAlgorithm=%s AND Clusterings.ClustersChosen=%s) '
+                       'ORDER BY DeployedClusters.ClusteringID=%s, DeployedClusters.DeployedAt, DeployedClusters.PlaylistID;', (clustering_id, user_id, algorithm, clusters, clustering_id))
+        rows = cursor.fetchall()
+    #rows of the current clustering come last, and the newest of the earlier ones after the rest, so they win
+    return {int(cluster_id): (playlist_id, published_clustering_id) for cluster_id, playlist_id, published_clustering_id in rows}
+
+
+def record_published_clusters(db_pool, clustering_id, playlist_ids):
+    """
+    record in DeployedClusters which playlist each cluster of a clustering is published to. A playlist brought up to date for a newer clustering keeps its row, now pointing at the newer one and dated with this deployment
+
+    Args:
+        db_pool (DBConnectionPool)
+        clustering_id (str)
+        playlist_ids (dict): cluster id to playlist id
+    """
+    deployed_at = time.time()
+    insertable_values = [(playlist_id, clustering_id, str(cluster_id), deployed_at) for cluster_id, playlist_id in playlist_ids.items()]
+    with db_pool.connection() as db_connection:
+        with db_connection.cursor() as cursor:
+            cursor.executemany('INSERT INTO DeployedClusters(PlaylistID,ClusteringID,ClusterID,DeployedAt) VALUES(%s,%s,%s,%s) '
+                               'ON DUPLICATE KEY UPDATE ClusteringID=VALUES(ClusteringID), ClusterID=VALUES(ClusterID), DeployedAt=VALUES(DeployedAt);', insertable_values)
+        db_connection.commit()
+
+
+def store_published_tracks(store, user_id:str, playlist_tracks:dict):
+    """
+    remember the tracks each playlist was just published with, so a later update only sends what changed
+
+    Args:
+        playlist_tracks (dict): playlist id to its track ids, in playlist order
+    """
+    for playlist_id, track_ids in playlist_tracks.items():
+        store.put_json(f'{user_id}/{PUBLISHED_TRACKS_FOLDER}/{playlist_id}.json', track_ids)
+
+
+def read_published_tracks(store, user_id:str, playlist_ids:list):
+    """
+    Returns:
+        dict: playlist id to the track ids it was last published with, or None if they were not recorded
+    """
+    stored = store.get_many([f'{user_id}/{PUBLISHED_TRACKS_FOLDER}/{playlist_id}.json' for playlist_id in playlist_ids])
+    return {playlist_id: json.loads(decode_json_body(stored_object.body)) if stored_object is not None else None for playlist_id, stored_object in zip(playlist_ids, stored.values())}
@@ -0,0 +1,17 @@
+"""
+worker.py
+
+Runs queued jobs (see jobs.py) outside the web request workers. uWSGI starts it as mules (see uwsgi.ini); it can also be run by hand with python worker.py
+"""
+import logging, threading
+from main import job_queue, JOB_WORKER_THREADS
+
+#the web app defers the clustering libraries (see scripts/new_user.py); every job needs them, so load them before taking the first one
+import sklearn.cluster, sklearn.metrics, scipy.cluster.hierarchy  # noqa: F401
+
+
+logging.info(f'Starting {JOB_WORKER_THREADS} job worker threads')
+job_queue.start_worker_threads(JOB_WORKER_THREADS)
+
+#the worker threads are daemons, so keep this process alive for them
+threading.Event().wait()
@@ -0,0 +1,58 @@
+'''
+bench_artifact_store.py
+
+Measures what the artifact store saves per upload, offline:
+
+- constructing an S3 client for every call (what the old upload/read helpers did) against reusing one pooled client; no request is sent, so this is pure client construction cost
+- writing a clustering's worth of artifacts to a LocalArtifactStore one by one against put_many, and gzip-compressed JSON size against plain JSON
+
+Usage (from the repository root):
+    python benchmarks/bench_artifact_store.py --clients 50 --artifacts 40
+'''
+import argparse, json, os, sys, tempfile, time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import boto3
+from storage import LocalArtifactStore, S3ArtifactStore, array_to_npy_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type = int, default = 50, help = 'number of per-call clients to construct')
+    parser.add_argument('--artifacts', type = int, default = 40)
+    parser.add_argument('--tracks', type = int, default = 20000)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    for _ in range(args.clients):
+        boto3.client('s3', region_name = 'us-west-2')
+    per_call = (time.perf_counter() - start_time) / args.clients
+    start_time = time.perf_counter()
+    S3ArtifactStore('radial-web-app-data')
+    pooled = time.perf_counter() - start_time
+    print(f'client per call: {per_call * 1000:.1f}ms per upload; pooled store: {pooled * 1000:.1f}ms once per process')
+
+    rng = np.random.default_rng(420)
+    items = [(f'bench_user/artifact_{index}.npy', array_to_npy_bytes(rng.random((args.tracks // args.artifacts, 10))), {'data-version': 'bench'}) for index in range(args.artifacts)]
+    with tempfile.TemporaryDirectory() as serial_root, tempfile.TemporaryDirectory() as concurrent_root:
+        serial_store, concurrent_store = LocalArtifactStore(serial_root), LocalArtifactStore(concurrent_root)
+        start_time = time.perf_counter()
+        for item in items:
+            serial_store.put(*item)
+        serial_elapsed = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        concurrent_store.put_many(items)
+        concurrent_elapsed = time.perf_counter() - start_time
+        assert all(np.array_equal(serial_store.get_array(key), concurrent_store.get_array(key)) for key, _, _ in items)
+        print(f'{args.artifacts} local puts: one by one {serial_elapsed * 1000:.1f}ms, put_many {concurrent_elapsed * 1000:.1f}ms')
+
+        snapshots = {f'playlist{index:05d}': {'snapshot_id': f'snapshot-{index}', 'name': f'Playlist {index}', 'track_ids': [f'{track:022d}' for track in rng.integers(0, 10 ** 12, 200)]} for index in range(100)}
+        concurrent_store.put_json('bench_user/playlist_snapshots.json', snapshots)
+        compressed_size = os.path.getsize(os.path.join(concurrent_root, 'bench_user', 'playlist_snapshots.json'))
+        assert concurrent_store.get_json('bench_user/playlist_snapshots.json') == snapshots
+        print(f'playlist snapshots: {len(json.dumps(snapshots).encode()) / 1024:.0f}KiB as JSON, {compressed_size / 1024:.0f}KiB gzipped')
+
+
+if __name__ == '__main__':
+    main()
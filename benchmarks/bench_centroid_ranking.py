@@ -0,0 +1,77 @@
+'''
+bench_centroid_ranking.py
+
+Compares SpotifyUser.generate_uploadable_playlists with the previous per-track iterrows() implementation on synthetic clustered libraries, and checks both produce the same playlists.
+
+Usage (from the repository root):
+    python benchmarks/bench_centroid_ranking.py --sizes 1000 10000 100000 --clusters 13
+'''
+import argparse, os, sys, time
+import numpy as np, pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from scripts import SpotifyUser
+
+
+FEATURES = ["danceability", "energy", "loudness", "speechiness", "acousticness", "instrumentalness", "liveness", "valence", "tempo", "duration_ms"]
+
+
+def legacy_organize_by_centroid_distance(labelled_cluster_data):
+    #the implementation this benchmark replaced, kept verbatim for comparison
+    cluster_data_centroids = labelled_cluster_data.groupby('Label').mean()
+    euclidean_distance_formula = lambda ser1, ser2: ((ser2 - ser1)**2).sum()
+    centroid_distances = []
+    for _, track_data in labelled_cluster_data.iterrows():
+        cluster_label = track_data['Label']
+        cluster_centroid = cluster_data_centroids.loc[cluster_label]
+        relevant_data = track_data.drop(['Label'])
+        calculated_distance = euclidean_distance_formula(relevant_data,cluster_centroid)
+        centroid_distances.append(calculated_distance)
+    labelled_cluster_data.loc[:,'Distance to Centroid'] = centroid_distances
+    return labelled_cluster_data.sort_values(by='Distance to Centroid', kind='stable')
+
+
+def legacy_generate_uploadable_playlists(labelled_data):
+    uploadable_playlists = {}
+    for label in set(labelled_data['Label']):
+        cluster_data = legacy_organize_by_centroid_distance(labelled_data[labelled_data['Label'] == label].copy())
+        uploadable_playlists[label] = list(cluster_data.index)
+    return uploadable_playlists
+
+
+def synthetic_labelled_data(size, clusters, seed = 420):
+    rng = np.random.default_rng(seed)
+    labelled_data = pd.DataFrame(rng.random((size, len(FEATURES))), columns = FEATURES, index = [f'track{index:07d}' for index in range(size)])
+    labelled_data['Label'] = rng.integers(0, clusters, size)
+    return labelled_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000, 100000])
+    parser.add_argument('--clusters', type = int, default = 13)
+    parser.add_argument('--legacy-limit', type = int, default = 100000, help = 'skip the slow legacy path above this many tracks')
+    args = parser.parse_args()
+
+    user = SpotifyUser('bench_user')
+    for size in args.sizes:
+        labelled_data = synthetic_labelled_data(size, args.clusters)
+
+        start_time = time.perf_counter()
+        vectorized = user.generate_uploadable_playlists(labelled_data)
+        vectorized_elapsed = time.perf_counter() - start_time
+
+        if size > args.legacy_limit:
+            print(f'tracks={size:<7} vectorized={vectorized_elapsed:.3f}s legacy=skipped')
+            continue
+
+        start_time = time.perf_counter()
+        legacy = legacy_generate_uploadable_playlists(labelled_data)
+        legacy_elapsed = time.perf_counter() - start_time
+
+        assert vectorized == legacy, f'orderings differ at {size} tracks'
+        print(f'tracks={size:<7} vectorized={vectorized_elapsed:.3f}s legacy={legacy_elapsed:.3f}s speedup={legacy_elapsed / vectorized_elapsed:.0f}x')
+
+
+if __name__ == '__main__':
+    main()
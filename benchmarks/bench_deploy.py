@@ -0,0 +1,77 @@
+'''
+bench_deploy.py
+
+Publishes a clustering's worth of cluster playlists to the local fake Spotify server, one cluster after another (deploy_single_cluster_playlist per cluster, the old behaviour) against all at once (deploy_cluster_playlists), and checks that every playlist holds its tracks in order. It then publishes again while the server fails some requests with 503s, resuming from the recorded deployment state after each failure, and checks that the resumed playlists are complete and that no playlist was created twice.
+
+Usage (from the repository root):
+    python benchmarks/bench_deploy.py --clusters 13 --tracks 20000 --latency 0.05
+'''
+import argparse, os, random, sys, time
+
+from fake_spotify import FakeSpotifyServer, SyntheticLibrary
+
+
+def build_user(library, concurrency):
+    from scripts import Contacter, SpotifyUser
+    contacter = Contacter()
+    contacter.formAccessHeaderfromToken('fake-token')
+    return SpotifyUser(library.user_id, contacter = contacter, max_concurrent_requests = concurrency)
+
+
+def check_playlists(library, cluster_playlists, playlist_ids):
+    for cluster_id, track_ids in cluster_playlists.items():
+        assert library.playlists[playlist_ids[cluster_id]]['tracks'] == track_ids, f'cluster {cluster_id} was not published in order'
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clusters', type = int, default = 13)
+    parser.add_argument('--tracks', type = int, default = 20000, help = 'tracks across every cluster')
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'simulated seconds per request')
+    parser.add_argument('--concurrency', type = int, default = 8)
+    parser.add_argument('--error-rate', type = float, default = 0.02, help = 'fraction of requests answered with 503 in the resume run')
+    args = parser.parse_args()
+
+    rng = random.Random(420)
+    track_ids = [f'track{index:07d}' for index in range(args.tracks)]
+    labels = [rng.randrange(args.clusters) for _ in track_ids]
+    cluster_playlists = {cluster_id: [track_id for track_id, label in zip(track_ids, labels) if label == cluster_id] for cluster_id in range(args.clusters)}
+
+    library = SyntheticLibrary(playlist_count = 0)
+    with FakeSpotifyServer(library, latency = args.latency) as server:
+        #the scripts package reads the API url at import time
+        os.environ['SPOTIFY_API_URL'] = server.api_url
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+        user = build_user(library, args.concurrency)
+        start_time = time.perf_counter()
+        serial_ids = {cluster_id: user.deploy_single_cluster_playlist(tracks, cluster_id + 1, 'Bench').playlist_id for cluster_id, tracks in cluster_playlists.items()}
+        serial_elapsed = time.perf_counter() - start_time
+        check_playlists(library, cluster_playlists, serial_ids)
+
+        requests_before = server.request_count
+        start_time = time.perf_counter()
+        concurrent_ids = user.deploy_cluster_playlists(cluster_playlists, 'Bench')
+        concurrent_elapsed = time.perf_counter() - start_time
+        check_playlists(library, cluster_playlists, concurrent_ids)
+        print(f'one at a time: {serial_elapsed:.2f}s; all at once: {concurrent_elapsed:.2f}s ({server.request_count - requests_before} requests, {serial_elapsed / concurrent_elapsed:.1f}x faster)')
+
+        server.error_rate = args.error_rate
+        created_before = server.created_playlists
+        deployment_state, attempts = {}, 0
+        while True:
+            attempts += 1
+            try:
+                resumed_ids = user.deploy_cluster_playlists(cluster_playlists, 'Bench', deployment_state)
+                break
+            except AssertionError:
+                confirmed = sum(cluster_state['tracks_added'] for cluster_state in deployment_state.values())
+                print(f'  attempt {attempts} failed with {confirmed} of {args.tracks} tracks confirmed; resuming')
+        check_playlists(library, cluster_playlists, resumed_ids)
+        created = server.created_playlists - created_before
+        assert created == args.clusters, f'{created} playlists were created for {args.clusters} clusters'
+        print(f'with {server.error_count} injected 503s: complete after {attempts} attempts, {created} playlists created for {args.clusters} clusters')
+
+
+if __name__ == '__main__':
+    main()
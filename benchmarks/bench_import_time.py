@@ -0,0 +1,53 @@
+'''
+bench_import_time.py
+
+Measures how long a fresh process takes to import the web app (main.py), which is what every uWSGI worker paid before it could serve a request when the app was not preloaded. Each import runs in its own subprocess, offline: artifacts go to a temporary directory, jobs to a temporary SQLite file, and no secret is resolved at import, so neither AWS nor a database is needed. It also reports which of the clustering libraries the import loaded and how long importing those libraries alone takes, i.e. what the first clustering job in a process pays.
+
+Usage (from the repository root):
+    python benchmarks/bench_import_time.py --runs 5
+'''
+import argparse, json, os, statistics, subprocess, sys, tempfile
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+#Modules the web app should only load on the clustering path
+CLUSTERING_MODULES = ('sklearn', 'scipy', 'matplotlib')
+
+IMPORT_APP = '''
+import json, sys, time
+start_time = time.perf_counter()
+import main
+print(json.dumps({'seconds': time.perf_counter() - start_time, 'loaded': [name for name in %r if name in sys.modules]}))
+''' % (CLUSTERING_MODULES,)
+
+IMPORT_CLUSTERING = '''
+import json, time
+import numpy, pandas
+start_time = time.perf_counter()
+import sklearn.cluster, sklearn.metrics, sklearn.preprocessing, scipy.cluster.hierarchy, matplotlib.pyplot
+print(json.dumps({'seconds': time.perf_counter() - start_time, 'loaded': []}))
+'''
+
+
+def run_once(code, env):
+    completed = subprocess.run([sys.executable, '-c', code], cwd = APP_DIR, env = env, capture_output = True, text = True, check = True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type = int, default = 5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = dict(os.environ, RADIAL_STORAGE_DIR = os.path.join(temp_dir, 'artifacts'), RADIAL_JOBS_DB = os.path.join(temp_dir, 'jobs.sqlite3'))
+        for label, code in (('import main', IMPORT_APP), ('clustering libraries', IMPORT_CLUSTERING)):
+            results = [run_once(code, env) for _ in range(args.runs)]
+            timings = [result['seconds'] for result in results]
+            print(f'{label}: median {statistics.median(timings) * 1000:.0f}ms, min {min(timings) * 1000:.0f}ms over {args.runs} runs')
+            if code is IMPORT_APP:
+                print(f'  clustering libraries loaded by the import: {results[0]["loaded"] or "none"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''
+bench_ingestion_memory.py
+
+Compares the memory used to page a whole library in from the local fake Spotify server when every raw page item is kept (the old behaviour, still used when raw items are saved to disk) against streaming ingestion, where each page is reduced to slotted Track objects as it arrives. Each mode runs in its own subprocess so peak RSS is measured independently; tracemalloc reports the Python heap at its peak and what is still held once collection finishes.
+
+Usage (from the repository root):
+    python benchmarks/bench_ingestion_memory.py --playlists 100 --tracks-per-playlist 500
+'''
+import argparse, json, os, resource, subprocess, sys, tracemalloc
+
+from fake_spotify import FakeSpotifyServer, SyntheticLibrary
+
+
+def measure(args):
+    #the scripts package reads the API url at import time
+    os.environ['SPOTIFY_API_URL'] = args.api_url
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+    from scripts import Contacter, Playlist
+
+    library = SyntheticLibrary(playlist_count = args.playlists, tracks_per_playlist = args.tracks_per_playlist)
+    contacter = Contacter()
+    contacter.formAccessHeaderfromToken('fake-token')
+
+    #importing the scripts package (pandas, numpy, ...) dominates RSS, so report growth over it as well
+    import_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    playlists = []
+    for playlist_id, playlist_data in library.playlists.items():
+        playlist = Playlist(playlist_id, playlist_data['name'], keep_raw_items = args.mode == 'raw')
+        playlist.retrieve_playlist_data(contacter, save_file = False)
+        playlists.append(playlist)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'mode': args.mode, 'tracks': sum(len(playlist.tracks) for playlist in playlists), 'retained_mib': retained / 2 ** 20, 'peak_mib': peak / 2 ** 20,
+            'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10, 'rss_growth_mib': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - import_rss) / 2 ** 10}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--playlists', type = int, default = 100)
+    parser.add_argument('--tracks-per-playlist', type = int, default = 500)
+    parser.add_argument('--mode', choices = ['raw', 'streaming'], help = 'measure a single mode in this process (used internally)')
+    parser.add_argument('--api-url', help = 'fake server to collect from (used internally)')
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        print(json.dumps(measure(args)))
+        return
+
+    #the server runs in this process so its own allocations do not count against either mode
+    library = SyntheticLibrary(playlist_count = args.playlists, tracks_per_playlist = args.tracks_per_playlist)
+    results = {}
+    with FakeSpotifyServer(library) as server:
+        for mode in ('raw', 'streaming'):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode, '--api-url', server.api_url, '--playlists', str(args.playlists), '--tracks-per-playlist', str(args.tracks_per_playlist)],
+                                    check = True, capture_output = True, text = True).stdout
+            results[mode] = json.loads(output.strip().splitlines()[-1])
+            result = results[mode]
+            print(f"{mode:<10} tracks={result['tracks']:<7} retained={result['retained_mib']:8.1f}MiB peak heap={result['peak_mib']:8.1f}MiB max RSS={result['max_rss_mib']:8.1f}MiB (+{result['rss_growth_mib']:.1f}MiB after imports)")
+
+    assert results['raw']['tracks'] == results['streaming']['tracks']
+    print(f"retained memory reduced {results['raw']['retained_mib'] / results['streaming']['retained_mib']:.1f}x, RSS growth reduced {results['raw']['rss_growth_mib'] / max(results['streaming']['rss_growth_mib'], 0.1):.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+'''
+bench_large_agglomerative.py
+
+Compares the exact Ward linkage with the micro-cluster mode used for large libraries: time, peak traced memory, and how closely the labels agree (adjusted Rand index). The exact path is skipped above --exact-limit tracks since its memory grows quadratically.
+
+Usage (from the repository root):
+    python benchmarks/bench_large_agglomerative.py --sizes 5000 10000 50000 --clusters 9
+'''
+import argparse, os, sys, time, tracemalloc
+from scipy.cluster.hierarchy import cut_tree
+from sklearn.datasets import make_blobs
+from sklearn.metrics import adjusted_rand_score
+from sklearn.preprocessing import MinMaxScaler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from scripts import SpotifyUser
+
+
+def measure(function, *args):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [5000, 10000, 50000])
+    parser.add_argument('--clusters', type = int, default = 9)
+    parser.add_argument('--exact-limit', type = int, default = 15000)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        #audio features are loosely clustered, so blobs with a wide spread are a fair stand-in
+        features, _ = make_blobs(n_samples = size, n_features = 10, centers = 20, cluster_std = 2.5, random_state = 420)
+        normalized_data = MinMaxScaler().fit_transform(features)
+
+        (linkage_matrix, micro_labels), micro_elapsed, micro_peak = measure(SpotifyUser.produce_micro_cluster_linkage, normalized_data)
+        micro_cut = cut_tree(linkage_matrix, args.clusters)[:, 0][micro_labels]
+        line = f'tracks={size:<7} micro: {micro_elapsed:6.2f}s {micro_peak:8.1f}MiB'
+
+        if size <= args.exact_limit:
+            exact_linkage, exact_elapsed, exact_peak = measure(SpotifyUser.produce_linkage_matrix, normalized_data)
+            exact_cut = cut_tree(exact_linkage, args.clusters)[:, 0]
+            line += f' | exact: {exact_elapsed:6.2f}s {exact_peak:8.1f}MiB | ARI={adjusted_rand_score(exact_cut, micro_cut):.3f}'
+        else:
+            line += ' | exact: skipped'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
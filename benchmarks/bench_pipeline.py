@@ -0,0 +1,168 @@
+'''
+bench_pipeline.py
+
+Runs the whole clustering pipeline offline, against the local fake Spotify server, for synthetic libraries of each size: collecting the library (SpotifyUser.collect_data), preparing it (the rest of utils.prepare_data: building the feature matrix and normalizing it), utils.execute_clustering and utils.prepare_playlists. The server answers with the configured latency and throttles a share of requests with 429s, which the client has to absorb.
+
+Each size runs in its own subprocess, so peak RSS is measured independently and the server's own memory is not counted. For each size the wall time of every stage, the requests sent (retries included) and the peak RSS are reported and compared against the stored baseline. Anything slower, heavier or chattier than the baseline by more than the tolerance is a regression, and the run exits with status 1. Timings depend on the machine, so record a baseline on the machine it will be compared on.
+
+Usage (from the repository root):
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --sizes 1000,10000 --update-baseline
+'''
+import argparse, json, logging, os, resource, subprocess, sys, time
+
+from fake_spotify import FakeSpotifyServer, SyntheticLibrary
+
+
+#Baseline compared against (and written by --update-baseline)
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_pipeline.json')
+
+#Library sizes, in distinct tracks, run by default
+DEFAULT_SIZES = '1000,10000,50000,200000'
+
+#Timed stages, in the order they run
+STAGES = ('collect_data', 'prepare_data', 'execute_clustering', 'prepare_playlists')
+
+#A stage also has to be this many seconds over its allowance to count as a regression, so sub-second stages do not fail on noise
+TIME_SLACK_SECONDS = 0.25
+
+#Requests only vary with the injected faults, so they get a much tighter allowance than time and memory
+REQUEST_TOLERANCE = 0.02
+
+
+def measure(args):
+    #the scripts package reads the API url at import time
+    os.environ['SPOTIFY_API_URL'] = args.api_url
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+    import utils
+    from scripts import Contacter, SpotifyUser
+    from scripts.metrics import StageTimings, collecting_timings
+    #job workers load the clustering libraries before their first job (see worker.py), so do not time their import
+    import sklearn.cluster, sklearn.metrics, scipy.cluster.hierarchy  # noqa: F401
+
+    #the app logs at DEBUG; measure the pipeline, not the log handler
+    logging.disable(logging.INFO)
+    import_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    contacter = Contacter()
+    contacter.formAccessHeaderfromToken('fake-token')
+    user = SpotifyUser(args.user_id, contacter = contacter)
+
+    #prepare_data collects the library itself; its spans split the collection from the preparation
+    timings = StageTimings()
+    with collecting_timings(timings):
+        normalized_data = utils.prepare_data(user)
+    stages = timings.summary()['stages']
+    seconds = {'collect_data': stages['collect_library']['seconds'], 'prepare_data': stages['build_feature_matrix']['seconds'] + stages['normalize']['seconds']}
+
+    start_time = time.perf_counter()
+    labelled_data, centroids = utils.execute_clustering(args.algorithm, args.clusters, normalized_data)
+    seconds['execute_clustering'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    prepared_playlists = utils.prepare_playlists(user, labelled_data, centroids)
+    seconds['prepare_playlists'] = time.perf_counter() - start_time
+
+    assert sum(len(track_ids) for track_ids in prepared_playlists.values()) == len(normalized_data)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'tracks': len(normalized_data), 'seconds': {stage: round(seconds[stage], 3) for stage in STAGES},
+            'max_rss_mib': round(max_rss / 2 ** 10, 1), 'rss_growth_mib': round((max_rss - import_rss) / 2 ** 10, 1)}
+
+
+def run_size(server, library, args):
+    requests_before, throttled_before = server.request_count, server.throttled_count
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', '--api-url', server.api_url, '--user-id', library.user_id, '--algorithm', args.algorithm, '--clusters', str(args.clusters)],
+                               capture_output = True, text = True)
+    if completed.returncode != 0:
+        sys.exit(f'the pipeline failed:\n{completed.stderr[-4000:]}')
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result['requests'] = server.request_count - requests_before
+    result['throttled'] = server.throttled_count - throttled_before
+    return result
+
+
+def find_regressions(results, baseline, tolerance):
+    '''
+    Returns a description of every measurement in results that is worse than its baseline by more than the allowance, and the sizes the baseline has nothing for
+    '''
+    regressions, unmeasured = [], []
+    for size, result in results.items():
+        expected = baseline['sizes'].get(size)
+        if expected is None:
+            unmeasured.append(size)
+            continue
+        for stage in STAGES:
+            allowed = expected['seconds'][stage] * (1 + tolerance) + TIME_SLACK_SECONDS
+            if result['seconds'][stage] > allowed:
+                regressions.append(f"{size} tracks: {stage} took {result['seconds'][stage]:.2f}s against a baseline of {expected['seconds'][stage]:.2f}s")
+        if result['max_rss_mib'] > expected['max_rss_mib'] * (1 + tolerance):
+            regressions.append(f"{size} tracks: peak RSS {result['max_rss_mib']:.0f}MiB against a baseline of {expected['max_rss_mib']:.0f}MiB")
+        if result['requests'] > expected['requests'] * (1 + REQUEST_TOLERANCE):
+            regressions.append(f"{size} tracks: {result['requests']} requests against a baseline of {expected['requests']}")
+    return regressions, unmeasured
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default = DEFAULT_SIZES, help = 'comma-separated numbers of distinct tracks')
+    parser.add_argument('--tracks-per-playlist', type = int, default = 500)
+    parser.add_argument('--latency', type = float, default = 0.01, help = 'simulated seconds per request')
+    parser.add_argument('--throttle-rate', type = float, default = 0.01, help = 'fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type = float, default = 0.05, help = 'Retry-After seconds sent with each 429')
+    parser.add_argument('--algorithm', default = 'KMeans', help = 'KMeans or Agglomerative Hierarchical')
+    parser.add_argument('--clusters', type = int, default = 9)
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'fraction by which a stage may be slower, or peak RSS higher, than the baseline')
+    parser.add_argument('--update-baseline', action = 'store_true', help = 'store these results as the new baseline instead of comparing against it')
+    parser.add_argument('--measure', action = 'store_true', help = 'run the pipeline once in this process (used internally)')
+    parser.add_argument('--api-url', help = 'fake server to collect from (used internally)')
+    parser.add_argument('--user-id', help = 'owner of the library (used internally)')
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args)))
+        return
+
+    settings = {'tracks_per_playlist': args.tracks_per_playlist, 'latency': args.latency, 'throttle_rate': args.throttle_rate, 'retry_after': args.retry_after, 'algorithm': args.algorithm, 'clusters': args.clusters}
+    baseline = None
+    if not args.update_baseline and os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as reader:
+            baseline = json.load(reader)
+        if baseline['settings'] != settings:
+            sys.exit(f"The baseline was recorded with {baseline['settings']}, not {settings}; run with the same settings or pass --update-baseline")
+
+    results = {}
+    for size in args.sizes.split(','):
+        library = SyntheticLibrary(track_count = int(size), tracks_per_playlist = args.tracks_per_playlist)
+        #a fresh server per size so each subprocess starts against an unloaded one
+        with FakeSpotifyServer(library, latency = args.latency, throttle_rate = args.throttle_rate, retry_after = args.retry_after) as server:
+            results[size] = result = run_size(server, library, args)
+        stage_times = ' '.join(f"{stage}={result['seconds'][stage]:.2f}s" for stage in STAGES)
+        print(f"{size:>7} tracks: {stage_times} requests={result['requests']} ({result['throttled']} throttled) max RSS={result['max_rss_mib']:.0f}MiB (+{result['rss_growth_mib']:.0f}MiB after imports)")
+
+    if args.update_baseline:
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as reader:
+                previous_baseline = json.load(reader)
+            #keep the sizes this run skipped, as long as they were measured the same way
+            if previous_baseline['settings'] == settings:
+                results = dict(previous_baseline['sizes'], **results)
+        with open(BASELINE_PATH, 'w') as writer:
+            json.dump({'settings': settings, 'sizes': results}, writer, indent = 2, sort_keys = True)
+        print(f'stored the baseline in {BASELINE_PATH}')
+        return
+
+    if baseline is None:
+        print(f'no baseline at {BASELINE_PATH}; pass --update-baseline to record one')
+        return
+
+    regressions, unmeasured = find_regressions(results, baseline, args.tolerance)
+    if unmeasured:
+        print(f"the baseline has nothing for {', '.join(unmeasured)} tracks")
+    if regressions:
+        print('regressions against the baseline:\n  ' + '\n  '.join(regressions))
+        sys.exit(1)
+    print(f'no regressions against the baseline (tolerance {args.tolerance:.0%})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''
+bench_playlist_fetch.py
+
+Times SpotifyUser.get_all_playlist_information against the local fake Spotify server at several concurrency caps and checks that every run produces the same playlists in the same order.
+
+Usage (from the repository root):
+    python benchmarks/bench_playlist_fetch.py --playlists 100 --tracks-per-playlist 300 --latency 0.02
+'''
+import argparse, os, sys, time
+
+from fake_spotify import FakeSpotifyServer, SyntheticLibrary
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--playlists', type = int, default = 100)
+    parser.add_argument('--tracks-per-playlist', type = int, default = 300)
+    parser.add_argument('--latency', type = float, default = 0.02, help = 'simulated seconds per request')
+    parser.add_argument('--concurrency', type = int, nargs = '+', default = [1, 4, 8, 16])
+    args = parser.parse_args()
+
+    library = SyntheticLibrary(playlist_count = args.playlists, tracks_per_playlist = args.tracks_per_playlist)
+
+    with FakeSpotifyServer(library, latency = args.latency) as server:
+        #the scripts package reads the API url at import time
+        os.environ['SPOTIFY_API_URL'] = server.api_url
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+        from scripts import Contacter, SpotifyUser
+
+        reference = None
+        for concurrency in args.concurrency:
+            contacter = Contacter()
+            contacter.formAccessHeaderfromToken('fake-token')
+            user = SpotifyUser(library.user_id, contacter = contacter, max_concurrent_requests = concurrency)
+
+            requests_before = server.request_count
+            start_time = time.perf_counter()
+            user.get_all_playlist_information(save_file_flag = False)
+            elapsed = time.perf_counter() - start_time
+
+            result = [(playlist_id, [track.id for track in playlist.tracks]) for playlist_id, playlist in user.playlists.items()]
+            if reference is None:
+                reference = result
+            assert result == reference, f'concurrency {concurrency} produced a different result'
+
+            print(f'concurrency={concurrency:<3} requests={server.request_count - requests_before:<6} elapsed={elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
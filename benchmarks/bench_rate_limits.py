@@ -0,0 +1,55 @@
+'''
+bench_rate_limits.py
+
+Fetches a library from the local fake Spotify server while it injects 429s (with Retry-After) and 503s, and checks that the collection still completes with the same playlists as a fault-free run. Prints how many faults were absorbed and where the adaptive concurrency limit settled.
+
+Usage (from the repository root):
+    python benchmarks/bench_rate_limits.py --throttle-rate 0.05 --error-rate 0.05
+'''
+import argparse, os, sys, time
+
+from fake_spotify import FakeSpotifyServer, SyntheticLibrary
+
+
+def collect(library, concurrency):
+    from scripts import Contacter, SpotifyUser
+    contacter = Contacter()
+    contacter.formAccessHeaderfromToken('fake-token')
+    user = SpotifyUser(library.user_id, contacter = contacter, max_concurrent_requests = concurrency)
+    start_time = time.perf_counter()
+    user.get_all_playlist_information(save_file_flag = False)
+    elapsed = time.perf_counter() - start_time
+    return [(playlist_id, [track.id for track in playlist.tracks]) for playlist_id, playlist in user.playlists.items()], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--playlists', type = int, default = 50)
+    parser.add_argument('--tracks-per-playlist', type = int, default = 300)
+    parser.add_argument('--latency', type = float, default = 0.02, help = 'simulated seconds per request')
+    parser.add_argument('--concurrency', type = int, default = 8)
+    parser.add_argument('--throttle-rate', type = float, default = 0.05, help = 'fraction of requests answered with 429')
+    parser.add_argument('--error-rate', type = float, default = 0.05, help = 'fraction of requests answered with 503')
+    parser.add_argument('--retry-after', type = int, default = 1, help = 'Retry-After seconds sent with each 429')
+    args = parser.parse_args()
+
+    library = SyntheticLibrary(playlist_count = args.playlists, tracks_per_playlist = args.tracks_per_playlist)
+
+    with FakeSpotifyServer(library, latency = args.latency, retry_after = args.retry_after) as server:
+        #the scripts package reads the API url at import time
+        os.environ['SPOTIFY_API_URL'] = server.api_url
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+        from scripts.api_contacter import rate_limiter
+
+        reference, clean_elapsed = collect(library, args.concurrency)
+        print(f'fault-free: requests={server.request_count:<6} elapsed={clean_elapsed:.2f}s')
+
+        server.throttle_rate, server.error_rate = args.throttle_rate, args.error_rate
+        requests_before = server.request_count
+        result, faulty_elapsed = collect(library, args.concurrency)
+        assert result == reference, 'the run with injected faults produced different playlists'
+        print(f'faulty:     requests={server.request_count - requests_before:<6} elapsed={faulty_elapsed:.2f}s 429s={server.throttled_count} 503s={server.error_count} limiter={rate_limiter.stats()}')
+
+
+if __name__ == '__main__':
+    main()
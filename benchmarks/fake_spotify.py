@@ -0,0 +1,369 @@
+'''
+fake_spotify.py
+
+A small local stand-in for the parts of the Spotify Web API that Radial uses, including creating and editing playlists. Libraries are generated deterministically from a seed so runs can be compared against each other.
+
+Point the app at it by setting SPOTIFY_API_URL to FakeSpotifyServer.api_url before importing the scripts package.
+'''
+import json, random, threading, time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+#Spotify lists every market a track is available in with each album and track
+MARKETS = ('AD AE AG AL AM AO AR AT AU AZ BA BB BD BE BF BG BH BI BJ BN BO BR BS BT BW BY BZ CA CD CG CH CI CL CM CO CR CV CW CY CZ DE DJ DK DM DO DZ EC EE EG ES FI FJ FM FR GA GB GD GE GH GM GN GQ GR GT GW GY HK HN HR HT HU ID IE IL IN IQ IS IT JM JO JP KE KG KH KI KM KN KR KW KZ LA LB LC LI LK LR LS LT LU LV LY MA MC MD ME '
+           'MG MH MK ML MN MO MR MT MU MV MW MX MY MZ NA NE NG NI NL NO NP NR NZ OM PA PE PG PH PK PL PS PT PW PY QA RO RS RW SA SB SC SE SG SI SK SL SM SN SR ST SV SZ TD TG TH TJ TL TN TO TR TT TV TW TZ UA UG US UY UZ VC VE VN VU WS XK ZA ZM ZW').split()
+
+
+#Share of a playlist's entries that repeat a track found elsewhere in a library built with an exact track_count
+REPEATED_TRACK_SHARE = 0.1
+
+#Characters of encoded playlist pages kept for requests that ask for the same page again, e.g. a benchmark's next run
+PAGE_CACHE_CHARACTERS = 256 * 2 ** 20
+
+#Stand-ins for the track id and duration in the encoded playlist item every item is made from
+TEMPLATE_TRACK_ID = 'templatetrackid'
+TEMPLATE_DURATION_MS = 987654321
+
+
+class EncodedJSON:
+    def __init__(self, text):
+        '''
+        A value already encoded as JSON, spliced into a response as is by encode_json
+        '''
+        self.text = text
+
+
+def encode_json(payload):
+    #json.dumps refuses EncodedJSON, so only the containers holding some are walked by hand
+    if isinstance(payload, EncodedJSON):
+        return payload.text
+    try:
+        return json.dumps(payload)
+    except TypeError:
+        if isinstance(payload, dict):
+            return '{' + ', '.join(f'{json.dumps(str(key))}: {encode_json(value)}' for key, value in payload.items()) + '}'
+        if isinstance(payload, list):
+            return '[' + ', '.join(encode_json(value) for value in payload) + ']'
+        raise
+
+
+class SyntheticLibrary:
+    def __init__(self, user_id = 'bench_user', playlist_count = 50, tracks_per_playlist = 200, seed = 420, track_count = None):
+        '''
+        Builds playlist_count playlists owned by user_id, each holding tracks_per_playlist track ids drawn from a shared pool so that playlists overlap like real libraries do
+
+        track_count = None - if set, the library holds exactly this many distinct tracks instead: each appears in some playlist, and REPEATED_TRACK_SHARE of every playlist's entries repeat tracks from elsewhere. playlist_count is then however many playlists of tracks_per_playlist that takes
+        '''
+        rng = random.Random(seed)
+        self.user_id = user_id
+        pool_size = max(1, playlist_count * tracks_per_playlist * 3 // 4) if track_count is None else track_count
+        track_pool = [f'track{index:07d}' for index in range(pool_size)]
+
+        if track_count is None:
+            playlist_tracks = [[rng.choice(track_pool) for _ in range(tracks_per_playlist)] for _ in range(playlist_count)]
+        else:
+            new_per_playlist = max(1, tracks_per_playlist - int(tracks_per_playlist * REPEATED_TRACK_SHARE))
+            shuffled_pool = rng.sample(track_pool, len(track_pool))
+            playlist_tracks = []
+            for start in range(0, len(shuffled_pool), new_per_playlist):
+                tracks = shuffled_pool[start: start + new_per_playlist] + [rng.choice(track_pool) for _ in range(tracks_per_playlist - new_per_playlist)]
+                rng.shuffle(tracks)
+                playlist_tracks.append(tracks)
+
+        self.playlists = {}
+        for index, tracks in enumerate(playlist_tracks):
+            playlist_id = f'playlist{index:05d}'
+            self.playlists[playlist_id] = {
+                'name': f'Playlist {index}',
+                'snapshot_id': f'snapshot-{playlist_id}-0',
+                'tracks': tracks}
+
+
+class FakeSpotifyServer:
+    def __init__(self, library, latency = 0.0, host = '127.0.0.1', port = 0, throttle_rate = 0.0, error_rate = 0.0, retry_after = 1, seed = 420):
+        '''
+        library - a SyntheticLibrary to serve
+
+        latency = 0.0 - seconds to sleep before answering each request, to imitate the round trip to Spotify
+
+        throttle_rate = 0.0 - fraction of requests answered with 429 and a Retry-After of retry_after seconds
+
+        error_rate = 0.0 - fraction of requests answered with a 503
+
+        Set require_auth to answer 401 to any bearer token not issued by the fake token endpoint (POST /api/token, see token_url) or revoked with expire_tokens
+        '''
+        self.library = library
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.request_count = 0
+        self.throttled_count = 0
+        self.error_count = 0
+        self._fault_rng = random.Random(seed)
+        self.require_auth = False
+        self.valid_tokens = set()
+        self.token_refreshes = 0
+        self.created_playlists = 0
+        self.playlist_edits = 0
+        self._count_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+        self._page_cache = OrderedDict()
+        self._page_cache_characters = 0
+        self._page_cache_lock = threading.Lock()
+        #items differ only in their track id and duration, so one is encoded up front and the rest are filled in from it
+        self._track_item_template = json.dumps(self._track_item(TEMPLATE_TRACK_ID, TEMPLATE_DURATION_MS))
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self):
+        return f'{self.base_url}/v1'
+
+    @property
+    def token_url(self):
+        return f'{self.base_url}/api/token'
+
+    def issue_token(self):
+        with self._count_lock:
+            self.token_refreshes += 1
+            token = f'fake-token-{self.token_refreshes}'
+            self.valid_tokens.add(token)
+        return token
+
+    def expire_tokens(self):
+        with self._count_lock:
+            self.valid_tokens.clear()
+
+    def _authorized(self, authorization):
+        return not self.require_auth or (authorization or '').replace('Bearer ', '', 1) in self.valid_tokens
+
+    def start(self):
+        self.thread = threading.Thread(target = self.httpd.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def _count_request(self):
+        '''
+        Counts the request and decides whether to inject a fault. Returns (status, payload, headers) for an injected fault, else None
+        '''
+        with self._count_lock:
+            self.request_count += 1
+            draw = self._fault_rng.random()
+            if draw < self.throttle_rate:
+                self.throttled_count += 1
+                return 429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, {'Retry-After': str(self.retry_after)}
+            if draw < self.throttle_rate + self.error_rate:
+                self.error_count += 1
+                return 503, {'error': {'status': 503, 'message': 'Service unavailable'}}, {}
+        return None
+
+
+    @staticmethod
+    def _duration_ms(track_id):
+        return 180000 + int(track_id[-4:])
+
+
+    def _encoded_track_item(self, track_id):
+        return EncodedJSON(self._track_item_template.replace(TEMPLATE_TRACK_ID, track_id).replace(str(TEMPLATE_DURATION_MS), str(self._duration_ms(track_id))))
+
+
+    def _track_item(self, track_id, duration_ms):
+        #shaped like a real playlist item, including the bulky market lists and image sets Radial never reads
+        artist = {'external_urls': {'spotify': 'https://open.spotify.com/artist/artist'}, 'href': f'{self.api_url}/artists/artist', 'id': 'artist', 'name': 'artist', 'type': 'artist', 'uri': 'spotify:artist:artist'}
+        images = [{'height': size, 'url': f'https://i.scdn.co/image/{track_id}{size}', 'width': size} for size in (640, 300, 64)]
+        album = {'album_type': 'album', 'artists': [artist], 'available_markets': list(MARKETS), 'external_urls': {'spotify': 'https://open.spotify.com/album/album'}, 'href': f'{self.api_url}/albums/album',
+                 'id': 'album', 'images': images, 'name': 'album', 'release_date': '2021-01-01', 'release_date_precision': 'day', 'total_tracks': 12, 'type': 'album', 'uri': 'spotify:album:album'}
+        track = {'album': album, 'artists': [artist], 'available_markets': list(MARKETS), 'disc_number': 1, 'duration_ms': duration_ms, 'episode': False, 'explicit': False,
+                 'external_ids': {'isrc': f'US{track_id}'}, 'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'}, 'href': f'{self.api_url}/tracks/{track_id}', 'id': track_id,
+                 'is_local': False, 'name': track_id, 'popularity': 50, 'preview_url': f'https://p.scdn.co/mp3-preview/{track_id}', 'track': True, 'track_number': 1, 'type': 'track', 'uri': f'spotify:track:{track_id}'}
+        return {'added_at': '2021-11-01T00:00:00Z', 'added_by': {'id': self.library.user_id, 'type': 'user'}, 'is_local': False, 'primary_color': None, 'track': track, 'video_thumbnail': {'url': None}}
+
+
+    def _track_metadata(self, track_id):
+        return {'id': track_id, 'name': track_id, 'artists': [{'name': 'artist'}], 'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'}, 'album': {'name': 'album', 'images': [{'url': f'https://i.scdn.co/image/{track_id}'}]}}
+
+
+    def _audio_features(self, track_id):
+        rng = random.Random(track_id)
+        return {'id': track_id, 'uri': f'spotify:track:{track_id}', 'danceability': rng.random(), 'energy': rng.random(), 'loudness': -60 * rng.random(), 'speechiness': rng.random(), 'acousticness': rng.random(),
+                'instrumentalness': rng.random(), 'liveness': rng.random(), 'valence': rng.random(), 'tempo': 60 + 140 * rng.random(), 'duration_ms': self._duration_ms(track_id), 'key': rng.randrange(12), 'mode': rng.randrange(2), 'time_signature': 4}
+
+
+    def _paging(self, path, items, offset, limit, transform):
+        #path is the full request path, version prefix included
+        page = items[offset: offset + limit]
+        next_link = f'{self.base_url}{path}?offset={offset + limit}&limit={limit}' if offset + limit < len(items) else None
+        return {'href': f'{self.base_url}{path}', 'items': [transform(item) for item in page], 'limit': limit, 'offset': offset, 'total': len(items), 'next': next_link}
+
+
+    def _cached_page(self, key, build_page):
+        '''
+        Returns the page for key as EncodedJSON, encoding it with build_page() unless it is among the most recently served pages. key must include the playlist's snapshot_id, so an edited playlist is encoded afresh
+        '''
+        with self._page_cache_lock:
+            page = self._page_cache.get(key)
+            if page is not None:
+                self._page_cache.move_to_end(key)
+                return page
+        page = EncodedJSON(encode_json(build_page()))
+        with self._page_cache_lock:
+            if key not in self._page_cache:
+                self._page_cache[key] = page
+                self._page_cache_characters += len(page.text)
+            while self._page_cache_characters > PAGE_CACHE_CHARACTERS:
+                _, evicted_page = self._page_cache.popitem(last = False)
+                self._page_cache_characters -= len(evicted_page.text)
+        return page
+
+
+    def route(self, path, query):
+        '''
+        Returns (status, payload) for a GET to path
+        '''
+        library = self.library
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['100'])[0])
+        parts = path.strip('/').split('/')[1:] #drop the v1 prefix
+
+        if len(parts) == 3 and parts[0] == 'users' and parts[2] == 'playlists':
+            listing = [(playlist_id, playlist) for playlist_id, playlist in library.playlists.items()]
+            transform = lambda entry: {'id': entry[0], 'name': entry[1]['name'], 'snapshot_id': entry[1]['snapshot_id'], 'owner': {'id': library.user_id, 'display_name': library.user_id}, 'tracks': {'total': len(entry[1]['tracks'])}}
+            return 200, self._paging(path, listing, offset, min(limit, 50), transform)
+
+        if len(parts) >= 2 and parts[0] == 'playlists' and parts[1] in library.playlists:
+            playlist = library.playlists[parts[1]]
+            if len(parts) == 2 and query.get('fields') == ['snapshot_id,tracks.total']:
+                return 200, {'snapshot_id': playlist['snapshot_id'], 'tracks': {'total': len(playlist['tracks'])}}
+            if len(parts) == 2:
+                return 200, self._cached_page((path, playlist['snapshot_id']), lambda: {
+                    'id': parts[1], 'name': playlist['name'], 'description': '', 'snapshot_id': playlist['snapshot_id'], 'owner': {'id': library.user_id, 'display_name': library.user_id},
+                    'tracks': self._paging(f'/v1/playlists/{parts[1]}/tracks', playlist['tracks'], 0, 100, self._encoded_track_item)})
+            if len(parts) == 3 and parts[2] == 'tracks':
+                return 200, self._cached_page((path, playlist['snapshot_id'], offset, limit), lambda: self._paging(path, playlist['tracks'], offset, limit, self._encoded_track_item))
+
+        if parts == ['tracks']:
+            track_ids = query.get('ids', [''])[0].split(',')
+            return 200, {'tracks': [self._track_metadata(track_id) for track_id in track_ids]}
+
+        if parts == ['audio-features']:
+            track_ids = query.get('ids', [''])[0].split(',')
+            return 200, {'audio_features': [self._audio_features(track_id) for track_id in track_ids]}
+
+        return 404, {'error': {'status': 404, 'message': 'Non existing id'}}
+
+
+    def route_write(self, method, path, body):
+        '''
+        Returns (status, payload) for a POST, PUT or DELETE of the JSON body to path: creating a playlist, or appending, replacing or removing its tracks
+        '''
+        library = self.library
+        parts = path.strip('/').split('/')[1:]
+
+        if method == 'POST' and len(parts) == 3 and parts[0] == 'users' and parts[2] == 'playlists':
+            with self._count_lock:
+                self.created_playlists += 1
+                playlist_id = f'created{self.created_playlists:05d}'
+                library.playlists[playlist_id] = {'name': body['name'], 'snapshot_id': f'snapshot-{playlist_id}-0', 'tracks': []}
+            return 201, {'id': playlist_id, 'name': body['name'], 'description': body.get('description', ''), 'snapshot_id': f'snapshot-{playlist_id}-0', 'owner': {'id': library.user_id, 'display_name': library.user_id}}
+
+        if len(parts) == 3 and parts[0] == 'playlists' and parts[1] in library.playlists and parts[2] == 'tracks':
+            with self._count_lock:
+                playlist = library.playlists[parts[1]]
+                if method == 'POST':
+                    playlist['tracks'].extend(uri.rsplit(':', 1)[-1] for uri in body['uris'])
+                elif method == 'PUT':
+                    playlist['tracks'] = [uri.rsplit(':', 1)[-1] for uri in body['uris']]
+                else:
+                    removed = {item['uri'].rsplit(':', 1)[-1] for item in body['tracks']}
+                    playlist['tracks'] = [track_id for track_id in playlist['tracks'] if track_id not in removed]
+                self.playlist_edits += 1
+                playlist['snapshot_id'] = f'snapshot-{parts[1]}-edit{self.playlist_edits}'
+                return 200 if method == 'PUT' else 201, {'snapshot_id': playlist['snapshot_id']}
+
+        return 404, {'error': {'status': 404, 'message': 'Not found'}}
+
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fault = server._count_request()
+                if server.latency:
+                    time.sleep(server.latency)
+                if fault is not None:
+                    status, payload, headers = fault
+                elif not server._authorized(self.headers.get('Authorization')):
+                    status, payload, headers = 401, {'error': {'status': 401, 'message': 'The access token expired'}}, {}
+                else:
+                    parsed = urlparse(self.path)
+                    status, payload = server.route(parsed.path, parse_qs(parsed.query))
+                    headers = {}
+                body = encode_json(payload).encode()
+                self.send_response(status)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.write_request('POST')
+
+            def do_PUT(self):
+                self.write_request('PUT')
+
+            def do_DELETE(self):
+                self.write_request('DELETE')
+
+            def write_request(self, method):
+                request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                path = urlparse(self.path).path
+                headers = {}
+                if path == '/api/token':
+                    status, payload = 200, {'access_token': server.issue_token(), 'token_type': 'Bearer', 'expires_in': 3600}
+                else:
+                    fault = server._count_request()
+                    if server.latency:
+                        time.sleep(server.latency)
+                    if fault is not None:
+                        status, payload, headers = fault
+                    elif not server._authorized(self.headers.get('Authorization')):
+                        status, payload = 401, {'error': {'status': 401, 'message': 'The access token expired'}}
+                    else:
+                        status, payload = server.route_write(method, path, json.loads(request_body or b'{}'))
+                body = encode_json(payload).encode()
+                self.send_response(status)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
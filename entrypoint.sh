@@ -7,5 +7,9 @@ pwd
 # start nginx webserver, as by default is is stopped
 service nginx start
 
+# metrics left by a previous run's processes would be added to this run's (see app/uwsgi.ini)
+rm -rf /tmp/radial_metrics
+mkdir -p /tmp/radial_metrics
+
 # run our python code via uwsgi
 uwsgi --ini /var/www/radial-web-app/app/uwsgi.ini
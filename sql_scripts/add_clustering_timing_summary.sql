@@ -0,0 +1,5 @@
+
+USE radial_app;
+
+-- Per-stage timings of the job that produced each clustering (see app/scripts/metrics.py); for databases created before the column was added to create_radial_tables.sql
+ALTER TABLE Clusterings ADD COLUMN TimingSummary text;
@@ -0,0 +1,4 @@
+USE radial_app;
+
+-- When each playlist was last published, so the newest deployment of a cluster wins (see find_published_clusters in app/utils.py); for databases created before the column was added to create_radial_tables.sql
+ALTER TABLE DeployedClusters ADD COLUMN DeployedAt double;
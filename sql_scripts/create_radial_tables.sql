@@ -14,12 +14,19 @@ CREATE TABLE IF NOT EXISTS Clusterings (
     ClusteringID varchar(255) PRIMARY KEY,
     SpotifyID varchar(255),
     ClusterAlgorithm varchar(255),
-    ClustersChosen int
-    
+    ClustersChosen int,
+    TimingSummary text
 );
 
 CREATE TABLE IF NOT EXISTS DeployedClusters (
     PlaylistID varchar(255) PRIMARY KEY,
     ClusteringID varchar(255),
-    ClusterID varchar(255)
-);
\ No newline at end of file
+    ClusterID varchar(255),
+    DeployedAt double
+);
+
+
+CREATE TABLE IF NOT EXISTS TrackAudioFeatures (
+    TrackID varchar(255) PRIMARY KEY,
+    AudioFeatures text
+);
@@ -0,0 +1,191 @@
+"""
+test_api_contacter.py
+
+Requests go through the process-wide adaptive rate limiter: a 429 halves the concurrency limit once per pause and holds every request back for its Retry-After, successes raise the limit again, and 5xx responses are retried after a jittered backoff until MAX_REQUEST_RETRIES runs out. An access token is refreshed before it expires, and requests turned away with 401 at the same time share a single refresh. The faults come from the fake Spotify server in benchmarks/
+"""
+import os, random, sys, threading, time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from fake_spotify import FakeSpotifyServer, SyntheticLibrary
+from scripts import api_contacter
+from scripts.api_contacter import AdaptiveRateLimiter, Contacter, MAX_REQUEST_RETRIES
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    #a limiter of the test's own, so throttling in one test does not slow the next
+    limiter = AdaptiveRateLimiter(initial_limit=8, min_limit=1, max_limit=16)
+    monkeypatch.setattr(api_contacter, 'rate_limiter', limiter)
+    return limiter
+
+
+@pytest.fixture
+def backoff_attempts(monkeypatch):
+    attempts = []
+
+    def record_backoff(attempt):
+        attempts.append(attempt)
+        return 0
+    monkeypatch.setattr(api_contacter, 'backoff_delay', record_backoff)
+    return attempts
+
+
+def serve(**faults):
+    return FakeSpotifyServer(SyntheticLibrary(playlist_count=2, tracks_per_playlist=10), **faults)
+
+
+def contacter():
+    contacter = Contacter()
+    contacter.formAccessHeaderfromToken('fake-token')
+    return contacter
+
+
+def test_successes_raise_the_limit_additively_up_to_its_maximum():
+    limiter = AdaptiveRateLimiter(initial_limit=4, min_limit=1, max_limit=6)
+    #+1/limit per success: a round of about limit successes adds one
+    for _ in range(5):
+        limiter.record_success()
+    assert limiter.stats()['limit'] == 5
+    for _ in range(100):
+        limiter.record_success()
+    assert limiter.stats()['limit'] == 6
+
+
+def test_a_burst_of_429s_halves_the_limit_once_and_pauses_every_request():
+    limiter = AdaptiveRateLimiter(initial_limit=16, min_limit=1, max_limit=32)
+    for _ in range(5):
+        limiter.record_throttle(0.2)
+    assert limiter.stats() == {'limit': 8, 'in_flight': 0, 'throttled': 5, 'server_errors': 0}
+
+    started_at = time.monotonic()
+    with limiter.slot():
+        waited = time.monotonic() - started_at
+    assert waited >= 0.15
+
+    #the next pause halves it again, but never below the minimum
+    for _ in range(10):
+        limiter.record_throttle(0)
+        time.sleep(0.001)
+    assert limiter.stats()['limit'] == 1
+
+
+def test_slots_never_exceed_the_limit():
+    limiter = AdaptiveRateLimiter(initial_limit=3, min_limit=1, max_limit=3)
+    in_flight, most_in_flight, lock = [0], [0], threading.Lock()
+
+    def request():
+        with limiter.slot():
+            with lock:
+                in_flight[0] += 1
+                most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+
+    threads = [threading.Thread(target=request) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most_in_flight[0] == 3
+
+
+def test_backoff_is_jittered_and_capped():
+    random.seed(420)
+    for attempt in range(12):
+        delays = [api_contacter.backoff_delay(attempt) for _ in range(50)]
+        ceiling = min(api_contacter.BACKOFF_CAP, api_contacter.BACKOFF_BASE * 2 ** attempt)
+        assert all(0 <= delay <= ceiling for delay in delays)
+        assert len(set(delays)) > 1
+
+
+def test_retry_after_of_a_429_is_honoured(limiter):
+    with serve(throttle_rate=0.5, retry_after=0.1) as server:
+        started_at = time.monotonic()
+        for _ in range(5):
+            contacter().contact_api(f'{server.api_url}/audio-features', additional_request_parameters={'ids': 'track0000001'})
+        elapsed = time.monotonic() - started_at
+
+    assert server.throttled_count > 0
+    assert limiter.stats()['throttled'] == server.throttled_count
+    assert elapsed >= 0.1 * server.throttled_count * 0.9
+
+
+def test_server_errors_are_retried_with_growing_backoff(limiter, backoff_attempts):
+    with serve(error_rate=0.5) as server:
+        for _ in range(5):
+            response = contacter().contact_api(f'{server.api_url}/audio-features', additional_request_parameters={'ids': 'track0000001'})
+            assert response.status_code == 200
+
+    assert server.error_count > 0
+    assert len(backoff_attempts) == server.error_count == limiter.stats()['server_errors']
+    #each request's backoff starts over at attempt 0 and grows with every retry
+    assert backoff_attempts.count(0) <= 5 and max(backoff_attempts) >= 1
+
+
+def test_gives_up_after_the_maximum_attempts(limiter, backoff_attempts):
+    with serve(error_rate=1.0) as server:
+        with pytest.raises(AssertionError):
+            contacter().contact_api(f'{server.api_url}/audio-features', additional_request_parameters={'ids': 'track0000001'})
+    assert server.request_count == MAX_REQUEST_RETRIES + 1
+    assert backoff_attempts == list(range(MAX_REQUEST_RETRIES + 1))
+
+    with serve(throttle_rate=1.0, retry_after=0) as server:
+        with pytest.raises(AssertionError):
+            contacter().contact_api(f'{server.api_url}/audio-features', additional_request_parameters={'ids': 'track0000001'})
+    assert server.request_count == MAX_REQUEST_RETRIES + 1
+
+
+def test_a_failed_post_is_not_retried(limiter, backoff_attempts):
+    with serve(error_rate=1.0) as server:
+        with pytest.raises(AssertionError):
+            contacter().contact_api(f'{server.api_url}/playlists/playlist00000/tracks', contact_type='post', data_params='{"uris": ["spotify:track:track0000001"]}')
+    assert server.request_count == 1
+    assert backoff_attempts == []
+
+
+def refreshing_contacter(server, monkeypatch, access_expires):
+    monkeypatch.setattr(api_contacter, 'SPOTIFY_TOKEN_URL', server.token_url)
+    contacter = Contacter()
+    contacter.auth_header = {'Authorization': 'Basic fake-client'}
+    contacter.formAccessHeaderfromToken('revoked-token')
+    stored_tokens = []
+    contacter.enable_token_refresh('fake-refresh-token', access_expires, on_token_refresh=lambda *token: stored_tokens.append(token))
+    return contacter, stored_tokens
+
+
+def test_concurrent_401s_share_one_refresh(limiter, monkeypatch):
+    with serve(latency=0.05) as server:
+        server.require_auth = True
+        contacter, stored_tokens = refreshing_contacter(server, monkeypatch, time.time() + 3000)
+
+        #every request is in flight with the revoked token before the first 401 comes back
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(contacter.contact_api(f'{server.api_url}/audio-features', additional_request_parameters={'ids': 'track0000001'})))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert [response.status_code for response in responses] == [200] * 8
+    assert server.token_refreshes == 1
+    assert len(stored_tokens) == 1 and stored_tokens[0][0] == 'fake-token-1'
+
+
+def test_an_expiring_token_is_refreshed_before_the_request(limiter, monkeypatch):
+    with serve() as server:
+        server.require_auth = True
+        contacter, stored_tokens = refreshing_contacter(server, monkeypatch, time.time() + api_contacter.TOKEN_REFRESH_MARGIN / 2)
+
+        response = contacter.contact_api(f'{server.api_url}/audio-features', additional_request_parameters={'ids': 'track0000001'})
+
+    assert response.status_code == 200
+    #refreshed up front, so the revoked token was never sent
+    assert server.request_count == 1
+    assert server.token_refreshes == 1 and len(stored_tokens) == 1
+    assert not contacter.token_expiring()
@@ -0,0 +1,99 @@
+"""
+test_deploy.py
+
+Publishing the clusters can be interrupted at any point, including after Spotify applied an add whose response never arrived. Resuming from the recorded deployment state finishes every playlist in centroid order, with no track added twice and no playlist created twice. The playlists live on the fake Spotify server in benchmarks/
+"""
+import os, random, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from fake_spotify import FakeSpotifyServer, SyntheticLibrary
+from scripts import api_contacter, new_user, playlist, Contacter, SpotifyUser
+from scripts.api_contacter import AdaptiveRateLimiter
+
+
+class UnreliableSpotifyServer(FakeSpotifyServer):
+    def __init__(self, *args, **kwargs):
+        '''
+        Applies the first lost_adds track adds but answers them with a 503, as if the connection dropped after Spotify processed the request
+        '''
+        super().__init__(*args, **kwargs)
+        self.lost_adds = 0
+
+    def route_write(self, method, path, body):
+        status, payload = super().route_write(method, path, body)
+        if method == 'POST' and path.endswith('/tracks') and status == 201:
+            with self._count_lock:
+                if self.lost_adds > 0:
+                    self.lost_adds -= 1
+                    return 503, {'error': {'status': 503, 'message': 'Service unavailable'}}
+        return status, payload
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with UnreliableSpotifyServer(SyntheticLibrary(playlist_count=0)) as server:
+        #the scripts read the API url when they are imported
+        for module in (new_user, playlist):
+            monkeypatch.setattr(module, 'SPOTIFY_API_URL', server.api_url)
+        monkeypatch.setattr(api_contacter, 'rate_limiter', AdaptiveRateLimiter())
+        monkeypatch.setattr(api_contacter, 'backoff_delay', lambda attempt: 0)
+        yield server
+
+
+def build_user(library):
+    contacter = Contacter()
+    contacter.formAccessHeaderfromToken('fake-token')
+    return SpotifyUser(library.user_id, contacter=contacter, max_concurrent_requests=4)
+
+
+def clusters_of(track_count, cluster_count):
+    rng = random.Random(420)
+    labels = [rng.randrange(cluster_count) for _ in range(track_count)]
+    return {cluster_id: [f'track{index:07d}' for index, label in enumerate(labels) if label == cluster_id] for cluster_id in range(cluster_count)}
+
+
+def test_interrupted_deploy_resumes_without_duplicates(server):
+    cluster_playlists = clusters_of(1200, 4)
+    user = build_user(server.library)
+    server.lost_adds = 3
+    server.error_rate = 0.05
+
+    deployment_state, progress = {}, []
+    for attempt in range(20):
+        try:
+            playlist_ids = user.deploy_cluster_playlists(cluster_playlists, 'KMeans', deployment_state, on_progress=progress.append)
+            break
+        except AssertionError:
+            continue
+    else:
+        pytest.fail('the deploy never finished')
+
+    assert attempt > 0, 'the deploy was never interrupted'
+    assert server.lost_adds == 0
+    assert server.created_playlists == len(cluster_playlists)
+    for cluster_id, track_ids in cluster_playlists.items():
+        assert server.library.playlists[playlist_ids[cluster_id]]['tracks'] == track_ids
+    assert all(cluster_state['tracks_added'] == cluster_state['total_tracks'] for cluster_state in progress[-1].values())
+
+
+def test_resume_position_counts_an_unconfirmed_add(server):
+    user = build_user(server.library)
+    track_ids = [f'track{index:07d}' for index in range(250)]
+    server.lost_adds = 1
+    deployment_state = {}
+    with pytest.raises(AssertionError):
+        user.deploy_cluster_playlists({0: track_ids}, 'KMeans', deployment_state)
+
+    #the first add went through, but its snapshot was never confirmed
+    cluster_state = deployment_state['0']
+    assert cluster_state['tracks_added'] == 0
+    resumed = playlist.Playlist(cluster_state['playlist_id'], None, snapshot_id=cluster_state['snapshot_id'])
+    assert user.resume_position(resumed, cluster_state['tracks_added']) == playlist.TRACKS_PER_ADD
+
+    user.deploy_cluster_playlists({0: track_ids}, 'KMeans', deployment_state)
+    assert server.library.playlists[cluster_state['playlist_id']]['tracks'] == track_ids
+    assert server.created_playlists == 1
@@ -0,0 +1,61 @@
+"""
+test_feature_matrix.py
+
+The clustering input is built straight from the audio features into a float matrix. It must match what the DataFrame and MinMaxScaler path it replaced produced, and leave out tracks Spotify has no usable features for
+"""
+import os, random, sys
+
+import numpy as np, pandas as pd, pytest
+from sklearn.preprocessing import MinMaxScaler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from scripts.new_user import SpotifyUser, CLUSTERING_FEATURES
+
+
+def audio_features(track_id):
+    rng = random.Random(track_id)
+    return {'id': track_id, 'danceability': rng.random(), 'energy': rng.random(), 'loudness': -60 * rng.random(), 'speechiness': rng.random(), 'acousticness': rng.random(),
+            'instrumentalness': rng.random(), 'liveness': rng.random(), 'valence': rng.random(), 'tempo': 60 + 140 * rng.random(), 'duration_ms': rng.randrange(60000, 600000), 'key': rng.randrange(12)}
+
+
+def prepare(aggregated_audio_features):
+    track_ids, feature_matrix = SpotifyUser.build_feature_matrix(aggregated_audio_features)
+    return SpotifyUser.feature_frame(track_ids, SpotifyUser.normalize_feature_matrix(feature_matrix))
+
+
+def test_matches_the_dataframe_path():
+    aggregated_audio_features = {f'track{index:05d}': audio_features(f'track{index:05d}') for index in range(500)}
+
+    #what prepare_data_for_clustering and normalize_prepped_data used to do
+    prepped_data = pd.DataFrame({track_id: {key: value for key, value in track_features.items() if key in CLUSTERING_FEATURES} for track_id, track_features in aggregated_audio_features.items()}).T
+    prepped_data = prepped_data[list(CLUSTERING_FEATURES)]
+    expected = pd.DataFrame(MinMaxScaler().fit_transform(prepped_data), columns=prepped_data.columns, index=prepped_data.index)
+
+    pd.testing.assert_frame_equal(prepare(aggregated_audio_features), expected, check_exact=True)
+
+
+def test_tracks_without_usable_features_are_left_out():
+    aggregated_audio_features = {track_id: audio_features(track_id) for track_id in ('first', 'null_feature', 'nan_feature', 'missing_feature', 'text_feature', 'second', 'no_features', 'third')}
+    aggregated_audio_features['null_feature']['energy'] = None
+    aggregated_audio_features['nan_feature']['tempo'] = float('nan')
+    del aggregated_audio_features['missing_feature']['valence']
+    aggregated_audio_features['text_feature']['loudness'] = 'loud'
+    aggregated_audio_features['no_features'] = None
+
+    normalized_data = prepare(aggregated_audio_features)
+
+    assert list(normalized_data.index) == ['first', 'second', 'third']
+    assert list(normalized_data.columns) == list(CLUSTERING_FEATURES)
+    assert np.isfinite(normalized_data.to_numpy()).all()
+    assert np.isclose(normalized_data.to_numpy().min(), 0) and np.isclose(normalized_data.to_numpy().max(), 1)
+
+
+def test_a_constant_feature_scales_to_zero():
+    aggregated_audio_features = {track_id: dict(audio_features(track_id), liveness=0.5) for track_id in ('first', 'second', 'third')}
+    assert (prepare(aggregated_audio_features)['liveness'] == 0).all()
+
+
+def test_no_usable_track_is_an_error():
+    with pytest.raises(AssertionError):
+        SpotifyUser.build_feature_matrix({'no_features': None, 'null_feature': dict(audio_features('null_feature'), energy=None)})
@@ -0,0 +1,127 @@
+"""
+test_features_cache.py
+
+TrackFeaturesCache answers from its in-process LRU tier first and falls back to the persistent store, remembering what the store had; what is put in it is written back to the store. The in-process tier never holds more than max_entries tracks
+"""
+import contextlib, json, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from scripts.features_cache import TrackFeaturesCache, MySQLTrackFeaturesStore
+
+
+class StubStore:
+    def __init__(self, audio_features=None, failing=False):
+        self.audio_features = dict(audio_features or {})
+        self.failing = failing
+        self.requested_ids = []
+
+    def get_many(self, track_ids):
+        self.requested_ids.append(list(track_ids))
+        if self.failing:
+            raise ConnectionError('the database is down')
+        return {track_id: self.audio_features[track_id] for track_id in track_ids if track_id in self.audio_features}
+
+    def put_many(self, audio_features):
+        if self.failing:
+            raise ConnectionError('the database is down')
+        self.audio_features.update(audio_features)
+
+
+class StubPool:
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.statements = []
+        self.commits = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    @contextlib.contextmanager
+    def cursor(self):
+        yield self
+
+    def execute(self, statement, values):
+        self.statements.append((statement, values))
+
+    def executemany(self, statement, values):
+        self.statements.append((statement, list(values)))
+
+    def fetchall(self):
+        return self.rows
+
+    def commit(self):
+        self.commits += 1
+
+
+def features(track_id):
+    return {'id': track_id, 'energy': 0.5}
+
+
+def test_least_recently_used_tracks_are_evicted():
+    cache = TrackFeaturesCache(max_entries=3)
+    cache.put_many({track_id: features(track_id) for track_id in ('a', 'b', 'c')})
+    #reading 'a' makes 'b' the least recently used
+    assert cache.get_many(['a']) == {'a': features('a')}
+    cache.put_many({'d': features('d')})
+
+    assert cache.get_many(['a', 'b', 'c', 'd']) == {track_id: features(track_id) for track_id in ('a', 'c', 'd')}
+    assert cache.stats() == {'memory_hits': 4, 'store_hits': 0, 'misses': 1, 'entries': 3}
+
+
+def test_the_bound_holds_under_many_puts():
+    cache = TrackFeaturesCache(max_entries=100)
+    for batch in range(50):
+        cache.put_many({f'track{batch}-{index}': features(f'track{batch}-{index}') for index in range(30)})
+        assert cache.stats()['entries'] <= 100
+    assert cache.stats()['entries'] == 100
+    assert cache.get_many(['track49-29', 'track0-0']) == {'track49-29': features('track49-29')}
+
+
+def test_memory_misses_fall_back_to_the_store_and_are_remembered():
+    store = StubStore({'stored': features('stored')})
+    cache = TrackFeaturesCache(store, max_entries=10)
+    cache.put_many({'cached': features('cached')})
+
+    assert cache.get_many(['cached', 'stored', 'unknown']) == {'cached': features('cached'), 'stored': features('stored')}
+    assert store.requested_ids == [['stored', 'unknown']]
+    assert cache.get_many(['stored']) == {'stored': features('stored')}
+    assert store.requested_ids == [['stored', 'unknown']]
+    assert cache.stats() == {'memory_hits': 2, 'store_hits': 1, 'misses': 1, 'entries': 2}
+
+
+def test_puts_are_written_back_except_null_features():
+    store = StubStore()
+    cache = TrackFeaturesCache(store, max_entries=10)
+    cache.put_many({'known': features('known'), 'unknown': None})
+
+    assert store.audio_features == {'known': features('known')}
+    assert cache.stats()['entries'] == 1
+
+
+def test_a_failing_store_only_costs_misses():
+    cache = TrackFeaturesCache(StubStore(failing=True), max_entries=10)
+    cache.put_many({'cached': features('cached')})
+
+    assert cache.get_many(['cached', 'stored']) == {'cached': features('cached')}
+    assert cache.stats()['misses'] == 1
+
+
+def test_mysql_store_reads_and_writes_json():
+    db_pool = StubPool(rows=[('a', json.dumps(features('a')))])
+    store = MySQLTrackFeaturesStore(db_pool.connection)
+
+    assert store.get_many(['a', 'b']) == {'a': features('a')}
+    assert db_pool.statements[-1] == ('SELECT TrackID, AudioFeatures FROM TrackAudioFeatures WHERE TrackID IN (%s,%s);', ('a', 'b'))
+
+    store.put_many({'b': features('b')})
+    statement, values = db_pool.statements[-1]
+    assert statement.startswith('INSERT IGNORE INTO TrackAudioFeatures')
+    assert [(track_id, json.loads(stored)) for track_id, stored in values] == [('b', features('b'))]
+    assert db_pool.commits == 1
+
+    #nothing to look up or write means no query at all
+    assert store.get_many([]) == {}
+    store.put_many({})
+    assert len(db_pool.statements) == 2
@@ -0,0 +1,23 @@
+"""
+test_jobs.py
+
+A worker that claims a job which has been abandoned too many times fails it and moves on to the next queued job in the same claim
+"""
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import jobs
+
+
+def test_claim_next_skips_exhausted_jobs(tmp_path):
+    job_queue = jobs.JobQueue(str(tmp_path / 'jobs.db'))
+    exhausted_job_id = job_queue.submit('clustertracks', {})
+    time.sleep(0.01)
+    queued_job_id = job_queue.submit('clustertracks', {})
+    job_queue._execute('UPDATE Jobs SET Attempts=? WHERE JobID=?;', (jobs.MAX_JOB_ATTEMPTS, exhausted_job_id))
+
+    claimed = job_queue.claim_next('worker')
+
+    assert claimed is not None and claimed['JobID'] == queued_job_id
+    assert job_queue.get(exhausted_job_id)['status'] == 'failed'
@@ -0,0 +1,69 @@
+"""
+test_published_clusters.py
+
+A cluster published by several earlier clusterings with the same algorithm and number of clusters is republished to the playlist it was most recently published to. The queries run against an in-memory SQLite copy of the radial schema
+"""
+import contextlib, os, re, sqlite3, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import utils
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sql_scripts', 'create_radial_tables.sql')
+
+
+class SQLitePool:
+    def __init__(self):
+        self.database = sqlite3.connect(':memory:')
+        with open(SCHEMA_PATH) as reader:
+            self.database.executescript(reader.read().replace('USE radial_app;', ''))
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def commit(self):
+        self.database.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    @staticmethod
+    def translate(statement):
+        #MySQL placeholders and upserts in their SQLite spelling
+        statement = statement.replace('%s', '?').replace('ON DUPLICATE KEY UPDATE', 'ON CONFLICT(PlaylistID) DO UPDATE SET')
+        return re.sub(r'VALUES\((\w+)\)', r'excluded.\1', statement)
+
+    def execute(self, statement, values=()):
+        self.rows = self.database.execute(self.translate(statement), values).fetchall()
+
+    def executemany(self, statement, values):
+        self.database.executemany(self.translate(statement), values)
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_newest_earlier_deployment_wins(monkeypatch):
+    db_pool = SQLitePool()
+    for clustering_id in ('first', 'second', 'current'):
+        db_pool.execute('INSERT INTO Clusterings(ClusteringID,SpotifyID,ClusterAlgorithm,ClustersChosen) VALUES(%s,%s,%s,%s)', (clustering_id, 'user', 'KMeans', 4))
+
+    #the later deployment is recorded first, so insertion order alone would pick the older playlist
+    monkeypatch.setattr(utils.time, 'time', lambda: 200.0)
+    utils.record_published_clusters(db_pool, 'second', {0: 'newer-playlist'})
+    monkeypatch.setattr(utils.time, 'time', lambda: 100.0)
+    utils.record_published_clusters(db_pool, 'first', {0: 'older-playlist', 1: 'only-playlist'})
+
+    published = utils.find_published_clusters(db_pool, 'user', 'current', 'KMeans', 4)
+    assert published == {0: ('newer-playlist', 'second'), 1: ('only-playlist', 'first')}
+
+    #a deployment from the current clustering wins over any earlier one
+    utils.record_published_clusters(db_pool, 'current', {0: 'older-playlist'})
+    assert utils.find_published_clusters(db_pool, 'user', 'current', 'KMeans', 4)[0] == ('older-playlist', 'current')
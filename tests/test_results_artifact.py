@@ -0,0 +1,35 @@
+"""
+test_results_artifact.py
+
+The results page lists each cluster's tracks in the order of the prepared playlists (closest to the centroid first), so the stored artifact must keep that order
+"""
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import utils
+
+
+def test_results_artifact_keeps_track_order():
+    clustered_tracks = {0: ['z0a', 'a0b', 'm0c'], 1: ['y1a', 'b1b']}
+    #every track is already cached, so building the artifact asks Spotify for nothing
+    utils.track_metadata_cache.put_many({track_id: {'name': track_id, 'playable_url': '', 'album_cover_url': '', 'artists': ''} for tracks in clustered_tracks.values() for track_id in tracks})
+
+    artifact = utils.build_results_artifact({}, clustered_tracks, 'KMeans', 2)
+
+    for cluster_id, tracks in clustered_tracks.items():
+        assert list(artifact['displayable_data'][str(cluster_id)]) == tracks
+        assert artifact['total_organized_playlist_data'][str(cluster_id)]['all_tracks'] == tracks
+    assert list(artifact['displayable_data']) == ['0', '1']
+
+
+def test_results_artifact_hash_follows_content():
+    clustered_tracks = {0: ['z0a', 'a0b', 'm0c']}
+    utils.track_metadata_cache.put_many({track_id: {'name': track_id, 'playable_url': '', 'album_cover_url': '', 'artists': ''} for track_id in clustered_tracks[0]})
+
+    first = utils.build_results_artifact({}, clustered_tracks, 'KMeans', 1)
+    second = utils.build_results_artifact({}, clustered_tracks, 'KMeans', 1)
+    changed = utils.build_results_artifact({}, clustered_tracks, 'KMeans', 2)
+
+    assert first['content_hash'] == second['content_hash']
+    assert first['content_hash'] != changed['content_hash']
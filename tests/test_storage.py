@@ -0,0 +1,74 @@
+"""
+test_storage.py
+
+The prepared data is kept as .npy arrays and read back memory-mapped, and is only trusted when it was stored with the version it is asked for. Concurrent writes of one key never pair a body with another write's metadata, and only a missing object reads as None
+"""
+import hashlib, mmap, os, sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np, pandas as pd, pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from storage import LocalArtifactStore, S3ArtifactStore, save_frame, load_frame
+
+
+def test_frame_round_trip_is_memory_mapped(tmp_path):
+    store = LocalArtifactStore(str(tmp_path))
+    frame = pd.DataFrame(np.random.default_rng(420).random((50, 3)), index=[f'track{index}' for index in range(50)], columns=['energy', 'tempo', 'valence'])
+    save_frame(store, 'user/prepared_data', frame, 'version-1', library_version='library-1')
+
+    loaded = load_frame(store, 'user/prepared_data', 'version-1', library_version='library-1')
+
+    pd.testing.assert_frame_equal(loaded, frame)
+    #the values are a view of the mapped file, not a copy of it
+    values = loaded.to_numpy()
+    while isinstance(values, np.ndarray):
+        values = values.base
+    assert isinstance(values, memoryview) and isinstance(values.obj, mmap.mmap)
+
+
+def test_frame_is_ignored_when_its_versions_do_not_match(tmp_path):
+    store = LocalArtifactStore(str(tmp_path))
+    frame = pd.DataFrame(np.ones((2, 2)), index=['a', 'b'], columns=['energy', 'tempo'])
+    save_frame(store, 'user/prepared_data', frame, 'version-1', library_version='library-1')
+
+    assert load_frame(store, 'user/prepared_data', 'version-2') is None
+    assert load_frame(store, 'user/prepared_data', library_version='library-2') is None
+    assert load_frame(store, 'user/missing') is None
+
+
+def test_concurrent_puts_of_one_key_keep_each_body_with_its_etag(tmp_path):
+    store = LocalArtifactStore(str(tmp_path))
+    bodies = [bytes([index]) * (1000 + index) for index in range(8)]
+
+    def put_and_get(body):
+        for _ in range(20):
+            store.put('user/artifact.json', body, {'size': str(len(body))})
+            stored = store.get('user/artifact.json')
+            assert stored.etag == hashlib.md5(stored.body).hexdigest()
+            assert stored.metadata['size'] == str(len(stored.body))
+
+    with ThreadPoolExecutor(max_workers=len(bodies)) as executor:
+        list(executor.map(put_and_get, bodies))
+
+    assert store.get('user/artifact.json').body in bodies
+    assert os.listdir(tmp_path / 'user') == ['artifact.json']
+
+
+def test_s3_errors_other_than_a_missing_object_are_raised():
+    store = S3ArtifactStore('bucket')
+    with Stubber(store.client) as stubber:
+        stubber.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404)
+        stubber.add_client_error('get_object', service_error_code='AccessDenied', http_status_code=403)
+        stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+        stubber.add_client_error('head_object', service_error_code='503', http_status_code=503)
+
+        assert store.get('user/missing.json') is None
+        with pytest.raises(ClientError):
+            store.get('user/denied.json')
+        assert store.exists('user/missing.json') is False
+        with pytest.raises(ClientError):
+            store.exists('user/unavailable.json')